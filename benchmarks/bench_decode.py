@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+Decoding benchmark of compressed CT stacks.
+
+Measures the time to load a synthetic RLE compressed CT series
+    - with Pylinac DicomImageStack (serial, before)
+    - with SparseDicomImageStack.decode in this process (serial)
+    - with SparseDicomImageStack.decode in a pool of decoding processes
+
+The pool is started before the measurement, as in a Catphan or ACR analysis
+of several series. Run from the repository root:
+    python -m benchmarks.bench_decode
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import subprocess
+import tempfile
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+import numpy as np
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decoding benchmark of compressed CT stacks')
+    parser.add_argument('--slices', type=int, default=200, help='Number of slices in the series.')
+    parser.add_argument('--workers', type=int, nargs='*', default=[2, 4, os.cpu_count()],
+                        help='Numbers of decoding processes.')
+    parser.add_argument('--repeats', type=int, default=3, help='Repeats for each measurement.')
+    bench = parser.parse_args()
+
+    from pylinac.core.image import DicomImageStack
+    from qa_analysis.stacks import SparseDicomImageStack
+    from qa_analysis.workers import decode_pool
+
+    tmp = Path(tempfile.mkdtemp(prefix='qa_bench_'))
+    try:
+        folder = tmp / 'series'
+        subprocess.run([sys.executable, '-c',
+                        'import sys; from benchmarks.synthetic import catphan; '
+                        'catphan(sys.argv[1], n_slices=int(sys.argv[2]), rle=True)',
+                        str(folder), str(bench.slices)], check=True)
+
+        def load(pool=None):
+            stack = SparseDicomImageStack(folder)
+            stack.decode(range(len(stack)), pool=pool)
+            return stack
+
+        def timed(func):
+            times = []
+            for _ in range(bench.repeats):
+                start = perf_counter()
+                func()
+                times.append(perf_counter() - start)
+            return times
+
+        results = {'Pylinac DicomImageStack (before)': timed(lambda: DicomImageStack(folder)),
+                   'Serial': timed(load)}
+        reference = DicomImageStack(folder)
+        for workers in sorted(w for w in set(bench.workers) if w > 1):
+            with decode_pool(workers) as pool:
+                # Start the processes
+                load(pool)
+                results[f'Pool, {workers} processes'] = timed(lambda: load(pool))
+                # Same volume in the same slice order
+                stack = load(pool)
+                assert all(np.array_equal(a.array, b.array) for a, b in zip(stack, reference))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f'{bench.slices} RLE slices, {os.cpu_count()} CPUs')
+    print(f'{"Loading":<36}{"median (s)":>12}{"min (s)":>12}')
+    for name, times in results.items():
+        print(f'{name:<36}{median(times):>12.2f}{min(times):>12.2f}')
+
+
+if __name__ == "__main__":
+    main()
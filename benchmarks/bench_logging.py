@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Latency of logging calls, synchronous file handler and queued logging (logqueue.py).
+
+The log file is written through a stream that waits --write_ms for each write,
+as a log file on a network share. Measures the time of a logger.debug call
+in the analysis thread (p50, p99, max), and the records dropped in a burst
+that is larger than the queue.
+
+Run from the repository root:
+    python -m benchmarks.bench_logging --records 2000 --write_ms 2
+"""
+
+import io
+import logging
+import argparse
+from time import perf_counter, sleep
+
+import numpy as np
+
+from qa_analysis.logqueue import start_listener, stop_listener
+
+
+class SlowStream(io.StringIO):
+    """
+    Stream with a delay for each write (e.g. file on a network share).
+    """
+
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def write(self, text):
+        sleep(self.delay)
+        return super().write(text)
+
+
+def call_times(logger, records):
+    """
+    Time (ms) of each logging call.
+    """
+    times = np.empty(records)
+    for i in range(records):
+        start = perf_counter()
+        logger.debug(f'Record {i} of the benchmark')
+        times[i] = perf_counter() - start
+    return 1000 * times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Latency of logging calls')
+    parser.add_argument('--records', type=int, default=2000, help='Number of records.')
+    parser.add_argument('--write_ms', type=float, default=2, help='Delay (ms) of each write to the log file.')
+    parser.add_argument('--queue_size', type=int, default=10000, help='Size of the log queue.')
+    bench = parser.parse_args()
+
+    logger = logging.getLogger('qa.analysis')
+    root = logging.getLogger('')
+    root.setLevel(logging.DEBUG)
+    print(f'{"Logging":<14}{"p50 (ms)":>10}{"p99 (ms)":>10}{"max (ms)":>10}{"written":>10}')
+
+    # Synchronous file handler (before)
+    stream = SlowStream(bench.write_ms / 1000)
+    handler = logging.StreamHandler(stream)
+    root.addHandler(handler)
+    times = call_times(logger, bench.records)
+    root.removeHandler(handler)
+    written = stream.getvalue().count('\n')
+    print(f'{"Synchronous":<14}{np.percentile(times, 50):>10.3f}{np.percentile(times, 99):>10.3f}'
+          f'{times.max():>10.3f}{written:>10}')
+
+    # Queued, written by the listener thread
+    stream = SlowStream(bench.write_ms / 1000)
+    start_listener([logging.StreamHandler(stream)], queue_size=bench.queue_size)
+    times = call_times(logger, bench.records)
+    stop_listener()
+    written = stream.getvalue().count('\n')
+    print(f'{"Queued":<14}{np.percentile(times, 50):>10.3f}{np.percentile(times, 99):>10.3f}'
+          f'{times.max():>10.3f}{written:>10}')
+    # Dropped records are reported in the log
+    dropped = sum(int(line.split()[0]) for line in stream.getvalue().splitlines() if 'records dropped' in line)
+    print(f'Dropped {dropped} records (queue size {bench.queue_size})')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Polling benchmark of the folder observers.
+
+Measures the CPU time and the number of stat and directory listing calls
+per poll on a tree of empty files, for
+    - Watchdog polling observer (DirectorySnapshot of the whole tree, before)
+    - SnapshotIndex (observer.py), idle and with new files in one directory
+
+Run from the repository root:
+    python -m benchmarks.bench_observer
+On a network drive, the tree can be created in a given folder with --path.
+"""
+
+import os
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+from statistics import median
+from time import process_time, perf_counter
+
+from watchdog.utils.dirsnapshot import DirectorySnapshot, DirectorySnapshotDiff
+
+from qa_analysis.observer import SnapshotIndex
+
+
+def make_tree(root, n_files, dirs=100, subdirs=10):
+    """
+    Creates n_files empty files in dirs x subdirs folders (patient/series).
+    """
+    per_dir = max(1, n_files // (dirs * subdirs))
+    for i in range(dirs):
+        for j in range(subdirs):
+            folder = root / f'patient_{i:03d}' / f'series_{j:02d}'
+            folder.mkdir(parents=True)
+            for k in range(per_dir):
+                (folder / f'IM_{k:04d}.dcm').touch()
+    return dirs * subdirs * per_dir
+
+
+def measure(poll, repeats):
+    """
+    Runs the poll function. Returns median CPU time, wall time (ms) and the last result.
+    """
+    cpu, wall = [], []
+    for _ in range(repeats):
+        start_cpu, start_wall = process_time(), perf_counter()
+        res = poll()
+        cpu.append(1000 * (process_time() - start_cpu))
+        wall.append(1000 * (perf_counter() - start_wall))
+    return median(cpu), median(wall), res
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Polling benchmark of the folder observers')
+    parser.add_argument('--files', type=int, default=100000, help='Number of files in the tree.')
+    parser.add_argument('--new_files', type=int, default=100, help='Files created in one directory between polls.')
+    parser.add_argument('--repeats', type=int, default=5, help='Number of polls measured.')
+    parser.add_argument('--path', type=Path, default=None, help='Folder for the tree (default: temporary folder).')
+    bench = parser.parse_args()
+
+    tmp = Path(tempfile.mkdtemp(prefix='qa_bench_', dir=bench.path))
+    try:
+        root = tmp / 'data'
+        n_files = make_tree(root, bench.files)
+        print(f'{n_files} files')
+        print(f'{"Observer":<40}{"CPU (ms)":>10}{"wall (ms)":>11}{"stat":>9}{"listdir":>9}')
+
+        # Watchdog polling observer: snapshot of the whole tree and diff on each poll
+        counts = {'stat': 0, 'listdir': 0}
+
+        def counting_stat(path):
+            counts['stat'] += 1
+            return os.stat(path)
+
+        def counting_scandir(path):
+            counts['listdir'] += 1
+            return os.scandir(path)
+
+        previous = DirectorySnapshot(str(root), stat=counting_stat, listdir=counting_scandir)
+
+        def poll_watchdog():
+            counts['stat'], counts['listdir'] = 0, 0
+            snapshot = DirectorySnapshot(str(root), stat=counting_stat, listdir=counting_scandir)
+            return DirectorySnapshotDiff(previous, snapshot)
+
+        cpu, wall, _ = measure(poll_watchdog, bench.repeats)
+        print(f'{"Watchdog polling (before)":<40}{cpu:>10.1f}{wall:>11.1f}{counts["stat"]:>9}{counts["listdir"]:>9}')
+
+        # Snapshot index, no changes
+        index = SnapshotIndex(root)
+        index.scan()
+        # Directories modified within the mtime resolution are listed on the first poll
+        index.poll()
+
+        def poll_index():
+            index.stat_calls, index.scandir_calls = 0, 0
+            return index.poll()
+
+        cpu, wall, _ = measure(poll_index, bench.repeats)
+        print(f'{"Snapshot index, idle":<40}{cpu:>10.1f}{wall:>11.1f}{index.stat_calls:>9}{index.scandir_calls:>9}')
+
+        # Snapshot index, new files in one series folder
+        folder = root / 'patient_000' / 'series_new'
+        folder.mkdir()
+        for k in range(bench.new_files):
+            (folder / f'IM_{k:04d}.dcm').touch()
+        cpu, wall, changes = measure(poll_index, 1)
+        name = f'Snapshot index, {len(changes["files_created"])} new files'
+        print(f'{name:<40}{cpu:>10.1f}{wall:>11.1f}{index.stat_calls:>9}{index.scandir_calls:>9}')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
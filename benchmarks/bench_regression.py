@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Performance regression gate.
+
+Runs a fixed set of synthetic workloads through the analysis pipeline
+(T2/T3, Halcyon T2/T3 with T2DR, linac CBCT Catphan, ACR MR and Winston-Lutz),
+and measures the time of each stage and the peak resident memory (RSS).
+The results are compared to the baselines of the QA computer
+(benchmarks/baselines.json), and the run fails (exit code 1) if a gated stage
+or the peak memory regresses more than the threshold. No baselines are shipped:
+times depend on the machine, save them with --update on the QA computer.
+
+Stages of each workload (the median of the runs is compared):
+    import      Pylinac import (run once per process, reported but not gated:
+                it depends on the disk cache more than on the code)
+    discover    listing and grouping the files (Series date, Patient ID)
+    headers     reading the headers of the tags used by the detectors
+    classify    finding the test images (detectors.py)
+    analyze     running the test, saving the results and moving the files
+
+Each workload is run in a new process. Run from the repository root:
+    python -m benchmarks.bench_regression
+Save the baselines (first run, after an intended change, or on a new machine):
+    python -m benchmarks.bench_regression --update
+"""
+
+import os
+import sys
+import json
+import statistics
+import shutil
+import logging
+import argparse
+import platform
+import subprocess
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+from benchmarks.bench_stack_memory import peak_rss_mb
+
+# Baselines of the QA computer (see --update)
+BASELINE_PATH = Path(__file__).parent / 'baselines.json'
+STAGES = ('import', 'discover', 'headers', 'classify', 'analyze')
+# Stages that fail the run when they regress
+GATED_STAGES = ('discover', 'headers', 'classify', 'analyze')
+# Workloads: (patient, series folder)
+WORKLOADS = {
+    't2_t3': ('LINAC1', 'VMAT'),
+    'halcyon_t2_dr': ('HAL1', 'VMAT'),
+    'cbct': ('LINAC1', 'CBCT'),
+    'acr': ('MR1', 'ACR'),
+    'winston_lutz': ('LINAC1', 'WL'),
+    }
+
+
+def generate(workload, folder):
+    """
+    Writes the images of a workload. Run in a new process, not included in the measurements.
+    """
+    from benchmarks import synthetic
+
+    patient, series = WORKLOADS[workload]
+    dir_out = Path(folder) / patient / series
+    if workload == 't2_t3':
+        synthetic.vmat(dir_out, patient=patient)
+    elif workload == 'halcyon_t2_dr':
+        synthetic.vmat(dir_out, patient=patient, halcyon=True)
+    elif workload == 'cbct':
+        synthetic.catphan(dir_out, patient=patient, cbct=True)
+    elif workload == 'acr':
+        synthetic.acr_mr(dir_out, patient=patient)
+    else:
+        synthetic.winston_lutz(dir_out, patient=patient)
+
+
+def run_workload(folder, pdf):
+    """
+    Runs the pipeline stages for the files of a folder. Run in the measured process.
+    Prints the stage times (s) and peak memory (MB) as json.
+    """
+    from qa_analysis.analysis import list_images, group_headers
+    from qa_analysis.detectors import DicomHeader, required_tags, classify_headers, run_detected
+
+    root = Path(folder)
+    for sub in ['processed', 'results']:
+        (root / sub).mkdir(exist_ok=True)
+    arg = argparse.Namespace(
+        data_path=root / 'data', processed_path=root / 'processed', save_path=root / 'results',
+        network_path=None, file_types=('.dcm', '.tiff', '.tif'), catphan_model='CustomCP504',
+        catphan_loading='full', slice_margin_mm=5, mmap=False, decode_workers=1,
+        field_strength=3.0, bb_size_mm=6.0, pdf=pdf, plot=False)
+    # Analysis errors are shown, not only logged
+    logging.basicConfig(level=logging.WARNING)
+
+    times = {}
+    start = perf_counter()
+    import pylinac  # noqa: F401
+    times['import'] = perf_counter() - start
+
+    start = perf_counter()
+    groups = group_headers(list_images(arg.data_path, arg.file_types))
+    times['discover'] = perf_counter() - start
+
+    # One group per workload
+    paths = next(iter(groups.values()))
+    start = perf_counter()
+    headers = [DicomHeader(path, required_tags()) for path in paths]
+    times['headers'] = perf_counter() - start
+
+    start = perf_counter()
+    test_images = classify_headers(headers, arg)
+    times['classify'] = perf_counter() - start
+
+    start = perf_counter()
+    results = run_detected(test_images, arg, pdf=pdf)
+    times['analyze'] = perf_counter() - start
+    if results is None:
+        raise RuntimeError(f'No test detected in {folder}')
+
+    print(json.dumps({'stages': times, 'peak_rss_mb': peak_rss_mb()}))
+
+
+def measure(tmp, workload, repeat, pdf):
+    """
+    Runs a workload repeat times, each in a new process on a new copy of the files.
+    Returns the median time of each stage and the largest peak memory.
+    """
+    runs = []
+    for i in range(repeat):
+        folder = tmp / f'{workload}_{i}'
+        shutil.copytree(tmp / 'template' / workload, folder / 'data')
+        command = [sys.executable, '-W', 'ignore', '-m', 'benchmarks.bench_regression', '--run', str(folder)]
+        if pdf:
+            command.append('--pdf')
+        out = subprocess.run(command, capture_output=True, text=True)
+        if out.returncode != 0:
+            raise RuntimeError(f'{workload} failed:\n{out.stderr}')
+        runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+        shutil.rmtree(folder, ignore_errors=True)
+
+    return {'stages': {stage: statistics.median(run['stages'][stage] for run in runs) for stage in STAGES},
+            'peak_rss_mb': max(run['peak_rss_mb'] for run in runs)}
+
+
+def compare(baseline, current, threshold, memory_threshold, min_seconds):
+    """
+    Compares the measurements of one workload to its baseline.
+
+    Parameters
+    ----------
+    baseline : dict
+        Baseline stage times (s) and peak memory (MB).
+    current : dict
+        Measured stage times (s) and peak memory (MB).
+    threshold : float
+        Allowed relative increase of a stage time (e.g. 0.25 = 25 %).
+    memory_threshold : float
+        Allowed relative increase of the peak memory.
+    min_seconds : float
+        Increases smaller than this (s) are not regressions (timer noise of short stages).
+
+    Returns
+    -------
+    rows : list
+        (stage, baseline, current, change, regressed) of each stage and the peak memory.
+        Only GATED_STAGES and the peak memory are regressions.
+
+    """
+    rows = []
+    for stage in STAGES:
+        before, after = baseline['stages'].get(stage), current['stages'][stage]
+        if before is None:
+            rows.append((stage, None, after, None, False))
+            continue
+        change = (after - before) / before if before > 0 else 0
+        regressed = after > before * (1 + threshold) and after - before > min_seconds
+        rows.append((stage, before, after, change, regressed and stage in GATED_STAGES))
+
+    before, after = baseline.get('peak_rss_mb'), current['peak_rss_mb']
+    if before is None:
+        rows.append(('peak_rss_mb', None, after, None, False))
+    else:
+        change = (after - before) / before
+        rows.append(('peak_rss_mb', before, after, change, after > before * (1 + memory_threshold)))
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Performance regression gate of the analysis pipeline')
+    parser.add_argument('--workloads', nargs='+', default=list(WORKLOADS), choices=list(WORKLOADS),
+                        help='Workloads run. The default is all.')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed relative increase of a stage time (0.25 = 25%%).')
+    parser.add_argument('--memory_threshold', type=float, default=0.15,
+                        help='Allowed relative increase of the peak memory (0.15 = 15%%).')
+    parser.add_argument('--min_seconds', type=float, default=0.25,
+                        help='Stage time increases under this (s) are not regressions.')
+    parser.add_argument('--repeat', type=int, default=5, help='Runs of each workload (median is compared).')
+    parser.add_argument('--pdf', action='store_true', help='Include the pdf reports in the analyze stage.')
+    parser.add_argument('--baselines', type=Path, default=BASELINE_PATH, help='Baseline file.')
+    parser.add_argument('--update', action='store_true', help='Save the measurements as the new baselines.')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    parser.add_argument('--generate', nargs=2, metavar=('WORKLOAD', 'FOLDER'), help=argparse.SUPPRESS)
+    bench = parser.parse_args()
+
+    # Measured process and data generation
+    if bench.run:
+        run_workload(bench.run, bench.pdf)
+        return
+    if bench.generate:
+        generate(*bench.generate)
+        return
+
+    baselines = {}
+    if bench.baselines.is_file():
+        with open(bench.baselines, 'r') as f:
+            baselines = json.load(f)
+    saved = baselines.get('workloads', {})
+    # Times are comparable only on the machine of the baselines
+    machine = baselines.get('machine', {}).get('platform')
+    if machine is None and not bench.update:
+        print(f'No baselines in {bench.baselines}, save them on this machine with --update.')
+    elif machine is not None and machine != platform.platform() and not bench.update:
+        print(f'Baselines were measured on {machine}, consider --update on this machine.')
+
+    tmp = Path(tempfile.mkdtemp(prefix='qa_bench_'))
+    regressions = []
+    measured = {}
+    try:
+        for workload in bench.workloads:
+            subprocess.run([sys.executable, '-W', 'ignore', '-m', 'benchmarks.bench_regression',
+                            '--generate', workload, str(tmp / 'template' / workload)],
+                           check=True, capture_output=True)
+            measured[workload] = measure(tmp, workload, bench.repeat, bench.pdf)
+
+            # Per-stage difference to the baseline
+            print(f'\n{workload}')
+            print(f'{"Stage":<14}{"baseline":>10}{"current":>10}{"change":>9}')
+            if workload not in saved:
+                for stage in STAGES:
+                    print(f'{stage:<14}{"-":>10}{measured[workload]["stages"][stage]:>10.3f}{"-":>9}')
+                print(f'{"peak_rss_mb":<14}{"-":>10}{measured[workload]["peak_rss_mb"]:>10.0f}{"-":>9}')
+                continue
+            rows = compare(saved[workload], measured[workload], bench.threshold,
+                           bench.memory_threshold, bench.min_seconds)
+            for stage, before, after, change, regressed in rows:
+                digits = 0 if stage == 'peak_rss_mb' else 3
+                before = '-' if before is None else f'{before:.{digits}f}'
+                change = '-' if change is None else f'{100 * change:+.0f}%'
+                print(f'{stage:<14}{before:>10}{after:>10.{digits}f}{change:>9}{"  REGRESSION" if regressed else ""}')
+                if regressed:
+                    regressions.append(f'{workload} {stage}')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    if bench.update:
+        saved.update(measured)
+        baselines = {'machine': {'platform': platform.platform(), 'python': platform.python_version(),
+                                 'cpus': os.cpu_count()},
+                     'repeat': bench.repeat, 'pdf': bench.pdf, 'workloads': saved}
+        with open(bench.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        print(f'\nBaselines saved to {bench.baselines}')
+        return
+
+    if len(regressions) > 0:
+        print(f'\nRegressions (threshold {100 * bench.threshold:.0f}%, '
+              f'memory {100 * bench.memory_threshold:.0f}%): {", ".join(regressions)}')
+        sys.exit(1)
+    print('\nNo regressions')
+
+
+if __name__ == "__main__":
+    main()
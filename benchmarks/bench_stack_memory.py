@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark of CT stack loading.
+
+Measures the peak resident memory (RSS) and wall time of a Catphan analysis
+on a synthetic diagnostic CT series, with the stack loaded by
+    - Pylinac (all slices decoded, before)
+    - load_phantom (all slices decoded, headers without pixel data)
+    - load_phantom with memory-mapped pixel data
+    - load_sparse_catphan, with and without memory-mapped pixel data
+
+Each measurement is run in a new process.
+Run from the repository root:
+    python -m benchmarks.bench_stack_memory
+"""
+
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+import tempfile
+from pathlib import Path
+from time import perf_counter
+
+
+LOADERS = {
+    'Pylinac DicomImageStack (before)': 'pylinac',
+    'Decoded': 'decoded',
+    'Memory-mapped': 'mmap',
+    'Sparse': 'sparse',
+    'Sparse, memory-mapped': 'sparse_mmap',
+    }
+
+
+def peak_rss_mb():
+    """
+    Peak resident memory (MB) of this process.
+    """
+    try:
+        import resource
+    except ImportError:
+        # Windows
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2 ** 20
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def run_loader(loader, folder):
+    """
+    Loads and analyses the series. Run in the measured process.
+    """
+    from qa_analysis.phantoms import get_catphan_model
+    from qa_analysis.stacks import load_phantom, load_sparse_catphan
+
+    model = get_catphan_model('CustomCP504')
+    start = perf_counter()
+    if loader == 'pylinac':
+        cbct = model(folder)
+    elif loader.startswith('sparse'):
+        cbct = load_sparse_catphan(model, folder, mapped=loader.endswith('mmap'))
+    else:
+        cbct = load_phantom(model, folder, mapped=loader == 'mmap')
+    cbct.analyze()
+
+    res = cbct.results_data(as_dict=True)
+    print(json.dumps({'time': perf_counter() - start, 'rss': peak_rss_mb(), 'origin': res['origin_slice']}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Memory benchmark of CT stack loading')
+    parser.add_argument('--slices', type=int, default=500, help='Number of slices in the series.')
+    parser.add_argument('--spacing', type=float, default=0.5, help='Slice spacing (mm).')
+    parser.add_argument('--run', nargs=2, metavar=('LOADER', 'FOLDER'), help=argparse.SUPPRESS)
+    bench = parser.parse_args()
+
+    # Measured process
+    if bench.run:
+        run_loader(*bench.run)
+        return
+
+    tmp = Path(tempfile.mkdtemp(prefix='qa_bench_'))
+    try:
+        # Generated in a new process, not included in the measurements
+        folder = tmp / 'CT' / 'CT1' / 'series'
+        subprocess.run([sys.executable, '-c',
+                        'import sys; from benchmarks.synthetic import catphan; '
+                        'catphan(sys.argv[1], n_slices=int(sys.argv[2]), spacing=float(sys.argv[3]))',
+                        str(folder), str(bench.slices), str(bench.spacing)], check=True)
+
+        print(f'{bench.slices} slices, {bench.spacing} mm')
+        print(f'{"Loader":<36}{"peak RSS (MB)":>15}{"time (s)":>10}{"origin":>8}')
+        for name, loader in LOADERS.items():
+            out = subprocess.run([sys.executable, '-W', 'ignore', '-m', 'benchmarks.bench_stack_memory',
+                                  '--run', loader, str(folder)],
+                                 check=True, capture_output=True, text=True).stdout
+            res = json.loads(out.strip().splitlines()[-1])
+            print(f'{name:<36}{res["rss"]:>15.0f}{res["time"]:>10.1f}{res["origin"]:>8}')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
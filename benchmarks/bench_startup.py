@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark.
+
+Measures the time to
+    - run main_offline.py for an empty data folder (new process, as with task scheduler)
+    - run main_offline.py for the first job (new process, imports included)
+    - start a pre-warmed worker pool, and run the first job with it (as in main.py)
+
+The first job is a synthetic Winston-Lutz session.
+Run from the repository root:
+    python -m benchmarks.bench_startup
+"""
+
+import sys
+import shutil
+import argparse
+import subprocess
+import tempfile
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+
+
+def run_offline(tmp, data_path):
+    """
+    Runs main_offline.py in a new process. Returns the wall time (s).
+    """
+    command = [sys.executable, 'main_offline.py',
+               '--data_path', str(data_path),
+               '--network_path', str(tmp / 'no_share.txt'),
+               '--processed_path', str(tmp / 'processed'),
+               '--save_path', str(tmp / 'results'),
+               '--log_path', str(tmp / 'logs' / 'qa.log')]
+    start = perf_counter()
+    subprocess.run(command, check=True, capture_output=True)
+    return perf_counter() - start
+
+
+def pipeline_args(tmp, data_path):
+    """
+    Input arguments as in main_offline.py.
+    """
+    return argparse.Namespace(
+        data_path=data_path, network_path=None, processed_path=tmp / 'processed',
+        save_path=tmp / 'results', log_path=tmp / 'logs' / 'qa.log',
+        file_types=('.dcm', '.tiff', '.tif'), catphan_model='CustomCP504',
+        field_strength=3.0, bb_size_mm=5, pdf=False, plot=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Startup benchmark of the QA pipeline')
+    parser.add_argument('--repeats', type=int, default=3, help='Repeats for each measurement.')
+    bench = parser.parse_args()
+
+    tmp = Path(tempfile.mkdtemp(prefix='qa_bench_'))
+    (tmp / 'results').mkdir()
+    # Generated in a new process, Pylinac should not be imported in this process
+    template = tmp / 'template' / 'Winston-Lutz' / 'LINAC1' / 'WL'
+    subprocess.run([sys.executable, '-m', 'benchmarks.synthetic', 'winston_lutz', str(template)], 
+                   check=True, capture_output=True)
+
+    def fresh_data(i):
+        # Each run consumes (moves) its data folder
+        data_path = tmp / f'data_{i}'
+        shutil.copytree(tmp / 'template', data_path)
+        return data_path
+
+    results = {}
+    try:
+        # Empty data folder in a new process
+        (tmp / 'empty').mkdir()
+        results['Empty folder (new process)'] = [run_offline(tmp, tmp / 'empty') for _ in range(bench.repeats)]
+
+        # First job in a new process, imports included
+        results['First job (new process)'] = [run_offline(tmp, fresh_data(f'cold_{i}')) for i in range(bench.repeats)]
+
+        # Pre-warmed worker pool
+        from qa_analysis.workers import start_pool
+        from qa_analysis.analysis import analyze_image
+        warm, first = [], []
+        for i in range(bench.repeats):
+            start = perf_counter()
+            pool = start_pool(1)
+            warm.append(perf_counter() - start)
+
+            arg = pipeline_args(tmp, fresh_data(f'warm_{i}'))
+            start = perf_counter()
+            analyze_image(arg, pool=pool)
+            first.append(perf_counter() - start)
+            pool.shutdown()
+        results['Worker pool start (daemon startup)'] = warm
+        results['First job (warm worker pool)'] = first
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    print(f'{"Measurement":<40}{"median (s)":>12}{"min (s)":>12}')
+    for name, times in results.items():
+        print(f'{name:<40}{median(times):>12.2f}{min(times):>12.2f}')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark of the lease-based workers (main_worker.py).
+
+Runs 1..N worker processes against the same data folder of synthetic
+Winston-Lutz sessions (one group per linac), and measures the wall time
+and throughput. Checks that every group was analysed exactly once.
+
+Run from the repository root:
+    python -m benchmarks.bench_workers --groups 8 --workers 1 2 4
+"""
+
+import sys
+import shutil
+import argparse
+import subprocess
+import tempfile
+from glob import glob
+from pathlib import Path
+from time import perf_counter
+
+
+def run_workers(tmp, data_path, n_workers):
+    """
+    Runs the workers once over the data folder. Returns the wall time (s) and log file.
+    """
+    log_path = tmp / 'logs' / f'workers_{n_workers}.log'
+    command = [sys.executable, '-W', 'ignore', 'main_worker.py', '--once',
+               '--data_path', str(data_path),
+               '--network_path', str(tmp / 'no_share.txt'),
+               '--processed_path', str(tmp / f'processed_{n_workers}'),
+               '--save_path', str(tmp / f'results_{n_workers}'),
+               '--lease_path', str(tmp / f'leases_{n_workers}'),
+               '--log_path', str(log_path)]
+    (tmp / f'results_{n_workers}').mkdir()
+    start = perf_counter()
+    workers = [subprocess.Popen(command + ['--worker_name', f'worker{i}'],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+               for i in range(n_workers)]
+    for worker in workers:
+        worker.wait()
+    return perf_counter() - start, log_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput benchmark of the lease-based workers')
+    parser.add_argument('--groups', type=int, default=8, help='Number of Winston-Lutz sessions.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='Numbers of workers.')
+    bench = parser.parse_args()
+
+    tmp = Path(tempfile.mkdtemp(prefix='qa_bench_'))
+    try:
+        # One session per linac
+        for i in range(bench.groups):
+            subprocess.run([sys.executable, '-m', 'benchmarks.synthetic', 'winston_lutz',
+                            str(tmp / 'template' / f'LINAC{i}' / 'WL'), '--patient', f'LINAC{i}'],
+                           check=True, capture_output=True)
+
+        print(f'{bench.groups} groups')
+        print(f'{"Workers":<10}{"time (s)":>10}{"groups/min":>12}{"analysed":>10}{"duplicates":>12}')
+        for n_workers in bench.workers:
+            # Each run consumes (moves) its data folder
+            data_path = tmp / f'data_{n_workers}'
+            shutil.copytree(tmp / 'template', data_path)
+            wall, log_path = run_workers(tmp, data_path, n_workers)
+
+            # Groups analysed, from the worker logs (named by month)
+            analysed = []
+            for path in glob(str(log_path.parent / f'{log_path.stem}*{log_path.suffix}')):
+                with open(path, 'r') as f:
+                    analysed += [line.split('analysing ')[1] for line in f if 'analysing patient' in line]
+            duplicates = len(analysed) - len(set(analysed))
+            reports = glob(str(tmp / f'results_{n_workers}' / '**' / '*.pdf'), recursive=True)
+            print(f'{n_workers:<10}{wall:>10.1f}{60 * len(reports) / wall:>12.1f}{len(set(analysed)):>10}{duplicates:>12}')
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Load generator for the QA daemon (main.py).
+
+Replays a timeline of file arrivals into a temporary data folder while main.py
+monitors it, and measures for each (date, patient) group the latency from the
+arrival of its last file until all of its files are moved out of the data folder
+or, with --processed_mode manifest, recorded in the manifest (results are saved
+before the files are moved or recorded).
+Reports p50/p95/p99 latency, throughput and the queue depth (groups waiting
+or being analysed) over time.
+
+The timeline is either
+    - a csv file with columns time (s), group, source, destination
+      (destination relative to the data folder),
+    - recorded from an archive folder (--from_folder), using the file
+      modification times and the (date, patient) groups, or
+    - scripted (default): a morning burst of Winston-Lutz sessions from several
+      linacs within minutes, T2/T3 sessions (normal and Halcyon) of other linacs,
+      and a CT series arriving slice by slice.
+
+Run from the repository root:
+    python -m benchmarks.replay --speed 10
+Arguments after -- are passed to main.py, e.g.
+    python -m benchmarks.replay -- --observer snapshot --workers 2
+"""
+
+import os
+import sys
+import csv
+import shutil
+import sqlite3
+import argparse
+import subprocess
+import tempfile
+import threading
+from pathlib import Path
+from time import perf_counter, sleep
+
+import numpy as np
+
+
+def scripted_timeline(source, linacs=3, stagger=60, image_interval=5, ct_slices=160, slice_interval=0.5,
+                      vmat_linacs=2):
+    """
+    Morning QA burst. Generates the source files and returns the arrival events.
+
+    Parameters
+    ----------
+    source : Path
+        Folder for the generated files.
+    linacs : int, optional
+        Number of Winston-Lutz sessions (one per linac). The default is 3.
+    stagger : float, optional
+        Time (s) between the sessions of the linacs. The default is 60.
+    image_interval : float, optional
+        Time (s) between the images of a session. The default is 5.
+    ct_slices : int, optional
+        Number of CT slices, arriving after the first session. The default is 160.
+    slice_interval : float, optional
+        Time (s) between the CT slices. The default is 0.5.
+    vmat_linacs : int, optional
+        Number of T2/T3 sessions, from the linacs after the Winston-Lutz linacs (a group is one
+        test). Every second session is a Halcyon session. The default is 2.
+
+    Returns
+    -------
+    events : list
+        (time, group, source, destination) of each file.
+
+    """
+    from benchmarks.synthetic import winston_lutz, vmat, catphan
+
+    events = []
+    for i in range(linacs):
+        paths = winston_lutz(source / f'LINAC{i + 1}' / 'WL', patient=f'LINAC{i + 1}')
+        for j, path in enumerate(paths):
+            events.append((i * stagger + j * image_interval, f'LINAC{i + 1}', path,
+                           os.path.relpath(path, source)))
+
+    # T2/T3 sessions start between the Winston-Lutz sessions
+    for i in range(vmat_linacs):
+        machine = f'LINAC{linacs + i + 1}'
+        paths = vmat(source / machine / 'VMAT', patient=machine, halcyon=i % 2 == 1)
+        for j, path in enumerate(paths):
+            events.append(((i + 0.25) * stagger + j * image_interval, machine, path,
+                           os.path.relpath(path, source)))
+
+    # CT series trickles in during the linac sessions
+    paths = catphan(source / 'CT1' / 'series', n_slices=ct_slices)
+    for k, path in enumerate(paths):
+        events.append((stagger / 2 + k * slice_interval, 'CT1', path, os.path.relpath(path, source)))
+
+    return sorted(events)
+
+
+def recorded_timeline(folder, file_types=('.dcm', '.tiff', '.tif')):
+    """
+    Timeline from the files of a folder (e.g. an archived morning of QA).
+    Arrival times are the file modification times.
+
+    Parameters
+    ----------
+    folder : Path
+        Folder with the recorded files.
+    file_types : tuple, optional
+        File types included.
+
+    Returns
+    -------
+    events : list
+        (time, group, source, destination) of each file.
+
+    """
+    from qa_analysis.analysis import list_images, group_headers
+
+    groups = group_headers(list_images(folder, file_types))
+    events = []
+    for (date, patient), paths in groups.items():
+        for path in paths:
+            events.append((os.path.getmtime(path), f'{patient}_{date}', path, os.path.relpath(path, folder)))
+    start = min(event[0] for event in events)
+    return sorted((t - start, group, src, dst) for t, group, src, dst in events)
+
+
+def read_timeline(path):
+    """
+    Reads a timeline csv file (time, group, source, destination).
+    """
+    with open(path, 'r', newline='') as f:
+        return sorted((float(row['time']), row['group'], row['source'], row['destination'])
+                      for row in csv.DictReader(f))
+
+
+def write_timeline(path, events):
+    """
+    Saves a timeline as a csv file, e.g. to replay it again.
+    """
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['time', 'group', 'source', 'destination'])
+        writer.writerows(events)
+
+
+def daemon_manifest(main_args, save_path):
+    """
+    Manifest file of main.py with --processed_mode manifest, None when the files are moved.
+    """
+    from qa_analysis.manifest import use_manifest, manifest_path
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--processed_mode', default='move')
+    parser.add_argument('--manifest', type=Path, default=None)
+    parser.add_argument('--save_path', type=Path, default=save_path)
+    args, _ = parser.parse_known_args(main_args)
+    return manifest_path(args) if use_manifest(args) else None
+
+
+def recorded_files(manifest):
+    """
+    Files recorded in the manifest (see manifest.py), empty before the first record.
+    """
+    if not os.path.isfile(manifest):
+        return set()
+    try:
+        con = sqlite3.connect(manifest, timeout=5)
+        try:
+            return {path for path, in con.execute('SELECT path FROM processed')}
+        finally:
+            con.close()
+    # Table not created yet, or locked by the daemon
+    except sqlite3.Error:
+        return set()
+
+
+class Monitor(threading.Thread):
+    """
+    Samples the data folder (or the manifest) and records when each group has been
+    moved out (or recorded).
+    """
+
+    def __init__(self, data_path, events, start, interval=0.25, manifest=None):
+        super().__init__(daemon=True)
+        self.data_path = data_path
+        self.start_time = start
+        self.interval = interval
+        self.manifest = manifest
+        self.stopped = threading.Event()
+        # Files and arrival times of each group
+        self.files = {}
+        for _, group, _, dst in events:
+            self.files.setdefault(group, []).append(os.path.normpath(os.path.join(data_path, dst)))
+        self.arrived = {group: 0 for group in self.files}
+        self.last_arrival = {}
+        self.done = {}
+        # (time, queue depth) samples
+        self.queue = []
+
+    def file_arrived(self, group, t):
+        self.arrived[group] += 1
+        if self.arrived[group] == len(self.files[group]):
+            self.last_arrival[group] = t
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            t = perf_counter() - self.start_time
+            recorded = None if self.manifest is None else recorded_files(self.manifest)
+            waiting = 0
+            for group, files in self.files.items():
+                if group in self.done or self.arrived[group] == 0:
+                    continue
+                # Finished when all files have arrived and none are left in the data folder,
+                # or all are recorded in the manifest (files are left in the data folder)
+                if recorded is None:
+                    processed = not any(os.path.exists(f) for f in files)
+                else:
+                    processed = all(f in recorded for f in files)
+                if group in self.last_arrival and processed:
+                    self.done[group] = t
+                else:
+                    waiting += 1
+            self.queue.append((t, waiting))
+
+    def finished(self):
+        return len(self.done) == len(self.files)
+
+
+def copy_arrival(src, dst, staging):
+    """
+    Copies a file into the data folder. The file is copied to a staging folder
+    first, and appears complete in the data folder.
+    """
+    Path(dst).parent.mkdir(parents=True, exist_ok=True)
+    part = os.path.join(staging, os.path.basename(dst))
+    shutil.copyfile(src, part)
+    os.replace(part, dst)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Arrival replay load generator for main.py')
+    parser.add_argument('--timeline', type=Path, default=None, help='Timeline csv file (time, group, source, destination).')
+    parser.add_argument('--from_folder', type=Path, default=None, help='Record the timeline from the files of a folder.')
+    parser.add_argument('--save_timeline', type=Path, default=None, help='Save the replayed timeline as csv.')
+    parser.add_argument('--linacs', type=int, default=3, help='Scripted timeline: number of Winston-Lutz sessions.')
+    parser.add_argument('--stagger', type=float, default=60, help='Scripted timeline: time (s) between linac sessions.')
+    parser.add_argument('--vmat_linacs', type=int, default=2, help='Scripted timeline: number of T2/T3 sessions.')
+    parser.add_argument('--ct_slices', type=int, default=160, help='Scripted timeline: number of CT slices.')
+    parser.add_argument('--speed', type=float, default=1, help='Replay speed (e.g. 10 = ten times faster).')
+    parser.add_argument('--wait_time', type=int, default=5, help='wait_time of main.py (s).')
+    parser.add_argument('--warmup', type=float, default=20, help='Time (s) for main.py to start before the replay.')
+    parser.add_argument('--timeout', type=float, default=600, help='Time (s) to wait for the results after the last arrival.')
+    parser.add_argument('--queue_csv', type=Path, default=None, help='Save the queue depth over time as csv.')
+    parser.add_argument('main_args', nargs=argparse.REMAINDER, help='Arguments for main.py (after --).')
+    bench = parser.parse_args()
+    main_args = [a for a in bench.main_args if a != '--']
+
+    tmp = Path(tempfile.mkdtemp(prefix='qa_replay_'))
+    daemon = None
+    try:
+        # Timeline of file arrivals
+        if bench.timeline is not None:
+            events = read_timeline(bench.timeline)
+        elif bench.from_folder is not None:
+            events = recorded_timeline(bench.from_folder)
+        else:
+            events = scripted_timeline(tmp / 'source', linacs=bench.linacs, stagger=bench.stagger,
+                                       ct_slices=bench.ct_slices, vmat_linacs=bench.vmat_linacs)
+        if bench.save_timeline is not None:
+            write_timeline(bench.save_timeline, events)
+        print(f'{len(events)} files in {len({e[1] for e in events})} groups, '
+              f'{events[-1][0] / bench.speed:.0f} s replay')
+
+        # QA daemon monitoring an empty data folder
+        data_path = tmp / 'data'
+        for folder in ['data', 'staging', 'processed', 'results', 'logs']:
+            (tmp / folder).mkdir()
+        command = [sys.executable, '-W', 'ignore', 'main.py',
+                   '--data_path', str(data_path),
+                   '--network_path', str(tmp / 'no_share.txt'),
+                   '--processed_path', str(tmp / 'processed'),
+                   '--save_path', str(tmp / 'results'),
+                   '--log_path', str(tmp / 'logs' / 'qa.log'),
+                   '--wait_time', str(bench.wait_time)] + main_args
+        daemon = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        sleep(bench.warmup)
+        if daemon.poll() is not None:
+            raise RuntimeError(f'main.py stopped with code {daemon.returncode}')
+
+        # Replay the arrivals
+        start = perf_counter()
+        monitor = Monitor(data_path, events, start, manifest=daemon_manifest(main_args, tmp / 'results'))
+        monitor.start()
+        for t, group, src, dst in events:
+            delay = t / bench.speed - (perf_counter() - start)
+            if delay > 0:
+                sleep(delay)
+            copy_arrival(src, data_path / dst, tmp / 'staging')
+            monitor.file_arrived(group, perf_counter() - start)
+
+        # Wait until all groups are finished
+        end = perf_counter() + bench.timeout
+        while not monitor.finished() and perf_counter() < end and daemon.poll() is None:
+            sleep(0.5)
+        monitor.stopped.set()
+        monitor.join()
+
+        # Latency from the last arrival of each group
+        latency = np.array([monitor.done[g] - monitor.last_arrival[g] for g in monitor.done])
+        print(f'{"Group":<20}{"last file (s)":>14}{"done (s)":>10}{"latency (s)":>13}')
+        for group in sorted(monitor.files):
+            if group in monitor.done:
+                print(f'{group:<20}{monitor.last_arrival[group]:>14.1f}{monitor.done[group]:>10.1f}'
+                      f'{monitor.done[group] - monitor.last_arrival[group]:>13.1f}')
+            else:
+                print(f'{group:<20}{"not finished":>37}')
+        if len(latency) > 0:
+            p50, p95, p99 = np.percentile(latency, [50, 95, 99])
+            duration = max(monitor.done.values())
+            depth = np.array([d for _, d in monitor.queue])
+            print(f'Latency p50 {p50:.1f} s, p95 {p95:.1f} s, p99 {p99:.1f} s')
+            print(f'Throughput {60 * len(latency) / duration:.2f} groups/min ({len(latency)} groups in {duration:.0f} s)')
+            print(f'Queue depth mean {depth.mean():.1f}, max {depth.max()}')
+
+        if bench.queue_csv is not None:
+            with open(bench.queue_csv, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['time', 'queue_depth'])
+                writer.writerows(monitor.queue)
+    finally:
+        if daemon is not None:
+            daemon.terminate()
+            daemon.wait()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,461 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic QA images for benchmarks. 
+Images are generated with the Pylinac image generator and 
+completed with the DICOM tags used by the analysis pipeline.
+Catphan CT series are drawn here, as Pylinac has no CT generator.
+"""
+
+import os
+import argparse
+from pathlib import Path
+from datetime import datetime
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless, generate_uid
+
+# Angle (deg) and HU value of the CTP404 inserts
+CATPHAN_INSERTS = ((-90, -1000), (90, -1000), (-120, -196), (180, -104), (120, -47), (60, 115), (0, 365), (-60, 1000))
+CT_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.2'
+MR_IMAGE_STORAGE = '1.2.840.10008.5.1.4.1.1.4'
+RT_PLAN_STORAGE = '1.2.840.10008.5.1.4.1.1.481.5'
+
+
+def winston_lutz(dir_out, patient='LINAC1', date='20240501', time='080000', 
+                 axes=((0, 0, 0), (90, 0, 0), (180, 0, 0), (270, 0, 0))):
+    """
+    Writes a synthetic Winston-Lutz session (AS1200 EPID images) to a folder.
+
+    Parameters
+    ----------
+    dir_out : Path
+        Output folder.
+    patient : str, optional
+        Patient ID (device name). The default is 'LINAC1'.
+    date : str, optional
+        Series date. The default is '20240501'.
+    time : str, optional
+        Series time. The default is '080000'.
+    axes : tuple, optional
+        Gantry, collimator and couch angles of the images.
+
+    Returns
+    -------
+    list
+        Paths of the written images. The file times are the series time, the session
+        is complete (not waited for, see validation.validate_winston).
+
+    """
+    from pylinac.core.image_generator import (
+        AS1200Image, FilteredFieldLayer, GaussianFilterLayer, generate_winstonlutz)
+    
+    Path(dir_out).mkdir(parents=True, exist_ok=True)
+    generate_winstonlutz(AS1200Image(sid=1000), FilteredFieldLayer, str(dir_out),
+                         final_layers=[GaussianFilterLayer(sigma_mm=1)], bb_size_mm=5,
+                         field_size_mm=(20, 20), image_axes=list(axes))
+    
+    # Add the tags used by the pipeline, use short file names
+    paths = []
+    acquired = datetime.strptime(date + time, '%Y%m%d%H%M%S').timestamp()
+    for i, name in enumerate(sorted(os.listdir(dir_out))):
+        ds = pydicom.dcmread(os.path.join(dir_out, name))
+        add_session_tags(ds, patient, date, time)
+        ds.InstanceNumber = i + 1
+        path = os.path.join(dir_out, f'WL_{i + 1:03d}.dcm')
+        ds.save_as(path)
+        os.remove(os.path.join(dir_out, name))
+        os.utime(path, (acquired, acquired))
+        paths.append(path)
+    
+    return paths
+
+
+# RT image labels, exposures (MU) and curve labels of the VMAT test images: (label, open image, exposure)
+VMAT_IMAGES = {
+    't2_open': ('MV_243', True, 200), 't2_mlc': ('MV_243', False, 200),
+    't3_open': ('MV_32', True, 200), 't3_mlc': ('MV_32', False, 200),
+    }
+VMAT_IMAGES_HALCYON = {
+    't2_open': ('MV_243', True, 200), 't2_mlc': ('MV_243', False, 200),
+    't3_open': ('MV_190', True, 200), 't3_mlc': ('MV_40', False, 200),
+    't2_dr_open': ('MV_243', True, 60), 't2_dr_mlc': ('MV_243', False, 60),
+    }
+# Source to imager distance (mm) of Halcyon, the 43 cm imager covers 28 cm at the isocenter
+HALCYON_SID = 1540
+# Segment centres (mm) of the DMLC images
+VMAT_SEGMENTS = {
+    't2_mlc': (-60, -40, -20, 0, 20, 40, 60), 't3_mlc': (-45, -15, 15, 45),
+    't2_dr_mlc': (-60, -40, -20, 0, 20, 40, 60),
+    }
+VMAT_SEGMENTS_HALCYON = {
+    't2_mlc': (-120, -80, -40, 0, 40, 80, 120), 't3_mlc': (-112, -56, 0, 56, 112),
+    't2_dr_mlc': (-60, -40, -20, 0, 20, 40, 60),
+    }
+
+
+def vmat(dir_out, patient='LINAC1', date='20240501', time='080000', halcyon=False):
+    """
+    Writes synthetic T2 (DRGS) and T3 (DRMLC) images (AS1200 EPID images) to a folder.
+    Halcyon sessions have the Halcyon geometry (43 cm imager at 154 cm SID, 28 cm at
+    the isocenter), the T2GS and T3 fields filling the imager, and the T2DR images.
+
+    Parameters
+    ----------
+    dir_out : Path
+        Output folder.
+    patient : str, optional
+        Patient ID (device name). The default is 'LINAC1'.
+    date : str, optional
+        Series date. The default is '20240501'.
+    time : str, optional
+        Series time. The default is '080000'.
+    halcyon : bool, optional
+        Halcyon images. The default is False.
+
+    Returns
+    -------
+    list
+        Paths of the written images.
+
+    """
+    from pylinac.core.image_generator import AS1200Image, FilteredFieldLayer, GaussianFilterLayer
+    
+    Path(dir_out).mkdir(parents=True, exist_ok=True)
+    images = VMAT_IMAGES_HALCYON if halcyon else VMAT_IMAGES
+    segments = VMAT_SEGMENTS_HALCYON if halcyon else VMAT_SEGMENTS
+    
+    # Images are drawn at SID 1000 mm and magnified to the Halcyon SID in the header
+    # (the generator scales the field sizes by the squared SID)
+    mag = HALCYON_SID / 1000 if halcyon else 1
+    
+    paths = []
+    for i, (name, (label, is_open, exposure)) in enumerate(images.items()):
+        # Open field, 28 cm wide for the Halcyon segments at 12 cm (jaws at -140 mm).
+        # The Halcyon field fills the imager, its edges are drawn 1 mm inside the image.
+        width = 280 if halcyon else 160
+        sim = AS1200Image(sid=1000)
+        sim.add_layer(FilteredFieldLayer(field_size_mm=(100 * mag, (width - 2 * halcyon) * mag)))
+        sim.add_layer(GaussianFilterLayer(sigma_mm=mag))
+        
+        # DMLC images: segments of the field with lower dose between them
+        if not is_open:
+            centres = np.array(segments[name])
+            gap = np.min(np.diff(centres)) / 2 - 2
+            x = (np.arange(sim.shape[1]) - (sim.shape[1] - 1) / 2) * sim.pixel_size / mag
+            inside = np.min(np.abs(x[:, None] - centres[None, :]), axis=1) < gap
+            sim.image = (sim.image * np.where(inside, 1.0, 0.7)).astype(np.uint16)
+        
+        ds = sim.as_dicom()
+        ds.RTImageSID = 1000 * mag
+        add_session_tags(ds, patient, date, time)
+        ds.InstanceNumber = i + 1
+        ds.RTImageLabel = label
+        # Open images have the field edge curve
+        if is_open:
+            ds.add_new((0x5000, 0x2500), 'LO', 'Field Edge (Open')
+        jaws = Dataset()
+        jaws.RTBeamLimitingDeviceType = 'ASYMX'
+        jaws.LeafJawPositions = [-width / 2, width / 2]
+        exposure_item = Dataset()
+        exposure_item.MetersetExposure = exposure
+        exposure_item.BeamLimitingDeviceSequence = [jaws]
+        ds.ExposureSequence = [exposure_item]
+        path = os.path.join(dir_out, f'{name.upper()}.dcm')
+        ds.save_as(path, write_like_original=False)
+        paths.append(path)
+    
+    return paths
+
+
+def catphan(dir_out, patient='CT1', date='20240501', time='080000', n_slices=160,
+            spacing=1.0, origin_z=0.0, size=512, pixel_mm=0.5, noise=5.0, seed=0, rle=False, cbct=False):
+    """
+    Writes a synthetic Catphan 504 diagnostic CT series to a folder.
+    The phantom has the CTP404 inserts, geometric nodes and wire ramps, CTP528 line pairs,
+    CTP515 low contrast disks and a uniform CTP486 module, at the CatPhan504 module offsets.
+
+    Parameters
+    ----------
+    dir_out : Path
+        Output folder.
+    patient : str, optional
+        Patient ID (device name). The default is 'CT1'.
+    date : str, optional
+        Series date. The default is '20240501'.
+    time : str, optional
+        Series time. The default is '080000'.
+    n_slices : int, optional
+        Number of slices. The default is 160.
+    spacing : float, optional
+        Slice spacing and thickness (mm). The default is 1.0.
+    origin_z : float, optional
+        Position of the CTP404 module (mm) from the middle of the scan. The default is 0.0.
+    size : int, optional
+        Rows and columns. The default is 512.
+    pixel_mm : float, optional
+        Pixel size (mm). The default is 0.5.
+    noise : float, optional
+        Standard deviation of image noise (HU). The default is 5.0.
+    seed : int, optional
+        Seed of the image noise. The default is 0.
+    rle : bool, optional
+        Save the slices RLE compressed. The default is False.
+    cbct : bool, optional
+        Linac CBCT series (referencing an RT plan). The default is False.
+
+    Returns
+    -------
+    list
+        Paths of the written images.
+
+    """
+    Path(dir_out).mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    series_uid = generate_uid()
+    
+    # Pixel coordinates (mm) from the phantom centre
+    y, x = (np.mgrid[:size, :size] - (size - 1) / 2) * pixel_mm
+    r = np.hypot(x, y)
+    angle = np.degrees(np.arctan2(y, x))
+    
+    paths = []
+    z_scan = (np.arange(n_slices) - (n_slices - 1) / 2) * spacing
+    for i, z in enumerate(z_scan):
+        hu = catphan_slice(x, y, r, angle, z - origin_z, spacing)
+        hu = hu + rng.normal(0, noise, hu.shape)
+        
+        ds = ct_dataset(series_uid, i, z, size, pixel_mm, spacing, cbct)
+        add_session_tags(ds, patient, date, time)
+        ds.PixelData = np.clip(hu + 1000, 0, 4095).astype(np.uint16).tobytes()
+        if rle:
+            ds.compress(RLELossless)
+        path = os.path.join(dir_out, f'CT_{i + 1:04d}.dcm')
+        ds.save_as(path, write_like_original=False)
+        paths.append(path)
+        
+    return paths
+
+
+def catphan_slice(x, y, r, angle, z, thickness):
+    """
+    HU values of a Catphan 504 slice at distance z (mm) from the CTP404 centre.
+    """
+    hu = np.where(r < 100, 0.0, -1000.0)
+    
+    # CTP404: inserts, geometric nodes and 23 degree wire ramps
+    if abs(z) < 12.5:
+        for a, value in CATPHAN_INSERTS:
+            xa, ya = 58.7 * np.cos(np.radians(a)), 58.7 * np.sin(np.radians(a))
+            hu[np.hypot(x - xa, y - ya) < 6] = value
+        for xa in (-25, 25):
+            for ya in (-25, 25):
+                hu[np.hypot(x - xa, y - ya) < 1.5] = -1000
+        # Ramp is seen over the slice thickness / tan(23)
+        length = thickness / np.tan(np.radians(23))
+        shift = z / np.tan(np.radians(23))
+        along = {'Left': y, 'Right': -y, 'Top': x, 'Bottom': -x}
+        across = {'Left': x + 38, 'Right': x - 38, 'Top': y + 38, 'Bottom': y - 38}
+        for name in along:
+            hu[(np.abs(across[name]) < 0.5) & (np.abs(along[name] - shift) < length / 2)] = 1000
+    
+    # CTP528: line pairs from 1 to 10 lp/cm on a circle, counter clockwise from the left
+    elif abs(z - 30) < 2:
+        ccw = np.mod(180 - angle, 360) / 360
+        ring = np.abs(r - 47) < 4
+        arc = ccw * 2 * np.pi * 47
+        bounds = (0, 0.107, 0.173, 0.236, 0.286, 0.335, 0.387, 0.434, 0.479, 0.52, 0.565)
+        for n, (start, end) in enumerate(zip(bounds[:-1], bounds[1:])):
+            gap = 5 / (n + 1)
+            region = ring & (ccw >= start) & (ccw < end)
+            phase = (arc - start * 2 * np.pi * 47) / gap
+            hu[region & (np.floor(phase) % 2 == 1) & (phase < 2 * (n + 2))] = 1000
+    
+    # CTP515: supra-slice low contrast disks
+    elif abs(z + 30) < 20:
+        for a, radius in zip((-87.4, -69.1, -52.7, -38.5, -25.1, -12.9), (6, 3.5, 3, 2.5, 2, 1.5)):
+            xa, ya = 50 * np.cos(np.radians(a)), 50 * np.sin(np.radians(a))
+            hu[np.hypot(x - xa, y - ya) < radius] = 10
+    
+    return hu
+
+
+def ct_dataset(series_uid, index, z, size, pixel_mm, spacing, cbct=False):
+    """
+    DICOM header of a diagnostic CT or linac CBCT slice.
+    """
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = CT_IMAGE_STORAGE
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.SeriesInstanceUID = series_uid
+    ds.StudyInstanceUID = series_uid
+    ds.Modality = 'CT'
+    ds.Manufacturer = 'Benchmark'
+    ds.KVP = 120
+    ds.Exposure = 200
+    ds.FilterType = 'BODY'
+    ds.ConvolutionKernel = 'STANDARD'
+    ds.CTDIvol = 20.0
+    ds.InstanceNumber = index + 1
+    # Diagnostic CT is detected from the referenced image, linac CBCT from the referenced plan
+    ref = Dataset()
+    ref.ReferencedSOPClassUID = RT_PLAN_STORAGE if cbct else CT_IMAGE_STORAGE
+    ref.ReferencedSOPInstanceUID = generate_uid()
+    if cbct:
+        purpose = Dataset()
+        purpose.CodeValue = '58'
+        purpose.CodingSchemeDesignator = 'DCM'
+        purpose.CodeMeaning = 'RT Plan or RT Ion Plan or Radiation Set to be verified'
+        ref.PurposeOfReferenceCodeSequence = [purpose]
+        ds.ReferencedInstanceSequence = [ref]
+    else:
+        ds.ReferencedImageSequence = [ref]
+    
+    ds.ImagePositionPatient = [-(size - 1) / 2 * pixel_mm, -(size - 1) / 2 * pixel_mm, float(z)]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [pixel_mm, pixel_mm]
+    ds.SliceThickness = spacing
+    ds.Rows = ds.Columns = size
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.RescaleIntercept = -1000
+    ds.RescaleSlope = 1
+    return ds
+
+
+def acr_mr(dir_out, patient='MR1', date='20240501', time='080000', size=256, pixel_mm=0.9765625,
+           noise=5.0, seed=0):
+    """
+    Writes a synthetic ACR large phantom MR series (11 axial slices, 10 mm apart) to a folder.
+    Slice 1 has the slice thickness ramps, slice position bars and the air bubble used for
+    the phantom roll, slice 11 has the slice position bars, the other slices are uniform.
+
+    Parameters
+    ----------
+    dir_out : Path
+        Output folder.
+    patient : str, optional
+        Patient ID (device name). The default is 'MR1'.
+    date : str, optional
+        Series date. The default is '20240501'.
+    time : str, optional
+        Series time. The default is '080000'.
+    size : int, optional
+        Rows and columns. The default is 256.
+    pixel_mm : float, optional
+        Pixel size (mm). The default is 0.9765625 (250 mm field of view).
+    noise : float, optional
+        Standard deviation of image noise. The default is 5.0.
+    seed : int, optional
+        Seed of the image noise. The default is 0.
+
+    Returns
+    -------
+    list
+        Paths of the written images.
+
+    """
+    Path(dir_out).mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    series_uid = generate_uid()
+    
+    # Pixel coordinates (mm) from the phantom centre
+    y, x = (np.mgrid[:size, :size] - (size - 1) / 2) * pixel_mm
+    r = np.hypot(x, y)
+    
+    paths = []
+    for i in range(11):
+        signal = np.where(r < 95, 1000.0, 0.0)
+        if i in (0, 10):
+            # Slice position bars at the top of the phantom
+            for side in (-1, 1):
+                signal[(np.abs(x - side * 3) < 1.5) & (y > -77) & (y < -53)] = 0
+        if i == 0:
+            # Slice thickness ramps and the air bubble at the top left
+            signal[(np.abs(y + 3) < 1) & (np.abs(x) < 50)] = 2000
+            signal[(np.abs(y - 2.5) < 1) & (np.abs(x) < 50)] = 2000
+            signal[np.hypot(x + 45, y + 45) < 20] = 0
+        signal = signal + rng.normal(0, noise, signal.shape)
+        
+        ds = mr_dataset(series_uid, i, 10.0 * i, size, pixel_mm)
+        add_session_tags(ds, patient, date, time)
+        ds.PixelData = np.clip(signal, 0, 4095).astype(np.uint16).tobytes()
+        path = os.path.join(dir_out, f'MR_{i + 1:04d}.dcm')
+        ds.save_as(path, write_like_original=False)
+        paths.append(path)
+    
+    return paths
+
+
+def mr_dataset(series_uid, index, z, size, pixel_mm):
+    """
+    DICOM header of an axial MR slice (5 mm thick).
+    """
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = MR_IMAGE_STORAGE
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+    ds.SOPClassUID = MR_IMAGE_STORAGE
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.SeriesInstanceUID = series_uid
+    ds.StudyInstanceUID = series_uid
+    ds.Modality = 'MR'
+    ds.Manufacturer = 'Benchmark'
+    ds.MagneticFieldStrength = 3.0
+    ds.InstanceNumber = index + 1
+    
+    ds.ImagePositionPatient = [-(size - 1) / 2 * pixel_mm, -(size - 1) / 2 * pixel_mm, float(z)]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [pixel_mm, pixel_mm]
+    ds.SliceThickness = 5.0
+    ds.SpacingBetweenSlices = 10.0
+    ds.Rows = ds.Columns = size
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    return ds
+
+
+def add_session_tags(ds, patient, date, time):
+    """
+    Adds the session tags read by the pipeline to a dataset.
+    """
+    ds.SeriesDate = date
+    ds.SeriesTime = time
+    ds.PatientID = patient
+    ds.StationName = patient
+    ds.OperatorsName = 'Benchmark'
+    ds.PatientPosition = 'HFS'
+
+
+if __name__ == "__main__":
+    # Generate data in a separate process, e.g. to keep Pylinac imports out of a benchmark
+    parser = argparse.ArgumentParser(description='Synthetic QA images')
+    parser.add_argument('test', choices=['winston_lutz', 'vmat', 'catphan', 'acr_mr'])
+    parser.add_argument('dir_out', type=Path)
+    parser.add_argument('--patient', default='LINAC1')
+    parser.add_argument('--date', default='20240501')
+    parser.add_argument('--halcyon', action='store_true', help='Halcyon T2-T3 images (vmat)')
+    generate = parser.parse_args()
+    options = {'halcyon': True} if generate.halcyon else {}
+    globals()[generate.test](generate.dir_out, patient=generate.patient, date=generate.date, **options)
@@ -7,22 +7,21 @@ Created on Fri Apr 19 09:33:10 2024
 
 import argparse
 import logging
+import threading
 from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
 from pathlib import Path
-from time import sleep
-import os
-from tqdm import tqdm
-from pylinac import (
-    CatPhan503,
-    CatPhan504,
-    CatPhan600,
-    CatPhan604
-    )
+from time import sleep, monotonic
+from concurrent.futures.process import BrokenProcessPool
 
-from qa_analysis.constants import CustomCP504    
-from qa_analysis.analysis import analyze_image
+from qa_analysis.analysis import analyze_image, list_images
 from qa_analysis.utilities import map_network_drive, start_log
+from qa_analysis.workers import start_pool
+from qa_analysis.observer import SnapshotObserver
+from qa_analysis.scheduler import parse_priorities
+from qa_analysis.constants import PRIORITY_AGING_S
+from qa_analysis.archive import wait_archive
+from qa_analysis.manifest import unprocessed, wait_relocation
 
 
 def main():
@@ -32,24 +31,80 @@ def main():
     parser.add_argument('--data_path', type=Path, default='Z:/Python/automated-rt-qa/data')
     parser.add_argument('--network_path', type=Path, default='share.txt')
     parser.add_argument('--processed_path', type=Path, default='Z:/Python/automated-rt-qa/processed')
+    parser.add_argument('--archive', choices=['none', 'deflate', 'rle'], default='none',
+                        help='Lossless compression of the processed images (deflated or RLE transfer syntax).')
+    parser.add_argument('--archive_workers', type=int, default=2,
+                        help='Number of background threads compressing the processed images.')
+    parser.add_argument('--processed_mode', choices=['move', 'manifest'], default='move',
+                        help='Move the analysed files to processed_path, or leave them in place and record them in a manifest.')
+    parser.add_argument('--manifest', type=Path, default=None,
+                        help='SQLite manifest of the processed files. The default is processed_manifest.sqlite in save_path.')
+    parser.add_argument('--relocate', action='store_true',
+                        help='Move the files of the manifest to processed_path in the background after each run.')
     parser.add_argument('--save_path', type=Path, default='Z:/Python/automated-rt-qa/results')
     parser.add_argument('--log_path', type=Path, default='logs/automated_qa.log', help='File for saving event logs.')
+    parser.add_argument('--log_rotation', default='month', choices=['month', 'size', 'daily'],
+                        help='New log file each month, or rotated by size (--log_max_mb) or daily.')
+    parser.add_argument('--log_max_mb', type=float, default=10, help='Size (MB) of rotated log files.')
     parser.add_argument('--file_types', type=tuple, default=('.dcm', '.tiff', '.tif'), help='File types listed for analysis.')
-    parser.add_argument('--catphan_model', default=CustomCP504, 
-                        choices=[CatPhan503, CatPhan504, CatPhan600, CatPhan604, CustomCP504], 
+    parser.add_argument('--catphan_model', default='CustomCP504', 
+                        choices=['CatPhan503', 'CatPhan504', 'CatPhan600', 'CatPhan604', 'CustomCP504'], 
                         help='Catphan phantom model')
+    parser.add_argument('--catphan_mode', default='full', choices=['auto', 'quick', 'full'],
+                        help='Catphan analysis: quick (HU linearity module only), full, or auto (quick for the '
+                             'machines and series in constants.py, full weekly).')
+    parser.add_argument('--catphan_loading', default='full', choices=['full', 'sparse'],
+                        help='Decode all Catphan slices (full), or only the slices near the phantom modules (sparse).')
+    parser.add_argument('--slice_margin_mm', type=float, default=5,
+                        help='Distance (mm) from the Catphan module centres decoded with sparse loading.')
+    parser.add_argument('--mmap', action='store_true',
+                        help='Memory-map uncompressed CT and MR pixel data instead of decoding it to memory.')
+    parser.add_argument('--decode_workers', type=int, default=1,
+                        help='Number of processes for decoding compressed CT and MR slices.')
+    parser.add_argument('--vmat_workers', type=int, default=3,
+                        help='Number of processes for running the T2, T3 and T2DR tests of a session concurrently '
+                             '(limited to the cores left by the --workers processes).')
+    parser.add_argument('--catphan_workers', type=int, default=4,
+                        help='Number of processes for analysing the Catphan modules concurrently '
+                             '(limited to the cores left by the --workers processes).')
     parser.add_argument('--field_strength', type=float, default=3.0, help='MRI field strength for ACR phantom images.')
     parser.add_argument('--bb_size_mm', type=float, default=6.0, 
                         help='Size of the ball-bearing phantom for Winston-Lutz test.')
     parser.add_argument('--pdf', type=bool, default=False, help='Option for saving a pdf results file.')
     parser.add_argument('--plot', type=bool, default=False, help='Option for plotting results images.')    
-    parser.add_argument('--wait_time', type=int, default=30, help='Waiting time (s) after a file is found. Allows user to finish file transfers.')
+    parser.add_argument('--report_mode', choices=['full', 'light'], default='full',
+                        help='Resolution of the pdf reports (light: smaller files, see REPORT_DPI in constants.py).')
+    parser.add_argument('--report_dpi', type=float, default=None,
+                        help='Figure DPI of the pdf reports, overrides the report mode.')
+    parser.add_argument('--wait_time', type=int, default=30, help='Waiting time (s) after the last file is found. Allows user to finish file transfers.')
+    parser.add_argument('--max_wait_time', type=int, default=300,
+                        help='Maximum waiting time (s) after the first file is found, while files keep arriving.')
     parser.add_argument('--monitor_time', type=int, default=5, help='Waiting time (s) for checking if file structure has changed.')
+    parser.add_argument('--workers', type=int, default=1, 
+                        help='Number of worker processes. Workers are started with Pylinac imported.')
+    parser.add_argument('--prefetch_groups', type=int, default=0,
+                        help='Groups read ahead of the analysis with one worker. The default 0 analyses the groups in sequence.')
+    parser.add_argument('--memory_budget_mb', type=float, default=None,
+                        help='Memory (MB) for the analyses running at once. The default is 75%% of the physical memory.')
+    parser.add_argument('--priorities', nargs='+', default=None, metavar='MODALITY=VALUE',
+                        help='Priorities of the tests by modality, lower runs first. The default is RTIMAGE=0 CT=2 MR=2.')
+    parser.add_argument('--priority_aging_s', type=float, default=PRIORITY_AGING_S,
+                        help='Waiting time (s) that raises the priority of a group by one (prevents starvation).')
+    parser.add_argument('--observer', default='native', choices=['native', 'snapshot'],
+                        help='Watchdog observer (native), or polling only the changed directories (snapshot, for network drives).')
+    parser.add_argument('--poll_time', type=float, default=1, help='Polling interval (s) of the snapshot observer after changes.')
+    parser.add_argument('--poll_max_time', type=float, default=30, help='Maximum polling interval (s) of the snapshot observer when idle.')
     
     # Use a global variable for arguments to allow updating them outside the function
     global arg
     arg = parser.parse_args()
     
+    # Check the priorities before starting
+    try:
+        parse_priorities(arg.priorities)
+    except ValueError as e:
+        parser.error(str(e))
+    
     # Map network drive with correct password
     if arg.network_path is not None:
         map_network_drive(arg.network_path)
@@ -62,37 +117,108 @@ def main():
                                case_sensitive=True)
     
     # Set up logging for file and console
-    start_log(arg.log_path)
+    start_log(arg.log_path, rotation=arg.log_rotation, max_mb=arg.log_max_mb)
+    
+    # Start the analysis workers before monitoring, allows fast analysis of first files
+    global pool
+    pool = start_pool(arg.workers, arg.log_path)
     
     # Watchdog observer to monitor data folder
-    observer = Observer()
+    if arg.observer == 'snapshot':
+        observer = SnapshotObserver(min_interval=arg.poll_time, max_interval=arg.poll_max_time)
+    else:
+        observer = Observer()
     observer.schedule(automated_qa, arg.data_path, recursive=True)
     observer.start()
     
     try:
+        # Time of the next run for the deferred groups
+        retry = None
         while True:
-            sleep(arg.monitor_time)
+            # Files found by the observer are analysed in one run after the transfer (see AutomatedQA)
+            if automated_qa.found.wait(arg.monitor_time):
+                automated_qa.wait_transfer(arg.wait_time, arg.max_wait_time)
+                retry = run_analysis()
+            # Deferred groups are checked again without new files (e.g. completed or expired)
+            elif retry is not None and monotonic() >= retry:
+                retry = run_analysis()
+            # Compressions finished while idle (see archive.py)
+            wait_archive(block=False)
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    pool.shutdown()
+    # Background relocation (--relocate) and compression finished before exiting
+    wait_relocation()
+
+def run_analysis():
+    """
+    Analyses the new files of the data folder. Restarts the workers if a worker stopped.
+    Returns the time of the next run if files were left in the data folder (deferred groups), otherwise None.
+    """
+    # Skip the run when there are no new files, e.g. the files were analysed by the previous run
+    # (processed files are left in the data folder in the manifest mode)
+    if len(unprocessed(list_images(arg.data_path, arg.file_types), arg)) == 0:
+        return None
+    
+    global pool
+    try:
+        if arg.workers == 1 and arg.prefetch_groups > 0:
+            # The run goes through the read-ahead pipeline in the worker (see pipeline.py)
+            pool.submit(analyze_image, arg).result()
+        else:
+            analyze_image(arg, pool=pool)
+    except BrokenProcessPool:
+        # A worker was terminated abruptly (e.g. out of memory)
+        logging.info('Analysis worker stopped unexpectedly. Restarting workers...')
+        pool.shutdown(wait=False)
+        pool = start_pool(arg.workers, arg.log_path)
+    
+    if len(unprocessed(list_images(arg.data_path, arg.file_types), arg)) > 0:
+        return monotonic() + arg.wait_time
+    return None
+
 
 class AutomatedQA(PatternMatchingEventHandler):
+    """
+    Watchdog event handler. The created files are not analysed in the observer thread:
+    the events of a transfer (e.g. the files found on one poll of the snapshot observer,
+    or the slices of a CT series) request one run, which the main loop starts when no
+    files have been created for wait_time (see wait_transfer).
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Set when files are created, cleared when the run starts
+        self.found = threading.Event()
+        self.lock = threading.Lock()
+        # Times of the first and last file found since the previous run
+        self.first_found = None
+        self.last_found = None
+    
     def on_created(self, event):
-        # Skip the queue when directory is empty
-        if len(os.listdir(str(arg.data_path))) == 0:
-            return
-            
-        # Log the first file found
-        logging.info(f"{event.src_path} found. Running analysis...")
-        
-        # Wait to allow finishing file transfers
-        division = 100
-        for i in tqdm(range(division), desc=f'Wait {arg.wait_time}s to allow finishing file transfers'):
-            sleep(arg.wait_time / division)
-        
-        # Run the analysis
-        analyze_image(arg)
-        
+        with self.lock:
+            self.last_found = monotonic()
+            if self.first_found is None:
+                self.first_found = self.last_found
+                # Log the first file found
+                logging.info(f"{event.src_path} found. Waiting for the file transfer to finish...")
+        self.found.set()
+    
+    def wait_transfer(self, wait_time, max_wait_time):
+        """
+        Waits until no files have been created for wait_time (s), at most max_wait_time (s)
+        from the first file. Files created later request the next run.
+        """
+        while True:
+            with self.lock:
+                remaining = min(self.last_found + wait_time, self.first_found + max_wait_time) - monotonic()
+                if remaining <= 0:
+                    self.first_found, self.last_found = None, None
+                    self.found.clear()
+                    logging.info('Running analysis...')
+                    return
+            sleep(remaining)
+    
     def on_deleted(self, event):
         # Log only processing of directories
         if event.is_directory:
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Re-runs the QA analyses for an archive of processed images.
+"""
+
+import os
+import argparse
+from pathlib import Path
+from qa_analysis.backfill import run_backfill
+from qa_analysis.utilities import map_network_drive, start_log
+
+def main():
+    # Input arguments and constants
+    parser = argparse.ArgumentParser(
+        description='Backfill of automated radiation therapy QA tests from an archive')
+    parser.add_argument('--archive_path', type=Path, default='Z:/Python/automated-rt-qa/processed',
+                        help='Archive of analysed images. Files are not moved or modified.')
+    parser.add_argument('--network_path', type=Path, default='share.txt',
+                        help='Path for a file with network drive details.')
+    parser.add_argument('--save_path', type=Path, default='Z:/Python/automated-rt-qa/results_backfill',
+                        help='New results folder. Rerun with the same folder to resume.')
+    parser.add_argument('--log_path', type=Path, default='logs/automated_qa_backfill.log', help='File for saving event logs.')
+    parser.add_argument('--log_rotation', default='month', choices=['month', 'size', 'daily'],
+                        help='New log file each month, or rotated by size (--log_max_mb) or daily.')
+    parser.add_argument('--log_max_mb', type=float, default=10, help='Size (MB) of rotated log files.')
+    parser.add_argument('--file_types', type=tuple, default=('.dcm', '.tiff', '.tif'), help='File types listed for analysis.')
+    parser.add_argument('--exclude', nargs='*', default=['Not_analyzed'], help='Archive subfolders skipped in the backfill.')
+    parser.add_argument('--catphan_model', default='CustomCP504',
+                        choices=['CatPhan503', 'CatPhan504', 'CatPhan600', 'CatPhan604', 'CustomCP504'],
+                        help='Catphan phantom model')
+    parser.add_argument('--catphan_mode', default='full', choices=['auto', 'quick', 'full'],
+                        help='Catphan analysis: quick (HU linearity module only), full, or auto (quick for the '
+                             'machines and series in constants.py, full weekly).')
+    parser.add_argument('--catphan_loading', default='full', choices=['full', 'sparse'],
+                        help='Decode all Catphan slices (full), or only the slices near the phantom modules (sparse).')
+    parser.add_argument('--slice_margin_mm', type=float, default=5,
+                        help='Distance (mm) from the Catphan module centres decoded with sparse loading.')
+    parser.add_argument('--mmap', action='store_true',
+                        help='Memory-map uncompressed CT and MR pixel data instead of decoding it to memory.')
+    parser.add_argument('--decode_workers', type=int, default=1,
+                        help='Number of processes for decoding compressed CT and MR slices.')
+    parser.add_argument('--vmat_workers', type=int, default=1,
+                        help='Number of processes for running the T2, T3 and T2DR tests of a session concurrently.')
+    parser.add_argument('--catphan_workers', type=int, default=1,
+                        help='Number of processes for analysing the Catphan modules concurrently.')
+    parser.add_argument('--field_strength', type=float, default=3.0, help='MRI field strength for ACR phantom images.')
+    parser.add_argument('--bb_size_mm', type=float, default=6.0,
+                        help='Size of the ball-bearing phantom for Winston-Lutz test.')
+    parser.add_argument('--pdf', action='store_true', help='Option for saving pdf results files.')
+    parser.add_argument('--plot', type=bool, default=False, help='Option for plotting results images.')
+    parser.add_argument('--report_mode', choices=['full', 'light'], default='full',
+                        help='Resolution of the pdf reports (light: smaller files, see REPORT_DPI in constants.py).')
+    parser.add_argument('--report_dpi', type=float, default=None,
+                        help='Figure DPI of the pdf reports, overrides the report mode.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of parallel analysis processes.')
+    parser.add_argument('--memory_budget_mb', type=float, default=None,
+                        help='Memory (MB) for the analyses running at once. The default is 75%% of the physical memory.')
+    parser.add_argument('--retry_failed', action='store_true', help='Rerun groups that failed or had no test in a previous run.')
+
+    arg = parser.parse_args()
+
+    # Map network drive with correct password
+    if arg.network_path is not None:
+        map_network_drive(arg.network_path)
+
+    # Set up logging for file and console
+    start_log(arg.log_path, rotation=arg.log_rotation, max_mb=arg.log_max_mb)
+
+    # Backfill script
+    run_backfill(arg)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,16 +7,13 @@ Created on Fri Apr 19 09:33:10 2024
 
 import argparse
 from pathlib import Path
-from pylinac import (
-    CatPhan503,
-    CatPhan504,
-    CatPhan600,
-    CatPhan604
-    )
 
-from qa_analysis.constants import CustomCP504   
 from qa_analysis.analysis import analyze_image
 from qa_analysis.utilities import start_log
+from qa_analysis.manifest import wait_relocation
+from qa_analysis.workers import start_pool
+from qa_analysis.scheduler import parse_priorities
+from qa_analysis.constants import PRIORITY_AGING_S
 
 def main():
     # Input arguments and constants
@@ -26,25 +23,80 @@ def main():
     parser.add_argument('--network_path', type=Path, default='share.txt', 
                         help='Path for a file with network drive details.')
     parser.add_argument('--processed_path', type=Path, default='Z:/Python/automated-rt-qa/processed')
+    parser.add_argument('--archive', choices=['none', 'deflate', 'rle'], default='none',
+                        help='Lossless compression of the processed images (deflated or RLE transfer syntax).')
+    parser.add_argument('--archive_workers', type=int, default=2,
+                        help='Number of background threads compressing the processed images.')
+    parser.add_argument('--processed_mode', choices=['move', 'manifest'], default='move',
+                        help='Move the analysed files to processed_path, or leave them in place and record them in a manifest.')
+    parser.add_argument('--manifest', type=Path, default=None,
+                        help='SQLite manifest of the processed files. The default is processed_manifest.sqlite in save_path.')
+    parser.add_argument('--relocate', action='store_true',
+                        help='Move the files of the manifest to processed_path in the background after each run.')
     parser.add_argument('--save_path', type=Path, default='Z:/Python/automated-rt-qa/results')
     parser.add_argument('--log_path', type=Path, default='logs/automated_qa.log', help='File for saving event logs.')
+    parser.add_argument('--log_rotation', default='month', choices=['month', 'size', 'daily'],
+                        help='New log file each month, or rotated by size (--log_max_mb) or daily.')
+    parser.add_argument('--log_max_mb', type=float, default=10, help='Size (MB) of rotated log files.')
     parser.add_argument('--file_types', type=tuple, default=('.dcm', '.tiff', '.tif'), help='File types listed for analysis.')
-    parser.add_argument('--catphan_model', default=CustomCP504, 
-                        choices=[CatPhan503, CatPhan504, CatPhan600, CatPhan604, CustomCP504], 
+    parser.add_argument('--catphan_model', default='CustomCP504', 
+                        choices=['CatPhan503', 'CatPhan504', 'CatPhan600', 'CatPhan604', 'CustomCP504'], 
                         help='Catphan phantom model')
+    parser.add_argument('--catphan_mode', default='full', choices=['auto', 'quick', 'full'],
+                        help='Catphan analysis: quick (HU linearity module only), full, or auto (quick for the '
+                             'machines and series in constants.py, full weekly).')
+    parser.add_argument('--catphan_loading', default='full', choices=['full', 'sparse'],
+                        help='Decode all Catphan slices (full), or only the slices near the phantom modules (sparse).')
+    parser.add_argument('--slice_margin_mm', type=float, default=5,
+                        help='Distance (mm) from the Catphan module centres decoded with sparse loading.')
+    parser.add_argument('--mmap', action='store_true',
+                        help='Memory-map uncompressed CT and MR pixel data instead of decoding it to memory.')
+    parser.add_argument('--decode_workers', type=int, default=1,
+                        help='Number of processes for decoding compressed CT and MR slices.')
+    parser.add_argument('--vmat_workers', type=int, default=1,
+                        help='Number of processes for running the T2, T3 and T2DR tests of a session concurrently.')
+    parser.add_argument('--catphan_workers', type=int, default=1,
+                        help='Number of processes for analysing the Catphan modules concurrently.')
     parser.add_argument('--field_strength', type=float, default=3.0, help='MRI field strength for ACR phantom images.')
     parser.add_argument('--bb_size_mm', type=float, default=6.0, 
                         help='Size of the ball-bearing phantom for Winston-Lutz test.')
     parser.add_argument('--pdf', type=bool, default=False, help='Option for saving a pdf results file.')
     parser.add_argument('--plot', type=bool, default=False, help='Option for plotting results images.')
+    parser.add_argument('--report_mode', choices=['full', 'light'], default='full',
+                        help='Resolution of the pdf reports (light: smaller files, see REPORT_DPI in constants.py).')
+    parser.add_argument('--report_dpi', type=float, default=None,
+                        help='Figure DPI of the pdf reports, overrides the report mode.')
+    parser.add_argument('--workers', type=int, default=1, 
+                        help='Number of processes for analysing measurement groups in parallel.')
+    parser.add_argument('--prefetch_groups', type=int, default=0,
+                        help='Groups read ahead of the analysis with one worker. The default 0 analyses the groups in sequence.')
+    parser.add_argument('--memory_budget_mb', type=float, default=None,
+                        help='Memory (MB) for the analyses running at once. The default is 75%% of the physical memory.')
+    parser.add_argument('--priorities', nargs='+', default=None, metavar='MODALITY=VALUE',
+                        help='Priorities of the tests by modality, lower runs first. The default is RTIMAGE=0 CT=2 MR=2.')
+    parser.add_argument('--priority_aging_s', type=float, default=PRIORITY_AGING_S,
+                        help='Waiting time (s) that raises the priority of a group by one (prevents starvation).')
 
     arg = parser.parse_args()
     
+    # Check the priorities before starting
+    try:
+        parse_priorities(arg.priorities)
+    except ValueError as e:
+        parser.error(str(e))
+    
     # Set up logging for file and console
-    start_log(arg.log_path)
+    start_log(arg.log_path, rotation=arg.log_rotation, max_mb=arg.log_max_mb)
 
-    # Analysis script
-    analyze_image(arg)
+    # Analysis script, groups are run in worker processes if more than one is given
+    if arg.workers > 1:
+        pool = start_pool(arg.workers, arg.log_path)
+        analyze_image(arg, pool=pool)
+        pool.shutdown()
+    else:
+        analyze_image(arg)
+    # Background relocation (--relocate) and compression finished before exiting
+    wait_relocation()
     
     
 if __name__ == "__main__":   
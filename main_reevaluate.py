@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Re-evaluates the pass/fail results with the current tolerances (constants.py),
+from the measured values saved by the analyses. Images are not analysed again.
+"""
+
+import argparse
+import logging
+from pathlib import Path
+from qa_analysis.verdicts import reevaluate
+from qa_analysis.utilities import map_network_drive, start_log
+
+def main():
+    # Input arguments
+    parser = argparse.ArgumentParser(
+        description='Re-evaluation of the QA results with the current tolerances')
+    parser.add_argument('--network_path', type=Path, default='share.txt',
+                        help='Path for a file with network drive details.')
+    parser.add_argument('--save_path', type=Path, default='Z:/Python/automated-rt-qa/results',
+                        help='Results folder (results Excel files and the array store).')
+    parser.add_argument('--log_path', type=Path, default='logs/automated_qa_reevaluate.log', help='File for saving event logs.')
+    parser.add_argument('--tests', nargs='+', default=['T2-T3', 'Catphan', 'Catphan daily'],
+                        choices=['T2-T3', 'Catphan', 'Catphan daily'],
+                        help='Results re-evaluated.')
+    parser.add_argument('--dry_run', action='store_true', help='Count the changed results without saving.')
+
+    arg = parser.parse_args()
+
+    # Map network drive with correct password
+    if arg.network_path is not None:
+        map_network_drive(arg.network_path)
+
+    # Set up logging for file and console
+    start_log(arg.log_path)
+
+    # Recompute the pass/fail columns
+    summary = reevaluate(arg.save_path, tests=tuple(arg.tests), dry_run=arg.dry_run)
+    changed = sum(counts[3] for counts in summary)
+    logging.getLogger('qa.utilities').info(f'{changed} cells {"would be " if arg.dry_run else ""}changed in {len(summary)} sheets.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Analysis worker for running several machines (or processes) against the same data folder.
+
+Each (date, patient) group is claimed with a lease file in a shared folder,
+so that every group is analysed and moved by one worker only.
+"""
+
+import argparse
+import logging
+from pathlib import Path
+from time import sleep
+
+from qa_analysis.analysis import analyze_claimed
+from qa_analysis.leases import worker_name
+from qa_analysis.utilities import map_network_drive, start_log
+from qa_analysis.manifest import wait_relocation
+
+
+def main():
+    # Input arguments and constants
+    parser = argparse.ArgumentParser(
+        description='Automated radiation therapy QA tests, worker for a shared data folder')
+    parser.add_argument('--data_path', type=Path, default='Z:/Python/automated-rt-qa/data')
+    parser.add_argument('--network_path', type=Path, default='share.txt',
+                        help='Path for a file with network drive details.')
+    parser.add_argument('--processed_path', type=Path, default='Z:/Python/automated-rt-qa/processed')
+    parser.add_argument('--archive', choices=['none', 'deflate', 'rle'], default='none',
+                        help='Lossless compression of the processed images (deflated or RLE transfer syntax).')
+    parser.add_argument('--archive_workers', type=int, default=2,
+                        help='Number of background threads compressing the processed images.')
+    parser.add_argument('--processed_mode', choices=['move', 'manifest'], default='move',
+                        help='Move the analysed files to processed_path, or leave them in place and record them in a manifest '
+                             '(workers of one machine only, see manifest.py).')
+    parser.add_argument('--manifest', type=Path, default=None,
+                        help='SQLite manifest of the processed files. The default is processed_manifest.sqlite in save_path.')
+    parser.add_argument('--relocate', action='store_true',
+                        help='Move the files of the manifest to processed_path in the background after each run.')
+    parser.add_argument('--save_path', type=Path, default='Z:/Python/automated-rt-qa/results')
+    parser.add_argument('--log_path', type=Path, default='logs/automated_qa.log', help='File for saving event logs.')
+    parser.add_argument('--log_rotation', default='month', choices=['month', 'size', 'daily'],
+                        help='New log file each month, or rotated by size (--log_max_mb) or daily.')
+    parser.add_argument('--log_max_mb', type=float, default=10, help='Size (MB) of rotated log files.')
+    parser.add_argument('--file_types', type=tuple, default=('.dcm', '.tiff', '.tif'), help='File types listed for analysis.')
+    parser.add_argument('--catphan_model', default='CustomCP504',
+                        choices=['CatPhan503', 'CatPhan504', 'CatPhan600', 'CatPhan604', 'CustomCP504'],
+                        help='Catphan phantom model')
+    parser.add_argument('--catphan_mode', default='full', choices=['auto', 'quick', 'full'],
+                        help='Catphan analysis: quick (HU linearity module only), full, or auto (quick for the '
+                             'machines and series in constants.py, full weekly).')
+    parser.add_argument('--catphan_loading', default='full', choices=['full', 'sparse'],
+                        help='Decode all Catphan slices (full), or only the slices near the phantom modules (sparse).')
+    parser.add_argument('--slice_margin_mm', type=float, default=5,
+                        help='Distance (mm) from the Catphan module centres decoded with sparse loading.')
+    parser.add_argument('--mmap', action='store_true',
+                        help='Memory-map uncompressed CT and MR pixel data instead of decoding it to memory.')
+    parser.add_argument('--decode_workers', type=int, default=1,
+                        help='Number of processes for decoding compressed CT and MR slices.')
+    parser.add_argument('--vmat_workers', type=int, default=3,
+                        help='Number of processes for running the T2, T3 and T2DR tests of a session concurrently.')
+    parser.add_argument('--catphan_workers', type=int, default=4,
+                        help='Number of processes for analysing the Catphan modules concurrently.')
+    parser.add_argument('--field_strength', type=float, default=3.0, help='MRI field strength for ACR phantom images.')
+    parser.add_argument('--bb_size_mm', type=float, default=6.0,
+                        help='Size of the ball-bearing phantom for Winston-Lutz test.')
+    parser.add_argument('--pdf', type=bool, default=False, help='Option for saving a pdf results file.')
+    parser.add_argument('--plot', type=bool, default=False, help='Option for plotting results images.')
+    parser.add_argument('--report_mode', choices=['full', 'light'], default='full',
+                        help='Resolution of the pdf reports (light: smaller files, see REPORT_DPI in constants.py).')
+    parser.add_argument('--report_dpi', type=float, default=None,
+                        help='Figure DPI of the pdf reports, overrides the report mode.')
+    parser.add_argument('--wait_time', type=int, default=30,
+                        help='Files that are not DICOM are moved to Not_analyzed after this time (s).')
+    parser.add_argument('--lease_path', type=Path, default=None,
+                        help='Shared folder for the lease files. The default is processed_path/.leases.')
+    parser.add_argument('--lease_ttl', type=float, default=300,
+                        help='Time (s) without heartbeat after which the lease of a stopped worker is reclaimed.')
+    parser.add_argument('--worker_name', default=None, help='Name of the worker in the logs. The default is host and process.')
+    parser.add_argument('--poll_time', type=float, default=10, help='Waiting time (s) between checks of the data folder.')
+    parser.add_argument('--once', action='store_true', help='Check the data folder once and exit.')
+
+    arg = parser.parse_args()
+    if arg.lease_path is None:
+        arg.lease_path = arg.processed_path / '.leases'
+    arg.lease_path.mkdir(parents=True, exist_ok=True)
+    worker = worker_name() if arg.worker_name is None else arg.worker_name
+
+    # Map network drive with correct password
+    if arg.network_path is not None:
+        map_network_drive(arg.network_path)
+
+    # Set up logging for file and console
+    start_log(arg.log_path, rotation=arg.log_rotation, max_mb=arg.log_max_mb)
+    logging.info(f'Worker {worker} started for {arg.data_path}')
+
+    try:
+        while True:
+            analyze_claimed(arg, arg.lease_path, worker)
+            if arg.once:
+                break
+            sleep(arg.poll_time)
+    except KeyboardInterrupt:
+        # Leases are released when the analysis is interrupted
+        logging.info(f'Worker {worker} stopped')
+    # Background relocation (--relocate) and compression finished before exiting
+    wait_relocation()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-aware admission of analysis jobs to the worker pool.
+
+The memory footprint of each (date, patient) group is estimated from the
+DICOM headers (Rows x Columns x BitsAllocated x number of images, and an
+overhead for the test). Jobs are started only while the estimated total of the
+running jobs stays under a memory budget. Small jobs (e.g. Winston-Lutz RT images)
+can start before large CT and MR stacks waiting for memory.
+"""
+import os
+import logging
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+from qa_analysis.constants import (
+    MEMORY_PIXEL_FACTOR, MEMORY_OVERHEAD_MB, MEMORY_DEFAULT_OVERHEAD_MB, SMALL_JOB_MB
+    )
+
+# Tags for the estimate: Modality, Rows, Columns, Bits allocated, Number of frames
+MEMORY_TAGS = [(0x0008, 0x0060), (0x0028, 0x0010), (0x0028, 0x0011), (0x0028, 0x0100), (0x0028, 0x0008)]
+
+
+def estimate_memory(paths):
+    """
+    Estimates the peak memory of analysing a group from the DICOM headers.
+    One header is read per folder (images of a series have the same size).
+
+    Parameters
+    ----------
+    paths : list
+        Files of the group.
+
+    Returns
+    -------
+    memory : float
+        Estimated memory (MB).
+
+    """
+    folders = {}
+    for path in paths:
+        folders.setdefault(os.path.dirname(path), []).append(path)
+
+    pixels, overhead = 0, 0
+    for files in folders.values():
+        for path in files:
+            try:
+                ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=MEMORY_TAGS)
+                break
+            except (InvalidDicomError, OSError):
+                continue
+        else:
+            continue
+        frames = int(ds.get('NumberOfFrames', 1) or 1)
+        pixels += ds.get('Rows', 0) * ds.get('Columns', 0) * ds.get('BitsAllocated', 16) / 8 * frames * len(files)
+        overhead = max(overhead, MEMORY_OVERHEAD_MB.get(ds.get('Modality', ''), MEMORY_DEFAULT_OVERHEAD_MB))
+
+    return MEMORY_PIXEL_FACTOR * pixels / 2 ** 20 + (overhead or MEMORY_DEFAULT_OVERHEAD_MB)
+
+
+def total_memory():
+    """
+    Physical memory of the machine (MB), or None if not available.
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().total / 2 ** 20
+    except ImportError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2 ** 20
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def memory_budget(budget_mb=None, fraction=0.75):
+    """
+    Memory budget (MB) for the running jobs.
+
+    Parameters
+    ----------
+    budget_mb : float, optional
+        Given budget. The default is None, which uses a fraction of the physical memory.
+    fraction : float, optional
+        Fraction of the physical memory. The default is 0.75.
+
+    Returns
+    -------
+    budget : float or None
+        Budget (MB), None if the memory is not known (no limit).
+
+    """
+    if budget_mb is not None:
+        return budget_mb
+    total = total_memory()
+    return None if total is None else fraction * total
+
+
+def run_admitted(pool, jobs, budget_mb=None, workers=1, small_mb=SMALL_JOB_MB, scheduler=None):
+    """
+    Submits jobs to the pool while the estimated memory of the running jobs stays under the budget.
+    Jobs start in the given order (or the scheduler order), except that jobs under small_mb can pass
+    a job waiting for memory. A job larger than the budget is started alone.
+
+    Parameters
+    ----------
+    pool : ProcessPoolExecutor
+        Worker pool.
+    jobs : list
+        (key, memory (MB), function, arguments) of each job.
+    budget_mb : float, optional
+        Memory budget (MB). The default is None (no limit).
+    workers : int, optional
+        Number of jobs running at once (workers in the pool). The default is 1.
+    small_mb : float, optional
+        Jobs under this size can pass a job waiting for memory. The default is SMALL_JOB_MB.
+    scheduler : PriorityScheduler, optional
+        Orders the waiting jobs and records their waiting times (see scheduler.py). The default is None.
+
+    Yields
+    ------
+    key, future
+        Key and future of each finished job, in the order of finishing.
+
+    """
+    # Analysis logger
+    logger_a = logging.getLogger('qa.analysis')
+
+    pending = list(jobs)
+    running = {}
+    used = 0
+    while len(pending) > 0 or len(running) > 0:
+        # Priorities change while jobs wait (aging)
+        if scheduler is not None:
+            pending = scheduler.order(pending)
+        # Start the jobs that fit in the budget
+        blocked = False
+        for job in list(pending):
+            if len(running) >= workers:
+                break
+            key, memory, function, args = job
+            fits = budget_mb is None or used + memory <= budget_mb or len(running) == 0
+            if fits and (not blocked or memory <= small_mb):
+                running[pool.submit(function, *args)] = (key, memory)
+                used += memory
+                pending.remove(job)
+                logger_a.debug(f'Started {key} (estimated {memory:.0f} MB, running {used:.0f} MB)')
+                if scheduler is not None:
+                    scheduler.started(key)
+            elif not blocked:
+                # Larger jobs wait in order
+                blocked = True
+                logger_a.debug(f'{key} waits for memory (estimated {memory:.0f} MB, running {used:.0f} MB)')
+
+        # Wait for a job to finish
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in done:
+            key, memory = running.pop(future)
+            used -= memory
+            yield key, future
@@ -5,37 +5,48 @@ Created on Mon Apr 22 10:32:35 2024
 @author: rytkysan
 
 Known issues: 
-    - Identification of faulty image (cropped field)
     - Other data types than dicom
     - Pylinac 3.22 does not sort multiple series correctly. Issue raised:
         https://github.com/jrkerns/pylinac/issues/494
 """
-from pylinac import image
 from glob import glob
-import numpy as np
+import os
+import random
+from time import time
+import pydicom
+from pydicom.errors import InvalidDicomError
 from pathlib import Path
-from os.path import dirname
 import logging
 
-from qa_analysis.tests import drgs_test, drmlc_test, catphan_analysis, winston_analysis, acr_analysis
-from qa_analysis.utilities import save_excel, move_file, remove_empty_dir, map_network_drive
-from qa_analysis.constants import (
-    T2_DR_ROI_HAL, T2_GS_ROI_HAL, T3_MLC_ROI_HAL, 
-    DRGS_TOL, DRMLC_TOL, CATPHAN_CBCT_TOLERANCES, CATPHAN_TOLERANCES
+from qa_analysis.admission import estimate_memory, memory_budget, run_admitted
+from qa_analysis.scheduler import PriorityScheduler, parse_priorities
+from qa_analysis.constants import PRIORITY_AGING_S
+from qa_analysis.leases import Lease, group_key, hold
+from qa_analysis.detectors import (
+    DicomHeader, required_tags, classify_headers, validate_detected, stream_detected, run_detected
     )
+from qa_analysis.validation import Invalid
+from qa_analysis.pipeline import Pipeline, read_ahead
+from qa_analysis.archive import wait_archive
+from qa_analysis.manifest import unprocessed, record, flush_manifest, relocate, use_manifest, NOT_ANALYZED
+from qa_analysis.utilities import move_file, remove_empty_dir, map_network_drive
     
 
-def analyze_image(arg):
+def analyze_image(arg, pool=None):
     """
     Main analysis pipeline.
     
-    Identifies T2-T3 test based on RT image label and Meterset exposure.
+    Identifies the tests from the DICOM headers (see detectors.py).
+    T2-T3 tests are identified based on RT image label and Meterset exposure.
     With Halcyon DR test, exposure is ~60MU.
     
     Parameters
     ----------
     arg : TYPE
         Input arguments.
+    pool : ProcessPoolExecutor, optional
+        Worker processes for running the analyses (see workers.py). 
+        The default is None, which runs the analyses in this process.
 
     Returns
     -------
@@ -49,325 +60,364 @@ def analyze_image(arg):
     if arg.network_path is not None:
         map_network_drive(arg.network_path)
     
-    # List dicom files in data path
-    images = []
-    for file_type in arg.file_types:
-        images += glob(str(arg.data_path / f'**/*{file_type}'), recursive=True)
-    images.sort()
+    # Files in the data folder when the run starts, files arriving during the run are left for the next run
+    present = set(glob(str(arg.data_path / '**/*.*'), recursive=True))
+    # List dicom files in data path, except the processed files of the manifest (see manifest.py)
+    images = unprocessed(list_images(arg.data_path, arg.file_types), arg)
     
     # Check for empty directory
     if len(images) == 0:
         logger_a.info('No files in the analysis folder!')
+        # Files of the manifest are still moved with --relocate
+        relocate(arg)
         return
     
-    # Load dicom images
-    dcm_images = []
-    dates = []  # Series date
-    times = []  # Series time
-    patients = []  # Patient ID (device name)
-    files = []  # File names
-    for i in range(len(images)):
-        dcm_images.append(image.LinacDicomImage(images[i]))
-        dates.append(dcm_images[i].metadata[0x0008, 0x0021].value)
-        times.append(dcm_images[i].metadata[0x0008, 0x0031].value)
-        patients.append(dcm_images[i].metadata[0x0010, 0x0020].value)
-        files.append(Path(images[i]).stem)
+    # Group the images by Series date and Patient ID (device name)
+    groups = group_headers(images)
     
-    # Sort images by Series Date
-    dates, times, dcm_images, patients, files = zip(
-        *sorted(zip(dates, times, dcm_images, patients, files), 
-                key=lambda x: x[0]))
+    # Groups are started by test type, estimated cost and waiting time (see scheduler.py)
+    scheduler = job_scheduler(arg)
+    jobs = []
+    for (date, patient), paths in groups.items():
+        memory = estimate_memory(paths)
+        scheduler.add((date, patient), paths, memory)
+        jobs.append(((date, patient), memory, analyze_files, (paths, arg, date, patient)))
     
-    # Pick unique measurement dates, linac (and test?)
-    unique_dates = np.unique(dates)
-        
-    # Loop for measurement dates
-    for date in unique_dates:
-
-        # Indexes of the measurement date
-        date_id = np.where(np.array(dates) == date)[0]
+    # Loop for measurement dates and patients
+    # Files of deferred groups are left in the data folder for the next run
+    deferred = set()
+    prefetch = getattr(arg, 'prefetch_groups', 0)
+    # Plots are shown from the analysis, the pipeline is used without plots
+    if pool is None and prefetch > 0 and not getattr(arg, 'plot', False):
+        # Reports are drawn in the commit thread, without a window backend
+        import matplotlib
+        matplotlib.use('Agg')
         
-        # Pick unique patients on the measurement date
-        unique_patients = np.unique(np.array(patients)[date_id])
+        def analyze(key, headers):
+            scheduler.started(key)
+            return analyze_group(headers, arg, *key)
         
-        # Loop for all patients
-        for patient in unique_patients:            
-            # Indexes of the same patient ID in the measurement date
-            pat_id =  np.where(np.array(patients) == patient)[0]
-            # Combine the date and patient id
-            pat_id = list(set(pat_id) & set(date_id))
-                        
-            try:                
-                # Loop through images of the patient in measurement date
-                # Find the relevant images for each test
-                test_images = {
-                    't2_dr_segment_size': None,
-                    't2_gs_segment_size': None,
-                    't3_segment_size': None,
-                    't2_dr_roi': None,
-                    't2_gs_roi': None,
-                    't3_roi': None}
-                for im_id in pat_id:
-                    # Find if the image is from T2 or T3 test
-                    test_images = detect_t2_t3_tests(dcm_images[im_id], test_images) 
-                    
-                    # Find Catphan images
-                    test_images = detect_catphan_tests(dcm_images[im_id], test_images)
-                    
-                    # Find ACR images
-                    test_images = detect_acr_tests(dcm_images[im_id], test_images, arg)
-                    
-                    # Find Winston-Lutz images
-                    test_images = detect_winston_tests(dcm_images[im_id], test_images)
-                
-                # T2/T3 test detected
-                if 't3_mlc' in test_images:
-                    # Run T2/T3 analysis
-                    run_t2_t3_tests(test_images, arg)
-                elif 'catphan' in test_images:
-                    # Run Caphan analysis
-                    results = catphan_analysis(test_images['catphan'], arg, 
-                                               tolerances=CATPHAN_TOLERANCES) 
-                elif 'catphan_linac' in test_images:
-                    # Run Caphan analysis
-                    results = catphan_analysis(test_images['catphan_linac'], arg, 
-                                               tolerances=CATPHAN_CBCT_TOLERANCES) 
-                elif 'acr' in test_images:
-                    # Run ACR analysis
-                    results = acr_analysis(test_images['acr'], arg)
-                elif 'winston' in test_images:
-                    # Run Winston-Lutz analysis                    
-                    results = winston_analysis(test_images['winston'], arg)                    
-                # Here more tests could be ran
-                else:
-                    logger_a.info(f'Test not implemented for patient {patient}, date {date}')
-    
-            # Missing dictionary data raises KeyError
-            # ValueError when running Winston analysis with incorrect images
-            except (KeyError, ValueError, ZeroDivisionError) as e:
-                logger_a.debug(f'Cannot analyse from measurement date {date} due to error {e}')
-                
+        # Next groups are read and the previous results saved during the analysis (see pipeline.py)
+        pipeline = Pipeline(prefetch)
+        for key, result in pipeline.run([(key, groups[key]) for key in groups], scheduler.order,
+                                        prefetch_group, analyze):
+            if isinstance(result, Invalid):
+                deferred.update(groups[key])
+    elif pool is None:
+        while len(jobs) > 0:
+            # Priorities change while jobs wait (aging)
+            key, _, function, args = scheduler.order(jobs)[0]
+            jobs = [job for job in jobs if job[0] != key]
+            scheduler.started(key)
+            if isinstance(function(*args), Invalid):
+                deferred.update(groups[key])
+    else:
+        # Groups start while their estimated memory fits in the budget
+        budget = memory_budget(getattr(arg, 'memory_budget_mb', None))
+        for key, future in run_admitted(pool, jobs, budget, workers=getattr(arg, 'workers', 1), scheduler=scheduler):
+            if isinstance(future.result(), Invalid):
+                deferred.update(groups[key])
     
     
     # List dicom files remaining in data path
-    images = glob(str(arg.data_path / '**/*.*'), recursive=True)
-    images.sort()
+    images = unprocessed(glob(str(arg.data_path / '**/*.*'), recursive=True), arg)
+    images = sorted(im for im in images if im in present and im not in deferred)
     # Move files to the processed folder
-    for im_id in range(len(images)):
-        # Replace the data folder in image path with processed
-        processed_path = images[im_id].replace(arg.data_path.stem, f'{arg.processed_path.stem}/Not_analyzed')
-        # Move the file
-        move_file(images[im_id], processed_path)
+    move_not_analyzed(images, arg)
         
     # Check for empty directories in data path
     remove_empty_dir(arg.data_path)
+    # Compressions finished in this process, the rest go on in the background (see archive.py)
+    wait_archive(block=False)
+    # Processed files recorded in this process, and moved in the background with --relocate
+    flush_manifest(arg)
+    relocate(arg)
 
 
-def detect_t2_t3_tests(dcm_image, res_images):
+def job_scheduler(arg):
     """
-    Finds open-beam and MLC images for T2 and T3. 
-    Sets custom ROI properties for Halcyon.
-
-    Assumptions:
-    T2: RT image label = 'MV_243'
-    T3: RT image label = 'MV_32' (MV_190 open and MV_40 MLC with Halcyon)
-    Open beam images have the "Curve label" -tag (= 'Field Edge (Open' or 'CIAO (OpenBeam)' with Halcyon)
-    Halcyon T2DR: Exposure < 100 MU
-    Halcyon T2GS: Jaw position = -140 mm
+    Priority scheduler from the input arguments (priorities, priority_aging_s).
+    The waiting times are saved next to the log file.
+    """
+    log_path = getattr(arg, 'log_path', None)
+    return PriorityScheduler(parse_priorities(getattr(arg, 'priorities', None)),
+                             aging_s=getattr(arg, 'priority_aging_s', PRIORITY_AGING_S),
+                             wait_log=None if log_path is None else Path(log_path).parent / 'job_waits.csv')
 
 
+def analyze_claimed(arg, lease_path, worker=None):
+    """
+    Analyses the groups of the data folder that are not claimed by other workers.
+    Several workers can run against the same data folder (see leases.py).
+    
     Parameters
     ----------
-    dcm_image : TYPE
-        DESCRIPTION.
-    res_images : TYPE
-        DESCRIPTION.
+    arg : TYPE
+        Input arguments.
+    lease_path : Path
+        Shared folder for the lease files.
+    worker : str, optional
+        Name of this worker. The default is None (host and process).
 
     Returns
     -------
-    res_images : TYPE
-        DESCRIPTION.
+    analysed : int
+        Number of groups analysed by this worker.
 
     """
-    # Check if RT image label exists in Dicom metadata
-    if (0x3002, 0x0002) in dcm_image.metadata:
-        rt_label = dcm_image.metadata[0x3002, 0x0002].value
-    else:
-        return res_images
-
-    # T2 open beam
-    if 'MV_243' in rt_label and (0x5000, 0x2500) in dcm_image.metadata:
-        # Halcyon DR image has ~60MU exposure
-        exposure = float(dcm_image.metadata[0x3002, 0x0030].value[0].MetersetExposure)
-        if exposure < 100:
-            res_images['t2_dr_open'] = dcm_image
-        else:
-            res_images['t2_open'] = dcm_image
-    # T2 MLC
-    elif 'MV_243' in rt_label and not (0x5000, 0x2500) in dcm_image.metadata:
-        # Halcyon DR image has ~60MU exposure
-        exposure = float(dcm_image.metadata[0x3002, 0x0030].value[0].MetersetExposure)
-        if exposure < 100:
-            res_images['t2_dr_mlc'] = dcm_image
-            # Custom ROI for Halcyon T2DR  
-            res_images['t2_dr_roi'] = T2_DR_ROI_HAL
-        else:
-            res_images['t2_mlc'] = dcm_image
-            
-            # Halcyon T2 tests have 14cm x 14cm collimation
-            jaw_pos = int(dcm_image.metadata[0x3002, 0x0030].value[0][0x300a, 0x00b6].value[0].LeafJawPositions[0])
-            # Custom ROI for Halcyon T2GS
-            if jaw_pos == -140: 
-                res_images['t2_gs_roi'] = T2_GS_ROI_HAL
-    # T3 Open beam
-    elif ('MV_32' in rt_label or 'MV_190' in rt_label) and (0x5000, 0x2500) in dcm_image.metadata:
-        res_images['t3_open'] = dcm_image
-        
-        # Custom ROI for Halcyon T3MLC
-        if 'MV_190' in rt_label:                                                     
-            res_images['t3_roi'] = T3_MLC_ROI_HAL
-    # T3 MLC
-    elif ('MV_32' in rt_label or 'MV_40' in rt_label) and not (0x5000, 0x2500) in dcm_image.metadata:
-        res_images['t3_mlc'] = dcm_image
-
-    return res_images
-
-def detect_catphan_tests(dcm_image, res_images):
-
-    # Modality should be CT
-    modality = dcm_image.metadata[0x0008, 0x0060].value
+    # Analysis logger
+    logger_a = logging.getLogger('qa.analysis')
     
-    # The orientation should be head first supine
-    if dcm_image.metadata[0x0018, 0x5100].value == 'FFS':
-        # Invert Z-axis, and change to HFS
-        dcm_image.metadata[0x0018, 0x5100].value = 'HFS'
-        dcm_image.metadata[0x0020, 0x0032].value[2] = str(-float(dcm_image.metadata[0x0020, 0x0032].value[2]))
-        # Save inverted image
-        dcm_image.save(dcm_image.path)
+    # List dicom files in data path and group them
+    images = unprocessed(list_images(arg.data_path, arg.file_types), arg)
+    groups = group_headers(images)
     
-    # Linac CBCT
-    if modality == 'CT' and (0x0008, 0x114a) in dcm_image.metadata:
-        
-        # For Linac CBCT, SOP UID should be RT Plan storage
-        ref_inst = 'RT Plan or RT Ion Plan or Radiation Set to be verified'
-        catphan_test1 = dcm_image.metadata[0x0008, 0x114a].value[0][0x0008, 0x1150].repval == 'RT Plan Storage'
-        catphan_test2 = dcm_image.metadata[0x0008, 0x114a].value[0][0x0040, 0xa170].value[0][0x0008, 0x0104].value == ref_inst
-        
-        if catphan_test1 or catphan_test2:
-            
+    # Groups are tried in random order, so that the workers do not compete for the same leases
+    keys = list(groups)
+    random.shuffle(keys)
+    
+    analysed = 0
+    for date, patient in keys:
+        lease = Lease(lease_path, group_key(date, patient), worker, ttl=arg.lease_ttl)
+        if not lease.claim():
+            continue
+        with hold(lease):
+            # Files may have been analysed by another worker after listing
+            paths = unprocessed([path for path in groups[date, patient] if os.path.isfile(path)], arg)
+            if len(paths) == 0:
+                continue
+            logger_a.info(f'Worker {lease.worker} analysing patient {patient}, date {date}')
+            # Deferred groups are left in the data folder for the next run
+            if isinstance(analyze_files(paths, arg, date, patient), Invalid):
+                continue
             
-            # Save the analysis image if does not exist already
-            if not 'catphan_linac' in res_images:
-                res_images['catphan_linac'] = dcm_image
+            # Move the files of the group that were not analysed
+            move_not_analyzed(unprocessed([path for path in paths if os.path.isfile(path)], arg), arg)
+        analysed += 1
     
-    # Diagnostic CT
-    elif modality == 'CT' and (0x0008, 0x1140) in dcm_image.metadata and not 'catphan' in res_images:
-        # For diagnostic CT, SOP UID [0x0008, 0x1140][0x0008, 0x1150] should be CT Image Storage
-        if dcm_image.metadata[0x0008, 0x1140].value[0][0x0008, 0x1150].repval == 'CT Image Storage':
-            res_images['catphan'] = dcm_image
-    # Linac images (e.g. Winston-Lutz)
-    elif modality == 'RTIMAGE':
-        pass
-        
-    return res_images
+    # Files that are not in any group (e.g. other file types), except recent and readable files
+    grouped = set(images)
+    ungrouped = [path for path in unprocessed(glob(str(arg.data_path / '**/*.*'), recursive=True), arg)
+                 if path not in grouped and time() - os.path.getmtime(path) > arg.wait_time]
+    readable = {path for paths in group_headers(ungrouped).values() for path in paths}
+    ungrouped = [path for path in ungrouped if path not in readable]
+    if len(ungrouped) > 0:
+        lease = Lease(lease_path, 'ungrouped', worker, ttl=arg.lease_ttl)
+        if lease.claim():
+            with hold(lease):
+                move_not_analyzed(sorted(path for path in ungrouped if os.path.isfile(path)), arg)
+    
+    # Check for empty directories in data path
+    remove_empty_dir(arg.data_path)
+    # Processed files moved in the background with --relocate (see manifest.py)
+    flush_manifest(arg)
+    relocate(arg)
+    
+    return analysed
 
 
-def detect_acr_tests(dcm_image, res_images, args):
+def move_not_analyzed(images, arg):
     """
-    Saves the first MR image found to given dict.
-    Assumes that MR images are from ACR phantom 
-    and that the images from same series are in one folder.
+    Moves files from the data folder to the Not_analyzed folder in the processed folder.
+    In manifest mode, the files are left in place and recorded as not analysed (see manifest.py).
 
     Parameters
     ----------
-    dcm_image : LinacDicomImage
-        DESCRIPTION.
-    res_images : dict
-        DESCRIPTION.
-    args : TYPE
-        Input arguments.
+    images : list
+        Files to be moved.
+    arg : TYPE
+        Input arguments (data_path and processed_path).
 
     Returns
     -------
-    res_images : dict
-        DESCRIPTION.
+    None.
 
     """
+    for im in images:
+        if use_manifest(arg):
+            record(im, arg, NOT_ANALYZED)
+            continue
+        # Replace the data folder in image path with processed
+        processed_path = im.replace(arg.data_path.stem, f'{arg.processed_path.stem}/Not_analyzed')
+        # Move the file
+        move_file(im, processed_path)
 
-    # Modality should be MRI
-    modality = dcm_image.metadata[0x0008, 0x0060].value    
-    if modality == 'MR' and not 'acr' in res_images:
-        # Update field strength to Dicom metadata
-        dcm_image.metadata.MagneticFieldStrength = args.field_strength
-        # Save the image with new metadata
-        dcm_image.save(dcm_image.path)
-        
-        res_images['acr'] = dcm_image
-    # Catphan image from same series
-    elif modality == 'MR' and dirname(dcm_image.path) == dirname(res_images['acr'].path):
-        pass
-    # Linac images (e.g. Winston-Lutz)
-    elif modality == 'RTIMAGE':
-        pass
-        
-    return res_images
 
+def list_images(path, file_types, exclude=()):
+    """
+    Lists the files of given types recursively in a folder.
 
-def detect_winston_tests(dcm_image, res_images):
+    Parameters
+    ----------
+    path : Path
+        Folder to be searched.
+    file_types : tuple
+        File extensions included in the list (e.g. '.dcm').
+    exclude : tuple, optional
+        Names of subfolders that are skipped. The default is ().
 
-    # Patient name could be added as a filter    
+    Returns
+    -------
+    images : list
+        Sorted list of file paths.
 
-    # Modality should be RTIMAGE
-    modality = dcm_image.metadata[0x0008, 0x0060].value    
-    if modality == 'RTIMAGE' and not 'winston' in res_images:
-        res_images['winston'] = dcm_image
-    # Winston-Lutz image from same series
-    elif modality == 'RTIMAGE' and dirname(dcm_image.path) == dirname(res_images['winston'].path):
-        pass
-        
-    return res_images
+    """
+    images = []
+    for file_type in file_types:
+        images += glob(str(path / f'**/*{file_type}'), recursive=True)
 
+    # Skip excluded subfolders (e.g. Not_analyzed in the processed folder)
+    if len(exclude) > 0:
+        images = [im for im in images
+                  if not set(Path(im).relative_to(path).parts[:-1]) & set(exclude)]
+    images.sort()
 
-def run_t2_t3_tests(test, args):   
-    res = []
-    
-    # Dose-rate & gantry speed test (T2)
-    t2 = drgs_test(test['t2_mlc'], test['t2_open'], tol=DRGS_TOL, 
-              savepath=args.save_path, pdf=args.pdf, plot=args.plot,
-              segment_size=test['t2_gs_segment_size'], roi=test['t2_gs_roi'])
-    res.append(t2)
-    
-    # mlc speed test (T3)
-    t3 = drmlc_test(test['t3_mlc'], test['t3_open'], tol=DRMLC_TOL, 
-              savepath=args.save_path, pdf=args.pdf, plot=args.plot,
-              segment_size=test['t3_segment_size'], roi=test['t3_roi'])
-    res.append(t3)
-    
-    # Dose rate test for Halcyon
-    if 't2_dr_open' and 't2_dr_mlc' in test:
-        t2_dr = drgs_test(test['t2_dr_mlc'], test['t2_dr_open'], tol=DRGS_TOL, 
-                  savepath=args.save_path, pdf=args.pdf, plot=args.plot,
-                  segment_size=test['t2_dr_segment_size'], roi=test['t2_dr_roi'])
-        res.append(t2_dr)
+    return images
+
+
+def group_headers(images):
+    """
+    Groups files by measurement date and patient. 
+    Reads only the Series date and Patient ID tags from the DICOM headers.
+
+    Parameters
+    ----------
+    images : list
+        File paths.
+
+    Returns
+    -------
+    groups : dict
+        File paths for each (Series date, Patient ID), sorted by date.
+
+    """
+    # Analysis logger
+    logger_a = logging.getLogger('qa.analysis')
     
-    # Save results as a row in Excel file
-    save_excel(test['t2_mlc'], res, save_path=args.save_path, test='T2-T3')
+    groups = {}
+    for path in images:
+        try:
+            ds = pydicom.dcmread(path, stop_before_pixels=True, 
+                                 specific_tags=[(0x0008, 0x0021), (0x0010, 0x0020)])
+            key = (ds[0x0008, 0x0021].value, ds[0x0010, 0x0020].value)
+        except (InvalidDicomError, KeyError, OSError) as e:
+            logger_a.debug(f'Cannot read header of {path} due to error {e}')
+            continue
+        groups.setdefault(key, []).append(path)
     
-    # Move analyzed files to the processed folder, create subfolder by modality
-    modality = 'T2-T3'
-    # Assume that there is one folder for patient name/ID
-    parent_folder = Path(test['t2_mlc'].path).parent.parent.stem  
-    # Possible test images
-    t2t3_images = ['t2_mlc', 't2_open', 't3_mlc', 't3_open', 't2_dr_mlc', 't2_dr_open']
-    for key, im in test.items():
-        if key in t2t3_images:            
-            # Replace the data folder in image path with processed
-            if parent_folder == modality:
-                processed_path = im.path.replace(args.data_path.stem, f'{args.processed_path.stem}' )
-            else:
-                processed_path = im.path.replace(args.data_path.stem, f'{args.processed_path.stem}/{modality}' )
-            # Move the file
-            move_file(im.path, processed_path)
+    return dict(sorted(groups.items()))
+
 
+def analyze_files(paths, arg, date, patient):
+    """
+    Reads the headers of one patient in one measurement date and runs the tests.
+    Only the tags used for detecting the tests are read (see detectors.py).
+
+    Parameters
+    ----------
+    paths : list
+        Files of the patient in the measurement date.
+    arg : TYPE
+        Input arguments.
+    date : str
+        Series date of the images.
+    patient : str
+        Patient ID (device name) of the images.
+
+    Returns
+    -------
+    results : dict, Invalid or None
+        Results of the test that was run. Invalid if the group was deferred
+        (see validation.py), None if no test was found or the group was rejected.
+
+    """
+    results = analyze_group(read_headers(paths), arg, date, patient)
+    # The group is done when its processed files are recorded (see manifest.py),
+    # the compressions are reported when finished (see archive.py)
+    flush_manifest(arg)
+    wait_archive(block=False)
+    return results
+
+
+def read_headers(paths):
+    """
+    Headers of the files with the tags used for detecting the tests (see detectors.py).
+    Files that are not readable dicom files are left out.
+    """
+    # Analysis logger
+    logger_a = logging.getLogger('qa.analysis')
     
-        
+    headers = []
+    for path in paths:
+        try:
+            headers.append(DicomHeader(path, required_tags()))
+        except (InvalidDicomError, OSError) as e:
+            logger_a.debug(f'Cannot read header of {path} due to error {e}')
+    return headers
+
+
+def prefetch_group(paths):
+    """
+    Prefetch stage of the pipeline: reads the files of a group to the file cache
+    and returns their headers (see pipeline.py).
+    """
+    read_ahead(paths)
+    return read_headers(paths)
+
+
+def analyze_group(headers, arg, date, patient):
+    """
+    Detects and runs the tests for images of one patient in one measurement date.
+    The test types are registered in detectors.py.
+
+    Parameters
+    ----------
+    headers : list
+        DicomHeaders of the patient in the measurement date.
+    arg : TYPE
+        Input arguments.
+    date : str
+        Series date of the images.
+    patient : str
+        Patient ID (device name) of the images.
+
+    Returns
+    -------
+    results : dict, Invalid or None
+        Results of the test that was run. Invalid if the group was deferred
+        (see validation.py), None if no test was found or the group was rejected.
+
+    """
+    # Analysis logger
+    logger_a = logging.getLogger('qa.analysis')
+
+    # Pdf reports are saved by default for Catphan, ACR and Winston-Lutz
+    pdf = getattr(arg, 'report_pdf', True)
+
+    results = None
+    try:
+        # Find the relevant images for each test in one pass
+        test_images = classify_headers(headers, arg)
+
+        # Fast checks before the analysis (see validation.py)
+        invalid = validate_detected(test_images, headers, arg)
+        if invalid is not None and invalid.action == 'defer':
+            logger_a.info(f'Deferred patient {patient}, date {date}: {invalid.reason}')
+            # Images that have arrived are analysed while waiting (see streaming.py)
+            stream_detected(test_images, headers, arg)
+            return invalid
+        if invalid is not None:
+            logger_a.info(f'Rejected patient {patient}, date {date}: {invalid.reason}')
+            return None
+
+        # Run the first test type found
+        results = run_detected(test_images, arg, pdf=pdf)
+        if results is None:
+            logger_a.info(f'Test not implemented for patient {patient}, date {date}')
+
+    # Missing dictionary data raises KeyError
+    # ValueError when running Winston analysis with incorrect images
+    except (KeyError, ValueError, ZeroDivisionError) as e:
+        logger_a.debug(f'Cannot analyse from measurement date {date} due to error {e}')
+
+    return results
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Lossless compression of the processed images.
+
+The analysed files are moved to the processed folder as before (move_processed),
+and then re-encoded in place in a background thread pool, so the analysis does
+not wait for the compression. The file names and the folder layout are kept.
+    deflate     Deflated Explicit VR Little Endian, the whole dataset is compressed (any DICOM file)
+    rle         RLE Lossless, the pixel data is compressed (uncompressed images only)
+
+Both transfer syntaxes are read by pydicom, so the archive is read as before,
+e.g. by backfill runs (main_backfill.py). Files that are already compressed or
+are not DICOM are left as they are. The analysis does not wait for the compression:
+the finished compressions are reported after each group and run, and the rest are
+waited for when the process exits (wait_archive).
+"""
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# Background pool of this process, and the compressions not yet reported (see archive)
+_archive_pool = None
+_archive_futures = []
+
+
+def compress_file(path, method):
+    """
+    Re-encodes a DICOM file in place with a lossless transfer syntax.
+
+    Parameters
+    ----------
+    path : str
+        DICOM file in the processed folder.
+    method : str
+        'deflate' or 'rle'.
+
+    Returns
+    -------
+    before : int
+        File size (bytes) before the compression.
+    after : int
+        File size (bytes) after the compression, before if the file was left as it is.
+
+    """
+    import pydicom
+    from pydicom.errors import InvalidDicomError
+    from pydicom.uid import (ImplicitVRLittleEndian, ExplicitVRLittleEndian,
+                             DeflatedExplicitVRLittleEndian, RLELossless)
+
+    # Utility logger
+    logger_u = logging.getLogger('qa.utilities')
+
+    before = os.path.getsize(path)
+    try:
+        ds = pydicom.dcmread(path)
+    except (InvalidDicomError, OSError):
+        return before, before
+    syntax = ds.file_meta.get('TransferSyntaxUID', ImplicitVRLittleEndian)
+    if syntax not in (ImplicitVRLittleEndian, ExplicitVRLittleEndian):
+        return before, before
+
+    stat = os.stat(path)
+    temp = f'{path}.tmp'
+    try:
+        if method == 'rle':
+            if 'PixelData' not in ds:
+                return before, before
+            ds.compress(RLELossless)
+        else:
+            ds.file_meta.TransferSyntaxUID = DeflatedExplicitVRLittleEndian
+            ds.is_implicit_VR = False
+            ds.is_little_endian = True
+        ds.save_as(temp, write_like_original=False)
+        after = os.path.getsize(temp)
+        if after >= before:
+            os.remove(temp)
+            return before, before
+        os.replace(temp, path)
+        # Modification time of the measurement is kept (e.g. for backfill scheduling)
+        os.utime(path, (stat.st_atime, stat.st_mtime))
+    except (ValueError, NotImplementedError, OSError) as e:
+        logger_u.debug(f'{path} not compressed due to error {e}')
+        if os.path.isfile(temp):
+            os.remove(temp)
+        return before, before
+    return before, after
+
+
+def archive(path, method, workers=1):
+    """
+    Compresses a processed file in the background pool (see compress_file).
+    The pool is started on first use.
+    """
+    global _archive_pool
+
+    if _archive_pool is None:
+        _archive_pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='qa-archive')
+    _archive_futures.append(_archive_pool.submit(compress_file, path, method))
+
+
+def wait_archive(block=True):
+    """
+    Waits for the compressions started in this process and logs the bytes saved.
+
+    Parameters
+    ----------
+    block : bool, optional
+        Wait for the running compressions. False reports only the finished ones,
+        e.g. after a run of the daemon. The default is True.
+
+    Returns
+    -------
+    before : int
+        Size (bytes) of the files before the compression.
+    after : int
+        Size (bytes) of the files after the compression.
+
+    """
+    # Utility logger
+    logger_u = logging.getLogger('qa.utilities')
+
+    before, after, compressed = 0, 0, 0
+    index = 0
+    while index < len(_archive_futures):
+        future = _archive_futures[index]
+        if not block and not future.done():
+            index += 1
+            continue
+        del _archive_futures[index]
+        try:
+            size, archived = future.result()
+        except Exception as e:
+            logger_u.debug(f'Archive compression failed due to error {e}')
+            continue
+        before += size
+        after += archived
+        compressed += archived < size
+
+    if before > 0:
+        logger_u.info(f'Archive: {compressed} files compressed, {before / 2 ** 20:.1f} MB to {after / 2 ** 20:.1f} MB '
+                      f'({(before - after) / 2 ** 20:.1f} MB, {(before - after) / before:.0%} saved)')
+    return before, after
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+Array store for the detailed results of the analyses.
+
+The results Excel keeps a few values per test. The full results (VMAT segment
+values, MTF curves, HU ROI statistics and Winston-Lutz BB offsets per image)
+are saved in the results folder as .npy files, which can be memory-mapped:
+
+    Arrays/<machine>/<test>/<field>.npy          rows of all measurements
+    Arrays/<machine>/<test>/<field>.ends.npy     end row of each measurement
+    Arrays/<machine>/<test>/<field>.times.npy    series date and time of each measurement
+
+New measurements are appended to the files. The times are written last,
+so readers only see complete measurements.
+
+Example, mean HU difference of the linearity inserts in each measurement:
+    times, values, ends = load_arrays(save_path, 'CT1', 'Catphan', 'hu_rois', start='2024-01-01')
+    rows = measurement_rows(ends)
+    mean_difference = np.bincount(rows, weights=values[:, 3]) / np.bincount(rows)
+"""
+import io
+import os
+import re
+import logging
+
+import numpy as np
+
+from qa_analysis.utilities import file_lock
+
+# Folder of the array store in the results folder
+ARRAY_FOLDER = 'Arrays'
+
+# Columns of the stored fields
+SEGMENT_COLUMNS = ('x_position_mm', 'r_corr', 'r_dev', 'stdev')
+MTF_COLUMNS = ('lp_mm', 'mtf')
+ROI_COLUMNS = ('nominal_value', 'value', 'stdev', 'difference')
+BB_COLUMNS = ('cax2bb_x', 'cax2bb_y', 'cax2epid_x', 'cax2epid_y')
+THICKNESS_COLUMNS = ('measured_mm', 'nominal_mm')
+
+
+def t2_t3_arrays(res):
+    """
+    Segment values of the T2, T3 and Halcyon T2DR tests (rows: segments, columns: SEGMENT_COLUMNS).
+    """
+    names = ['t2_segments', 't3_segments', 't2_dr_segments']
+    return {name: np.array([[segment[column] for column in SEGMENT_COLUMNS] for segment in test['segment_data']])
+            for name, test in zip(names, res)}
+
+
+def catphan_arrays(res):
+    """
+    MTF curve (MTF_COLUMNS), and HU and uniformity ROI statistics (ROI_COLUMNS) of a Catphan analysis.
+    The line distances, slice thickness (THICKNESS_COLUMNS), low-contrast ROIs seen and the
+    tolerance set are saved for re-evaluating the pass/fail results (verdicts.py).
+    """
+    hu_rois = res['ctp404']['hu_rois']
+    uniformity_rois = res['ctp486']['rois']
+    return {
+        'mtf': np.array(list(res['mtf'].items()), dtype=float),
+        'hu_rois': np.array([[roi[column] for column in ROI_COLUMNS] for roi in hu_rois.values()]),
+        'hu_roi_names': np.array(list(hu_rois), dtype='<U32'),
+        'uniformity_rois': np.array([[roi[column] for column in ROI_COLUMNS] for roi in uniformity_rois.values()]),
+        'uniformity_roi_names': np.array(list(uniformity_rois), dtype='<U32'),
+        'line_distances': np.array(res['ctp404']['line_distances_mm'], dtype=float),
+        'slice_thickness': np.array([[res['ctp404']['measured_slice_thickness_mm'],
+                                      res['ctp404'].get('nominal_slice_thickness_mm', np.nan)]]),
+        'low_contrast_rois_seen': np.array([res['ctp515']['num_rois_seen']], dtype=float),
+        'tolerance_set': np.array([res.get('tolerance_set', '')], dtype='<U32'),
+        }
+
+
+def winston_arrays(res):
+    """
+    BB and EPID offsets from the field centre of each Winston-Lutz image (BB_COLUMNS).
+    """
+    images = res['keyed_image_details']
+    return {
+        'bb_offsets': np.array([[image['cax2bb_vector']['x'], image['cax2bb_vector']['y'],
+                                 image['cax2epid_vector']['x'], image['cax2epid_vector']['y']]
+                                for image in images.values()]),
+        'image_keys': np.array(list(images), dtype='<U32'),
+        }
+
+
+def catphan_quick_arrays(res):
+    """
+    HU ROI statistics, line distances, slice thickness and tolerance set of a quick
+    Catphan analysis (HU linearity module only), as in catphan_arrays.
+    """
+    return {
+        'hu_rois': np.array([[roi[column] for column in ROI_COLUMNS] for roi in res['ctp404']['hu_rois'].values()]),
+        'hu_roi_names': np.array(list(res['ctp404']['hu_rois']), dtype='<U32'),
+        'line_distances': np.array(res['ctp404']['line_distances_mm'], dtype=float),
+        'slice_thickness': np.array([[res['ctp404']['measured_slice_thickness_mm'],
+                                      res['ctp404'].get('nominal_slice_thickness_mm', np.nan)]]),
+        'tolerance_set': np.array([res.get('tolerance_set', '')], dtype='<U32'),
+        }
+
+
+def measurement_time(dicom_im):
+    """
+    Series date and time of an image (numpy.datetime64), the time of a measurement in the store.
+    """
+    date = dicom_im.metadata[0x0008, 0x0021].value
+    time = dicom_im.metadata[0x0008, 0x0031].value
+    return np.datetime64(f'{date[:4]}-{date[4:6]}-{date[6:8]}T{time[:2]}:{time[2:4]}:{time[4:6]}', 's')
+
+
+def store_path(save_path, machine, test):
+    """
+    Folder of the arrays of a test for one machine.
+    """
+    return os.path.join(save_path, ARRAY_FOLDER, re.sub(r'[^A-Za-z0-9_.-]', '_', str(machine)), test)
+
+
+def save_arrays(dicom_im, arrays, save_path, test):
+    """
+    Appends the arrays of one measurement to the array store.
+    Measurements that are already saved (same series date and time) are skipped.
+
+    Parameters
+    ----------
+    dicom_im : TYPE
+        Dicom image analyzed (for extracting the machine, date and time).
+    arrays : dict
+        Arrays of the measurement by field name (rows of values).
+    save_path : Path
+        Results folder.
+    test : str
+        QA test (e.g. 'Catphan').
+
+    Returns
+    -------
+    saved : bool
+        True if the measurement was added to the store.
+
+    """
+    # Utility logger
+    logger_u = logging.getLogger('qa.utilities')
+
+    date = dicom_im.metadata[0x0008, 0x0021].value
+    patient = dicom_im.metadata[0x0010, 0x0020].value
+    measured = measurement_time(dicom_im)
+
+    folder = store_path(save_path, patient, test)
+    os.makedirs(folder, exist_ok=True)
+
+    # Parallel runs may save the same machine and test
+    saved = False
+    with file_lock(os.path.join(folder, 'store')) as locked:
+        if not locked:
+            logger_u.info(f'Arrays of patient {patient}, date {date}, test {test} not saved (store locked).')
+            return saved
+        for field, values in arrays.items():
+            values = np.asarray(values)
+            values = values.astype('<U32' if values.dtype.kind == 'U' else float)
+            base = os.path.join(folder, field)
+
+            # Skip measurements already saved
+            times = read_npy(f'{base}.times.npy')
+            if times is not None and measured in times:
+                continue
+            ends = read_npy(f'{base}.ends.npy')
+            # Rows of a failed write (no time saved) are overwritten
+            n = 0 if times is None else len(times)
+            end = 0 if n == 0 else int(ends[n - 1])
+
+            # The analysis is not stopped if saving fails
+            try:
+                append_npy(f'{base}.npy', values, start=end)
+                append_npy(f'{base}.ends.npy', np.array([end + len(values)], dtype=np.int64), start=n)
+                append_npy(f'{base}.times.npy', np.array([measured]), start=n)
+                saved = True
+            except (OSError, ValueError) as e:
+                logger_u.info(f'Arrays {field} of patient {patient}, date {date}, test {test} not saved due to error {e}')
+    return saved
+
+
+def load_arrays(save_path, machine, test, field, start=None, end=None, mmap_mode='r'):
+    """
+    Reads a field of the array store.
+
+    Parameters
+    ----------
+    save_path : Path
+        Results folder.
+    machine : str
+        Patient ID (device name).
+    test : str
+        QA test (e.g. 'Catphan').
+    field : str
+        Field name (e.g. 'mtf').
+    start : str or numpy.datetime64, optional
+        First series date included (e.g. '2024-01-01'). The default is None.
+    end : str or numpy.datetime64, optional
+        Last series date included. The default is None.
+    mmap_mode : str, optional
+        Memory-map the files (see numpy.load). The default is 'r'.
+
+    Returns
+    -------
+    times : numpy.ndarray
+        Series date and time of each measurement (datetime64).
+    values : numpy.ndarray
+        Rows of all measurements.
+    ends : numpy.ndarray
+        End row of each measurement in values.
+
+    """
+    base = os.path.join(store_path(save_path, machine, test), field)
+    times = read_npy(f'{base}.times.npy', mmap_mode)
+    if times is None:
+        return np.array([], dtype='datetime64[s]'), np.array([]), np.array([], dtype=np.int64)
+    # Measurements written completely
+    ends = read_npy(f'{base}.ends.npy', mmap_mode)[:len(times)]
+    values = read_npy(f'{base}.npy', mmap_mode)[:ends[-1] if len(ends) > 0 else 0]
+
+    if start is None and end is None:
+        return times, values, ends
+
+    # Select the measurements in the date range
+    dates = times.astype('datetime64[D]')
+    keep = np.ones(len(times), dtype=bool)
+    if start is not None:
+        keep &= dates >= np.datetime64(start, 'D')
+    if end is not None:
+        keep &= dates <= np.datetime64(end, 'D')
+    counts = np.diff(ends, prepend=0)
+    return times[keep], values[np.repeat(keep, counts)], np.cumsum(counts[keep])
+
+
+def measurement_rows(ends):
+    """
+    Index of the measurement of each row, e.g. for np.bincount or grouping rows.
+    """
+    return np.repeat(np.arange(len(ends)), np.diff(ends, prepend=0))
+
+
+def read_npy(path, mmap_mode=None):
+    """
+    Reads a .npy file, None if the file does not exist.
+    """
+    if not os.path.isfile(path):
+        return None
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+def append_npy(path, rows, start=None):
+    """
+    Appends rows to a .npy file, creating the file if needed.
+    The data is written before the header (shape), so readers see only complete rows.
+
+    Parameters
+    ----------
+    path : str
+        File.
+    rows : numpy.ndarray
+        Rows to add.
+    start : int, optional
+        Row where the new rows are written (overwrites later rows). The default is None (end).
+
+    Returns
+    -------
+    None.
+
+    """
+    rows = np.ascontiguousarray(rows)
+    if not os.path.isfile(path):
+        np.save(path, rows)
+        return
+
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        read_header, write_header = {
+            (1, 0): (np.lib.format.read_array_header_1_0, np.lib.format.write_array_header_1_0),
+            }.get(version, (np.lib.format.read_array_header_2_0, np.lib.format.write_array_header_2_0))
+        shape, fortran_order, dtype = read_header(f)
+        header_size = f.tell()
+        if len(rows) == 0:
+            return
+        # Empty file or all rows overwritten
+        if start == 0 or shape[0] == 0:
+            f.close()
+            np.save(path, rows)
+            return
+        if dtype != rows.dtype or tuple(shape[1:]) != rows.shape[1:] or fortran_order:
+            raise ValueError(f'Cannot append {rows.dtype} {rows.shape} to {dtype} {shape} in {path}')
+
+        # Header with the new shape
+        start = shape[0] if start is None else min(start, shape[0])
+        header = io.BytesIO()
+        write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                              'shape': (start + len(rows),) + tuple(shape[1:])})
+
+        # The header is padded for growing files (numpy >= 1.23), otherwise the file is rewritten
+        if len(header.getvalue()) != header_size:
+            f.close()
+            existing = np.load(path)[:start]
+            np.save(f'{path}.tmp.npy', np.concatenate([existing, rows]))
+            os.replace(f'{path}.tmp.npy', path)
+            return
+
+        row_size = dtype.itemsize * int(np.prod(shape[1:], dtype=np.int64))
+        f.seek(header_size + start * row_size)
+        f.write(rows.tobytes())
+        # Rows of a failed write are removed
+        if start < shape[0]:
+            f.truncate()
+        f.seek(0)
+        f.write(header.getvalue())
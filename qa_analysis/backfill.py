@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Backfill of archived QA measurements.
+
+Re-runs the analyses for images stored in the processed folder, e.g. after
+a tolerance change or a Pylinac upgrade. Files are not moved or modified and
+the results are saved to a separate results folder.
+Analysed groups are recorded so that an interrupted run can be resumed.
+"""
+import os
+import json
+import logging
+from tqdm import tqdm
+
+from qa_analysis.analysis import list_images, group_headers, analyze_files
+from qa_analysis.workers import start_pool
+from qa_analysis.admission import estimate_memory, memory_budget, run_admitted
+
+
+def run_backfill(arg):
+    """
+    Analyses the (date, patient) groups of an archive folder in parallel.
+
+    Parameters
+    ----------
+    arg : TYPE
+        Input arguments.
+
+    Returns
+    -------
+    None.
+
+    """
+    # Analysis logger
+    logger_a = logging.getLogger('qa.analysis')
+
+    # Archive is read only, pdf reports only if asked for
+    arg.read_only = True
+    arg.move_files = False
+    arg.report_pdf = arg.pdf
+    arg.save_path.mkdir(parents=True, exist_ok=True)
+
+    # Rebuild the measurement groups from DICOM headers
+    images = list_images(arg.archive_path, arg.file_types, exclude=arg.exclude)
+    groups = group_headers(images)
+
+    # Skip groups analysed in a previous run
+    state_path = arg.save_path / 'backfill_state.jsonl'
+    analysed = read_backfill_state(state_path, retry_failed=arg.retry_failed)
+    pending = [key for key in groups if key not in analysed]
+    logger_a.info(f'Backfill: {len(groups)} groups found in {arg.archive_path}, '
+                  f'{len(groups) - len(pending)} already analysed.')
+    if len(pending) == 0:
+        return
+
+    pool = start_pool(arg.workers, arg.log_path)
+    try:
+        # Groups start while their estimated memory fits in the budget
+        jobs = [(key, estimate_memory(groups[key]), analyze_files, (groups[key], arg, *key)) for key in pending]
+        finished = run_admitted(pool, jobs, memory_budget(arg.memory_budget_mb), workers=arg.workers)
+
+        # Progress and ETA over finished groups
+        for (date, patient), future in tqdm(finished, total=len(jobs), desc='Backfill', unit='group'):
+            try:
+                status = 'done' if future.result() is not None else 'skipped'
+            except Exception as e:
+                logger_a.debug(f'Backfill failed for patient {patient}, date {date} due to error {e}')
+                status = 'failed'
+            write_backfill_state(state_path, date, patient, status)
+    except KeyboardInterrupt:
+        # Finished groups are already recorded, the rest is run on resume
+        logger_a.info('Backfill interrupted. Rerun with the same save_path to resume.')
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
+
+
+def read_backfill_state(state_path, retry_failed=False):
+    """
+    Reads the groups recorded in a backfill state file.
+
+    Parameters
+    ----------
+    state_path : Path
+        State file (json lines).
+    retry_failed : bool, optional
+        Leave failed and skipped groups out, so that they are run again.
+        The default is False.
+
+    Returns
+    -------
+    analysed : set
+        (date, patient) keys of recorded groups.
+
+    """
+    analysed = set()
+    if not os.path.isfile(state_path):
+        return analysed
+
+    with open(state_path, 'r') as f:
+        for line in f:
+            # Last line can be incomplete after a crash
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if retry_failed and row['status'] != 'done':
+                continue
+            analysed.add((row['date'], row['patient']))
+    return analysed
+
+
+def write_backfill_state(state_path, date, patient, status):
+    """
+    Appends an analysed group to the backfill state file.
+
+    Parameters
+    ----------
+    state_path : Path
+        State file (json lines).
+    date : str
+        Series date.
+    patient : str
+        Patient ID.
+    status : str
+        'done', 'skipped' (no test found) or 'failed'.
+
+    Returns
+    -------
+    None.
+
+    """
+    with open(state_path, 'a') as f:
+        f.write(json.dumps({'date': date, 'patient': patient, 'status': status}) + '\n')
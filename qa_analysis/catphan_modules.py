@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel analysis of the Catphan modules.
+
+Pylinac analyses the CTP404, CTP486, CTP528 and CTP515 modules one after another
+after locating the phantom (CatPhanBase.analyze). Here the phantom is located in
+the current process, the decoded slices are copied once to shared memory, and
+each module is analysed in a process of the Catphan session pool (workers.py).
+The workers read the slices from shared memory, the pixel data is not sent to them.
+
+The analysed modules are set to the Catphan object, so that results_data(),
+the pdf report and the plots work as after cbct.analyze().
+"""
+import inspect
+import logging
+import functools
+from multiprocessing import shared_memory
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from pylinac.ct import CTP404CP504, CTP486, CTP528CP504, CTP515
+
+from qa_analysis.workers import session_pool, close_session_pool
+
+# Catphan modules: attribute, Pylinac base class, the module arguments from the
+# arguments of CatPhanBase.analyze, and the cached results that Pylinac computes
+# on first use (computed in the worker). The slowest module (CTP528 MTF) is started first.
+MODULES = {
+    'ctp528': (CTP528CP504, lambda a: dict(tolerance=None), ['mtf']),
+    'ctp404': (CTP404CP504, lambda a: dict(
+        hu_tolerance=a['hu_tolerance'], thickness_tolerance=a['thickness_tolerance'],
+        scaling_tolerance=a['scaling_tolerance'], thickness_slice_straddle=a['thickness_slice_straddle'],
+        expected_hu_values=a['expected_hu_values']), []),
+    'ctp515': (CTP515, lambda a: dict(
+        tolerance=a['low_contrast_tolerance'], cnr_threshold=a['cnr_threshold'],
+        contrast_method=a['contrast_method'], visibility_threshold=a['visibility_threshold']), []),
+    'ctp486': (CTP486, lambda a: dict(tolerance=a['hu_tolerance']), ['power_spectrum_1d']),
+    }
+
+
+class SharedSlice:
+    """
+    Slice of a SharedStack. The array is a read-only view of the shared memory,
+    the images kept by the analysed module are copied before closing it (own_arrays).
+    """
+
+    def __init__(self, volume, row):
+        self.volume = volume
+        self.row = row
+
+    @property
+    def array(self):
+        array = self.volume[self.row]
+        array.flags.writeable = False
+        return array
+
+
+class SharedStack:
+    """
+    Stack of the decoded slices in shared memory, with the header values used by
+    the Catphan modules. Slices that were not decoded cannot be read.
+
+    Parameters
+    ----------
+    volume : numpy.ndarray
+        Decoded slices (slice, row, column) in shared memory.
+    rows : dict
+        Row of the volume for each slice number.
+    metadata : pydicom.Dataset
+        Header of the first slice.
+    slice_spacing : float
+        Slice spacing (mm).
+
+    """
+
+    def __init__(self, volume, rows, metadata, slice_spacing):
+        self.volume = volume
+        self.rows = rows
+        self.metadata = metadata
+        self.slice_spacing = slice_spacing
+
+    def __getitem__(self, item):
+        if item not in self.rows:
+            raise IndexError(f'Slice {item} was not decoded')
+        return SharedSlice(self.volume, self.rows[item])
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def share_volume(stack):
+    """
+    Copies the decoded slices of a stack to shared memory.
+    The stack keeps its arrays for the results and plots after the analysis, so the
+    volume is in memory twice while the modules are analysed. The copy is small next
+    to the analysis (e.g. 0.5 s for 160 slices of 512 x 512, 335 MB, against 19 s for
+    cbct.analyze() with one core).
+
+    Parameters
+    ----------
+    stack : SparseDicomImageStack
+        Catphan stack (stacks.py).
+
+    Returns
+    -------
+    shm : SharedMemory
+        Shared memory of the volume. Closed and unlinked by the caller.
+    volume : dict
+        Name, shape, dtype and slice rows of the volume for attaching in the workers.
+
+    """
+    indices = stack.decoded if hasattr(stack, 'decoded') else range(len(stack))
+    first = stack[indices[0]].array
+    shape = (len(indices), *first.shape)
+    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * first.dtype.itemsize)
+    array = np.ndarray(shape, dtype=first.dtype, buffer=shm.buf)
+    for row, i in enumerate(indices):
+        array[row] = stack[i].array
+    del array
+    return shm, {'name': shm.name, 'shape': shape, 'dtype': first.dtype.str,
+                 'rows': {i: row for row, i in enumerate(indices)}}
+
+
+def attach(name):
+    """
+    Attaches to shared memory created in the main process.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13, forked workers share the resource tracker of the main process,
+        # which unlinks the memory
+        return shared_memory.SharedMemory(name=name)
+
+
+def own_arrays(obj, volume, seen=None):
+    """
+    Replaces the arrays of Pylinac objects that are views of the shared volume
+    (e.g. the image of a module slice) with copies, before the memory is closed.
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, dict):
+        values = list(obj.values())
+    elif isinstance(obj, (list, tuple)):
+        values = list(obj)
+    elif type(obj).__module__.startswith(('pylinac', 'qa_analysis')) and hasattr(obj, '__dict__'):
+        for key, value in list(vars(obj).items()):
+            if isinstance(value, np.ndarray) and np.may_share_memory(value, volume):
+                setattr(obj, key, np.array(value))
+        values = list(vars(obj).values())
+    else:
+        return
+    for value in values:
+        own_arrays(value, volume, seen)
+
+
+def drop_cached(obj, seen=None):
+    """
+    Removes the method caches of Pylinac objects (pylinac.core.decorators.lru_cache),
+    which cannot be pickled. The caches are created again on the next call.
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return
+    seen.add(id(obj))
+    if isinstance(obj, dict):
+        values = list(obj.values())
+    elif isinstance(obj, (list, tuple)):
+        values = list(obj)
+    elif type(obj).__module__.startswith(('pylinac', 'qa_analysis')) and hasattr(obj, '__dict__'):
+        for key, value in list(vars(obj).items()):
+            if isinstance(value, functools._lru_cache_wrapper):
+                delattr(obj, key)
+        values = list(vars(obj).values())
+    else:
+        return
+    for value in values:
+        drop_cached(value, seen)
+
+
+def analyze_module(model, name, state, volume, metadata, slice_spacing, arguments):
+    """
+    Analyses one Catphan module. Run in the Catphan session pool.
+
+    Parameters
+    ----------
+    model : type
+        Catphan model class (e.g. CustomCP504).
+    name : str
+        Module attribute (key of MODULES).
+    state : dict
+        Attributes of the located Catphan (origin slice, roll, phantom axis).
+    volume : dict
+        Shared volume (see share_volume).
+    metadata : pydicom.Dataset
+        Header of the first slice.
+    slice_spacing : float
+        Slice spacing (mm).
+    arguments : dict
+        Module arguments (see MODULES).
+
+    Returns
+    -------
+    module : CatPhanModule
+        Analysed module.
+
+    """
+    shm = attach(volume['name'])
+    try:
+        # Catphan object without loading the images
+        shared = np.ndarray(volume['shape'], dtype=volume['dtype'], buffer=shm.buf)
+        catphan = model.__new__(model)
+        catphan.__dict__.update(state)
+        catphan.dicom_stack = SharedStack(shared, volume['rows'], metadata, slice_spacing)
+        module, offset = catphan._get_module(MODULES[name][0], raise_empty=True)
+        result = module(catphan, offset=offset, clear_borders=catphan.clear_borders, **arguments)
+        for attribute in MODULES[name][2]:
+            getattr(result, attribute)
+        # Views to the shared memory are copied or released before closing
+        own_arrays(result, shared)
+        del catphan, shared
+    finally:
+        shm.close()
+
+    drop_cached(result)
+    return result
+
+
+def analyze_catphan(cbct, workers=1, log_path=None, share=1, **tolerances):
+    """
+    Runs cbct.analyze(**tolerances), with the modules analysed in parallel
+    in the Catphan session pool. Analysed in the current process for workers <= 1
+    or when no cores are left.
+
+    Parameters
+    ----------
+    cbct : CatPhanBase
+        Catphan with the slices loaded (stacks.py).
+    workers : int, optional
+        Number of processes for the modules. The default is 1.
+    log_path : Path, optional
+        File for saving event logs in the workers. The default is None.
+    share : int, optional
+        Number of analysis processes sharing the cores (see workers.session_pool). The default is 1.
+    **tolerances
+        Arguments of cbct.analyze.
+
+    Returns
+    -------
+    None.
+
+    """
+    # Test logger
+    logger_t = logging.getLogger('qa.test')
+
+    pool = session_pool(workers, log_path, name='catphan', share=share)
+    if pool is None:
+        cbct.analyze(**tolerances)
+        return
+
+    cbct.localize()
+    # Pylinac defaults for the arguments that are not given
+    parameters = inspect.signature(type(cbct).analyze).parameters.items()
+    arguments = {key: value.default for key, value in parameters if value.default is not inspect.Parameter.empty}
+    arguments.update(tolerances)
+    names = [name for name, (base, _, _) in MODULES.items() if name == 'ctp404' or cbct._has_module(base)]
+
+    state = {key: value for key, value in vars(cbct).items() if key != 'dicom_stack'}
+    shm, volume = share_volume(cbct.dicom_stack)
+    try:
+        futures = {name: pool.submit(analyze_module, type(cbct), name, state, volume, cbct.dicom_stack.metadata,
+                                     cbct.dicom_stack.slice_spacing, MODULES[name][1](arguments))
+                   for name in names}
+        for name in names:
+            setattr(cbct, name, futures[name].result())
+        # Images compressed after the analysis as in Pylinac
+        if arguments['zip_after'] and not cbct.was_from_zip:
+            cbct._zip_images()
+    except BrokenProcessPool:
+        # A worker was terminated abruptly, the modules are analysed here
+        logger_t.info('Catphan worker stopped unexpectedly. Analysing the modules in sequence.')
+        close_session_pool('catphan')
+        cbct.analyze(**tolerances)
+    finally:
+        shm.close()
+        shm.unlink()
@@ -5,8 +5,6 @@ Created on Mon Apr 29 12:30:18 2024
 @author: rytkysan
 """
 
-from pylinac.ct import CatPhan504, CTP404CP504, CTP486, CTP528CP504, CTP515
-
 # ROI sizes for Halcyon T2/T3 tests
 
 T2_DR_ROI_HAL = {
@@ -62,13 +60,62 @@ CATPHAN_CBCT_TOLERANCES = {
                            'Delrin': 343, 
                            'Teflon': 936}}
 
+# Quick daily Catphan analysis, HU linearity module (CTP404) only (tests.catphan_mode)
+# Machines (Patient ID) and series descriptions (part, any case) analysed in quick mode
+CATPHAN_QUICK_MACHINES = []
+CATPHAN_QUICK_SERIES = []
+# Full analysis when the last full analysis of the machine is older than this (days)
+CATPHAN_FULL_INTERVAL_DAYS = 7
+
 # Tolerance for DRGS (T2) test (% of max deviation)
 DRGS_TOL = 1.5
 
 # Tolerance for DRMLC (T3) test (% of max deviation)
 DRMLC_TOL = 1.5
 
-# Custom linearity module (smaller diameter for ROIs)
+# Memory estimate of an analysis job (admission.py)
+# Stored pixel data is multiplied by the factor (float64 copies in Pylinac), 
+# and the overhead (MB) of the test is added by modality
+MEMORY_PIXEL_FACTOR = 4
+MEMORY_OVERHEAD_MB = {'CT': 400, 'MR': 300, 'RTIMAGE': 150}
+MEMORY_DEFAULT_OVERHEAD_MB = 200
+# Jobs under this size (MB) can start before larger queued jobs (e.g. RT images)
+SMALL_JOB_MB = 512
+
+# Priority scheduling of the analysis jobs (scheduler.py)
+# Priority of each modality (lower runs first), linac tests before CT and MR stacks
+TEST_PRIORITY = {'RTIMAGE': 0, 'CT': 2, 'MR': 2}
+TEST_DEFAULT_PRIORITY = 1
+# Estimated memory (MB) that lowers the priority by one
+PRIORITY_COST_MB = 1000
+# Waiting time (s) that raises the priority by one (aging, long jobs are not starved)
+PRIORITY_AGING_S = 300
+
+# Pdf reports (reports.py)
+# Figure DPI of each report mode, None for the Matplotlib default (100 dpi)
+REPORT_DPI = {'full': None, 'light': 60}
+
+# Pre-validation of the test images (validation.py)
+# Pixel step of the downsampled field check of RT images
+VALIDATION_PIXEL_STEP = 8
+# Fraction of an image border inside the field for a cropped field
+FIELD_EDGE_FRACTION = 0.2
+# Minimum contrast of the field (fraction of the pixel values)
+FIELD_MIN_CONTRAST = 0.1
+# Minimum number of Winston-Lutz images
+WL_MIN_IMAGES = 4
+# Winston-Lutz session of each machine (Patient ID): (gantry, collimator, couch) angles of the images.
+# The session is analysed when the last angle arrives, machines not listed wait for WL_MIN_IMAGES and WL_SETTLE_S.
+# e.g. {'LINAC1': [(0, 0, 0), (90, 0, 0), (180, 0, 0), (270, 0, 0)]}
+WL_EXPECTED_AXES = {}
+# Tolerance (deg) of the image angles to the expected angles
+WL_AXIS_TOLERANCE_DEG = 1
+# Sessions of machines not in WL_EXPECTED_AXES are analysed when no new image has arrived in this time (s)
+WL_SETTLE_S = 120
+# Incomplete groups are deferred while their last file is newer than this (s), then rejected
+DEFER_MAX_S = 600
+
+# HU values of the linearity module inserts
 
 AIR = -1000
 PMP = -196
@@ -81,66 +128,10 @@ BONE_20 = 237
 BONE_50 = 725
 WATER = 0
 
-class CustomCTP404(CTP404CP504):
-    roi_dist_mm = 58.7  # Default value
-    roi_radius_mm = 4  # Smaller diameter
-    roi_settings = {
-        "Air": {
-            "value": AIR,
-            "angle": -90,
-            "distance": roi_dist_mm,
-            "radius": roi_radius_mm,
-        },
-        "PMP": {
-            "value": PMP,
-            "angle": -120,
-            "distance": roi_dist_mm,
-            "radius": roi_radius_mm,
-        },
-        "LDPE": {
-            "value": LDPE,
-            "angle": 180,
-            "distance": roi_dist_mm,
-            "radius": roi_radius_mm,
-        },
-        "Poly": {
-            "value": POLY,
-            "angle": 120,
-            "distance": roi_dist_mm,
-            "radius": roi_radius_mm,
-        },
-        "Acrylic": {
-            "value": ACRYLIC,
-            "angle": 60,
-            "distance": roi_dist_mm,
-            "radius": roi_radius_mm,
-        },
-        "Delrin": {
-            "value": DELRIN,
-            "angle": 0,
-            "distance": roi_dist_mm,
-            "radius": roi_radius_mm,
-        },
-        "Teflon": {
-            "value": TEFLON,
-            "angle": -60,
-            "distance": roi_dist_mm,
-            "radius": roi_radius_mm,
-        },
-    }
-    background_roi_settings = {
-        "1": {"angle": -30, "distance": roi_dist_mm, "radius": roi_radius_mm},
-        "2": {"angle": -150, "distance": roi_dist_mm, "radius": roi_radius_mm},
-        "3": {"angle": -210, "distance": roi_dist_mm, "radius": roi_radius_mm},
-        "4": {"angle": 30, "distance": roi_dist_mm, "radius": roi_radius_mm},
-    }
-
-
-# then, pass to the CatPhan model
-class CustomCP504(CatPhan504):
-    modules = {
-        CustomCTP404: {"offset": 0},
-        CTP486: {"offset": -65},
-        CTP528CP504: {"offset": 30},
-        CTP515: {"offset": -30},
-    }
\ No newline at end of file
+
+def __getattr__(name):
+    # Custom Catphan models are imported on first use, importing Pylinac is slow
+    if name in ('CustomCTP404', 'CustomCP504'):
+        from qa_analysis import phantoms
+        return getattr(phantoms, name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,502 @@
+# -*- coding: utf-8 -*-
+"""
+Registry of the test types detected by the analysis pipeline.
+
+Each test type declares the DICOM tags it needs, a match function that finds
+its images and a run function for the analysis. The pipeline reads the union
+of the declared tags from each file once (without pixel data) and classifies
+the images in one pass (see classify_headers).
+
+A new test type is added with register(). When images of several test types
+are found in one group, the test registered first is run.
+"""
+from collections import namedtuple
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+import logging
+
+import pydicom
+
+from qa_analysis.tests import drgs_test, drmlc_test, catphan_analysis, winston_analysis, acr_analysis
+from qa_analysis.utilities import save_excel, move_processed
+from qa_analysis.arrays import save_arrays, t2_t3_arrays
+from qa_analysis.workers import session_pool, close_session_pool
+from qa_analysis.pipeline import commit
+from qa_analysis.streaming import localize_session
+from qa_analysis.reports import report_dpi
+from qa_analysis.validation import (
+    IMAGE_POSITION, validate_t2_t3, validate_catphan, validate_acr, validate_winston
+    )
+from qa_analysis.constants import (
+    T2_DR_ROI_HAL, T2_GS_ROI_HAL, T3_MLC_ROI_HAL,
+    DRGS_TOL, DRMLC_TOL, CATPHAN_CBCT_TOLERANCES, CATPHAN_TOLERANCES
+    )
+
+
+# Test type
+#   name: name of the test in the logs
+#   tags: DICOM tags read for detecting the images (top-level tags, sequences are read whole)
+#   match: function(header, test_images) returning the images found, {key: value},
+#          or None if the image is not from the test
+#   run: function(test_images, arg, pdf) running the analysis, returns the results
+#   key: the test is run when this key is found
+#   prepare: function(header, arg) called for each matched image before the analysis, optional
+#   validate: function(test_images, headers, arg) returning an Invalid (see validation.py)
+#             or None, run before the analysis, optional
+#   stream: function(test_images, headers, arg) called when the group is deferred, e.g. to
+#           analyse the images that have arrived, optional
+Detector = namedtuple('Detector', ['name', 'tags', 'match', 'run', 'key', 'prepare', 'validate', 'stream'],
+                      defaults=[None, None, None])
+
+# Registered test types, in the order of priority
+DETECTORS = []
+
+# Modality tag (used by most test types)
+MODALITY = (0x0008, 0x0060)
+
+
+class DicomHeader:
+    """
+    DICOM header of an image file without pixel data.
+
+    Only the tags used for detecting the tests are read (tags). The full header
+    (metadata) is read when it is used, i.e. for the images that are analysed.
+    """
+
+    def __init__(self, path, tags=None):
+        self.path = path
+        self.tags = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=tags)
+        self._metadata = None
+
+    @property
+    def metadata(self):
+        """
+        Full header of the file (read once).
+        """
+        if self._metadata is None:
+            self._metadata = pydicom.dcmread(self.path, stop_before_pixels=True)
+        return self._metadata
+
+    def __contains__(self, tag):
+        return tag in self.tags
+
+    def __getitem__(self, tag):
+        return self.tags[tag]
+
+    def get_value(self, tag, default=None):
+        """
+        Value of a tag, or default if the tag is missing.
+        """
+        return self.tags[tag].value if tag in self.tags else default
+
+
+def register(name, tags, match, run, key, prepare=None, validate=None, stream=None):
+    """
+    Adds a test type to the registry.
+
+    Parameters
+    ----------
+    name : str
+        Name of the test.
+    tags : list
+        DICOM tags needed by the match and prepare functions.
+    match : function
+        Called as match(header, test_images) for each image.
+        Returns a dict of the images (and settings) found, which is empty 
+        if the image is from the test but not needed. None for other images.
+    run : function
+        Called as run(test_images, arg, pdf) to run the analysis.
+    key : str
+        The test is run if this key is found in the test images.
+    prepare : function, optional
+        Called as prepare(header, arg) for each matched image. The default is None.
+    validate : function, optional
+        Called as validate(test_images, headers, arg) before the analysis. Returns an Invalid
+        (see validation.py) if the images cannot be analysed, None otherwise. The default is None.
+    stream : function, optional
+        Called as stream(test_images, headers, arg) when the group is deferred, to analyse
+        the images that have arrived (see streaming.py). The default is None.
+
+    Returns
+    -------
+    detector : Detector
+        The registered test type.
+
+    """
+    detector = Detector(name, tuple(tags), match, run, key, prepare, validate, stream)
+    DETECTORS.append(detector)
+    return detector
+
+
+def required_tags(detectors=None):
+    """
+    Union of the tags needed by the test types.
+
+    Parameters
+    ----------
+    detectors : list, optional
+        Test types. The default is None (all registered).
+
+    Returns
+    -------
+    tags : list
+        Sorted DICOM tags.
+
+    """
+    detectors = DETECTORS if detectors is None else detectors
+    tags = {pydicom.tag.Tag(tag) for detector in detectors for tag in detector.tags}
+    return sorted(tags)
+
+
+def classify_headers(headers, arg):
+    """
+    Finds the images of each test type in one pass over the headers.
+
+    Parameters
+    ----------
+    headers : list
+        DicomHeaders of the patient in the measurement date.
+    arg : TYPE
+        Input arguments.
+
+    Returns
+    -------
+    test_images : dict
+        Images (and settings) found for the tests.
+
+    """
+    test_images = {
+        't2_dr_segment_size': None,
+        't2_gs_segment_size': None,
+        't3_segment_size': None,
+        't2_dr_roi': None,
+        't2_gs_roi': None,
+        't3_roi': None}
+    for header in headers:
+        for detector in DETECTORS:
+            found = detector.match(header, test_images)
+            if found is None:
+                continue
+            test_images.update(found)
+            if detector.prepare is not None:
+                detector.prepare(header, arg)
+
+    return test_images
+
+
+def validate_detected(test_images, headers, arg):
+    """
+    Pre-validation of the images of the first registered test type found (see validation.py).
+
+    Parameters
+    ----------
+    test_images : dict
+        Images found by classify_headers.
+    headers : list
+        DicomHeaders of the patient in the measurement date.
+    arg : TYPE
+        Input arguments.
+
+    Returns
+    -------
+    Invalid or None
+        Reason for rejecting or deferring the group, None if the images can be analysed.
+
+    """
+    for detector in DETECTORS:
+        if detector.key in test_images:
+            if detector.validate is None:
+                return None
+            return detector.validate(test_images, headers, arg)
+
+    return None
+
+
+def stream_detected(test_images, headers, arg):
+    """
+    Analyses the images that have arrived of a deferred group, for the first registered
+    test type found (see streaming.py). Test types without a stream function are left as they are.
+    """
+    for detector in DETECTORS:
+        if detector.key in test_images:
+            if detector.stream is not None:
+                detector.stream(test_images, headers, arg)
+            return
+
+
+def run_detected(test_images, arg, pdf=True):
+    """
+    Runs the analysis of the first registered test type found in the images.
+
+    Parameters
+    ----------
+    test_images : dict
+        Images found by classify_headers.
+    arg : TYPE
+        Input arguments.
+    pdf : bool, optional
+        Save pdf reports (Catphan, ACR and Winston-Lutz). The default is True.
+
+    Returns
+    -------
+    results : dict, list or None
+        Results of the test. None if no test was found.
+
+    """
+    # Analysis logger
+    logger_a = logging.getLogger('qa.analysis')
+
+    for detector in DETECTORS:
+        if detector.key in test_images:
+            logger_a.debug(f'Running {detector.name} for {test_images[detector.key].path}')
+            return detector.run(test_images, arg, pdf)
+
+    return None
+
+
+def match_t2_t3(header, res_images):
+    """
+    Finds open-beam and MLC images for T2 and T3.
+    Sets custom ROI properties for Halcyon.
+
+    Assumptions:
+    T2: RT image label = 'MV_243'
+    T3: RT image label = 'MV_32' (MV_190 open and MV_40 MLC with Halcyon)
+    Open beam images have the "Curve label" -tag (= 'Field Edge (Open' or 'CIAO (OpenBeam)' with Halcyon)
+    Halcyon T2DR: Exposure < 100 MU
+    Halcyon T2GS: Jaw position = -140 mm
+
+    Parameters
+    ----------
+    header : DicomHeader
+        Image header.
+    res_images : dict
+        Images found so far.
+
+    Returns
+    -------
+    dict or None
+        Images (and Halcyon ROIs) found.
+
+    """
+    # Check if RT image label exists in Dicom metadata
+    rt_label = header.get_value((0x3002, 0x0002))
+    if rt_label is None:
+        return None
+    is_open = (0x5000, 0x2500) in header
+
+    # T2 open beam
+    if 'MV_243' in rt_label and is_open:
+        # Halcyon DR image has ~60MU exposure
+        exposure = float(header[0x3002, 0x0030].value[0].MetersetExposure)
+        if exposure < 100:
+            return {'t2_dr_open': header}
+        return {'t2_open': header}
+    # T2 MLC
+    elif 'MV_243' in rt_label:
+        # Halcyon DR image has ~60MU exposure
+        exposure = float(header[0x3002, 0x0030].value[0].MetersetExposure)
+        if exposure < 100:
+            # Custom ROI for Halcyon T2DR
+            return {'t2_dr_mlc': header, 't2_dr_roi': T2_DR_ROI_HAL}
+
+        # Halcyon T2 tests have 14cm x 14cm collimation
+        jaw_pos = int(header[0x3002, 0x0030].value[0][0x300a, 0x00b6].value[0].LeafJawPositions[0])
+        # Custom ROI for Halcyon T2GS
+        if jaw_pos == -140:
+            return {'t2_mlc': header, 't2_gs_roi': T2_GS_ROI_HAL}
+        return {'t2_mlc': header}
+    # T3 Open beam
+    elif ('MV_32' in rt_label or 'MV_190' in rt_label) and is_open:
+        # Custom ROI for Halcyon T3MLC
+        if 'MV_190' in rt_label:
+            return {'t3_open': header, 't3_roi': T3_MLC_ROI_HAL}
+        return {'t3_open': header}
+    # T3 MLC
+    elif ('MV_32' in rt_label or 'MV_40' in rt_label) and not is_open:
+        return {'t3_mlc': header}
+
+    return None
+
+
+def run_t2_t3_tests(test, args):
+    """
+    Runs the T2, T3 and (Halcyon) T2DR tests of a session, saves the results and moves the images.
+    The tests share no images and are run concurrently in the session pool (--vmat_workers,
+    limited to the cores left by the analysis workers).
+
+    Parameters
+    ----------
+    test : dict
+        Images found by classify_headers.
+    args : TYPE
+        Input arguments (the reports are saved with args.pdf).
+
+    Returns
+    -------
+    res : list
+        Results of the T2, T3 and T2DR tests, in this order.
+
+    """
+    # Analysis logger
+    logger_a = logging.getLogger('qa.analysis')
+
+    # Dose-rate & gantry speed test (T2), MLC speed test (T3)
+    jobs = [
+        (drgs_test, (test['t2_mlc'], test['t2_open']),
+         dict(tol=DRGS_TOL, savepath=args.save_path, pdf=args.pdf, plot=args.plot, dpi=report_dpi(args),
+              segment_size=test['t2_gs_segment_size'], roi=test['t2_gs_roi'])),
+        (drmlc_test, (test['t3_mlc'], test['t3_open']),
+         dict(tol=DRMLC_TOL, savepath=args.save_path, pdf=args.pdf, plot=args.plot, dpi=report_dpi(args),
+              segment_size=test['t3_segment_size'], roi=test['t3_roi'])),
+        ]
+    # Dose rate test for Halcyon
+    if 't2_dr_open' in test and 't2_dr_mlc' in test:
+        jobs.append((drgs_test, (test['t2_dr_mlc'], test['t2_dr_open']),
+                     dict(tol=DRGS_TOL, savepath=args.save_path, pdf=args.pdf, plot=args.plot, dpi=report_dpi(args),
+                          segment_size=test['t2_dr_segment_size'], roi=test['t2_dr_roi'], rep_name='t2dr')))
+
+    # Plots are shown only in the current process
+    pool = None if args.plot else session_pool(getattr(args, 'vmat_workers', 1), getattr(args, 'log_path', None),
+                                               share=getattr(args, 'workers', 1))
+    res = None
+    if pool is not None:
+        futures = [pool.submit(function, *images, **options) for function, images, options in jobs]
+        try:
+            # Results in the order of save_excel: t2, t3, t2_dr
+            res = [future.result() for future in futures]
+        except BrokenProcessPool:
+            # A worker was terminated abruptly, the tests are run here
+            logger_a.info('Session worker stopped unexpectedly. Running T2-T3 tests in sequence.')
+            close_session_pool()
+    if res is None:
+        res = [function(*images, **options) for function, images, options in jobs]
+
+    # Saved in the commit stage of the pipeline (see pipeline.py)
+    commit(commit_t2_t3, test, res, args)
+    return res
+
+
+def commit_t2_t3(test, res, args):
+    """
+    Saves the results of a T2-T3 session and moves the images to the processed folder.
+    """
+    # Save results as a row in Excel file
+    save_excel(test['t2_mlc'], res, save_path=args.save_path, test='T2-T3')
+    # Save the segment values
+    save_arrays(test['t2_mlc'], t2_t3_arrays(res), args.save_path, 'T2-T3')
+
+    # Move analyzed files to the processed folder, create subfolder by modality
+    modality = 'T2-T3'
+    # Assume that there is one folder for patient name/ID
+    parent_folder = Path(test['t2_mlc'].path).parent.parent.stem
+    # Possible test images
+    t2t3_images = ['t2_mlc', 't2_open', 't3_mlc', 't3_open', 't2_dr_mlc', 't2_dr_open']
+    for key, im in test.items():
+        if key in t2t3_images:
+            move_processed(im.path, args, modality, parent_folder)
+
+
+def match_catphan(header, res_images):
+    """
+    Finds the first diagnostic CT image (SOP class CT Image Storage).
+    The other slices of the series are matched without adding images.
+    """
+    if header.get_value(MODALITY) != 'CT':
+        return None
+    # Linac CBCT images are detected by match_catphan_linac
+    if (0x0008, 0x114a) in header or not (0x0008, 0x1140) in header:
+        return None
+
+    # For diagnostic CT, SOP UID [0x0008, 0x1140][0x0008, 0x1150] should be CT Image Storage
+    if header[0x0008, 0x1140].value[0][0x0008, 0x1150].repval != 'CT Image Storage':
+        return None
+    return {} if 'catphan' in res_images else {'catphan': header}
+
+
+def match_catphan_linac(header, res_images):
+    """
+    Finds the first Linac CBCT image (referencing an RT plan).
+    The other slices of the series are matched without adding images.
+    """
+    if header.get_value(MODALITY) != 'CT' or not (0x0008, 0x114a) in header:
+        return None
+
+    # For Linac CBCT, SOP UID should be RT Plan storage
+    ref_inst = 'RT Plan or RT Ion Plan or Radiation Set to be verified'
+    reference = header[0x0008, 0x114a].value[0]
+    catphan_test1 = reference[0x0008, 0x1150].repval == 'RT Plan Storage'
+    catphan_test2 = reference[0x0040, 0xa170].value[0][0x0008, 0x0104].value == ref_inst
+
+    if not (catphan_test1 or catphan_test2):
+        return None
+    return {} if 'catphan_linac' in res_images else {'catphan_linac': header}
+
+
+def prepare_orientation(header, arg):
+    """
+    The Catphan orientation should be head first supine.
+    Inverts the Z-axis of feet first supine images and changes them to HFS.
+    """
+    if header.get_value((0x0018, 0x5100)) != 'FFS' or getattr(arg, 'read_only', False):
+        return
+
+    # Invert Z-axis, and change to HFS
+    ds = pydicom.dcmread(header.path)
+    ds[0x0018, 0x5100].value = 'HFS'
+    ds[0x0020, 0x0032].value[2] = -float(ds[0x0020, 0x0032].value[2])
+    # Save inverted image
+    ds.save_as(header.path)
+
+    # Update the headers that were read
+    header.tags[0x0018, 0x5100].value = 'HFS'
+    header._metadata = None
+
+
+def match_acr(header, res_images):
+    """
+    Finds the first MR image. Assumes that MR images are from ACR phantom
+    and that the images from same series are in one folder.
+    The field strength is updated in acr_analysis.
+    """
+    if header.get_value(MODALITY) == 'MR' and not 'acr' in res_images:
+        return {'acr': header}
+    return None
+
+
+def match_winston(header, res_images):
+    """
+    Finds the first RT image. Patient name could be added as a filter.
+    """
+    if header.get_value(MODALITY) == 'RTIMAGE' and not 'winston' in res_images:
+        return {'winston': header}
+    return None
+
+
+# VMAT tests (T2/T3)
+register('T2/T3 analysis',
+         tags=[(0x3002, 0x0002), (0x3002, 0x0030), (0x5000, 0x2500)],
+         match=match_t2_t3, key='t3_mlc', validate=validate_t2_t3,
+         run=lambda test, arg, pdf: run_t2_t3_tests(test, arg))
+# Diagnostic CT
+register('Catphan analysis',
+         tags=[MODALITY, (0x0008, 0x1140), (0x0008, 0x114a), (0x0018, 0x5100), IMAGE_POSITION],
+         match=match_catphan, key='catphan', prepare=prepare_orientation,
+         validate=validate_catphan('catphan'),
+         run=lambda test, arg, pdf: catphan_analysis(test['catphan'], arg, pdf=pdf,
+                                                     tolerances=CATPHAN_TOLERANCES))
+# Linac CBCT
+register('Catphan analysis (CBCT)',
+         tags=[MODALITY, (0x0008, 0x114a), (0x0018, 0x5100), IMAGE_POSITION],
+         match=match_catphan_linac, key='catphan_linac', prepare=prepare_orientation,
+         validate=validate_catphan('catphan_linac'),
+         run=lambda test, arg, pdf: catphan_analysis(test['catphan_linac'], arg, pdf=pdf,
+                                                     tolerances=CATPHAN_CBCT_TOLERANCES))
+# MR images
+register('ACR analysis', tags=[MODALITY, IMAGE_POSITION], match=match_acr, key='acr', validate=validate_acr,
+         run=lambda test, arg, pdf: acr_analysis(test['acr'], arg, pdf=pdf))
+# RT images
+register('Winston-Lutz analysis',
+         tags=[MODALITY, (0x0008, 0x0018), (0x0010, 0x0020), (0x300a, 0x011e), (0x300a, 0x0120), (0x300a, 0x0122)],
+         match=match_winston, key='winston', validate=validate_winston, stream=localize_session,
+         run=lambda test, arg, pdf: winston_analysis(test['winston'], arg, pdf=pdf))
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Lease files for claiming measurement groups between workers.
+
+Several workers (machines or processes) can analyse the same data folder.
+A worker analyses a (date, patient) group only while holding its lease, a file
+in a shared lease folder. Leases are created with O_EXCL, which is atomic also
+on network shares (SMB, NFS), so only one worker gets each lease.
+
+The lease file of a group is named <group>.<generation>.lease. A worker keeps
+its lease alive by updating the modification time (heartbeat). If a worker
+dies, the lease expires after ttl seconds and is reclaimed by creating the
+next generation, which again succeeds for only one worker.
+The clocks of the workers should agree within a fraction of ttl.
+"""
+import os
+import re
+import json
+import socket
+import hashlib
+import logging
+import threading
+from time import time
+from contextlib import contextmanager
+
+
+def group_key(date, patient):
+    """
+    File name for a (date, patient) group. Hash is added, as Patient IDs
+    can have characters that are not allowed in file names.
+    """
+    digest = hashlib.sha1(f'{date}/{patient}'.encode()).hexdigest()[:8]
+    return f"{date}_{re.sub(r'[^A-Za-z0-9_-]', '_', str(patient))}_{digest}"
+
+
+def worker_name():
+    """
+    Default name of this worker (host and process).
+    """
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+
+class Lease:
+    """
+    Lease of one measurement group.
+
+    Parameters
+    ----------
+    lease_path : Path
+        Shared folder for the lease files.
+    key : str
+        Group name (see group_key).
+    worker : str, optional
+        Name of the worker, saved in the lease. The default is host and process.
+    ttl : float, optional
+        Time (s) after the last heartbeat when the lease expires. The default is 300.
+
+    """
+
+    def __init__(self, lease_path, key, worker=None, ttl=300):
+        self.lease_path = lease_path
+        self.key = key
+        self.worker = worker_name() if worker is None else worker
+        self.ttl = ttl
+        self.generation = None
+
+    def _path(self, generation):
+        return os.path.join(self.lease_path, f'{self.key}.{generation}.lease')
+
+    def _generations(self):
+        """
+        Generations of the existing lease files, in ascending order.
+        """
+        generations = []
+        for name in os.listdir(self.lease_path):
+            if not (name.startswith(f'{self.key}.') and name.endswith('.lease')):
+                continue
+            generation = name[len(self.key) + 1:-len('.lease')]
+            if generation.isdigit():
+                generations.append(int(generation))
+        return sorted(generations)
+
+    def claim(self):
+        """
+        Tries to get the lease.
+
+        Returns
+        -------
+        bool
+            True if the lease was taken by this worker.
+
+        """
+        # Logger for the worker events
+        logger_a = logging.getLogger('qa.analysis')
+
+        generations = self._generations()
+        generation = 0
+        if len(generations) > 0:
+            # Lease held by another worker, unless expired
+            try:
+                age = time() - os.stat(self._path(generations[-1])).st_mtime
+            except FileNotFoundError:
+                # Released or reclaimed meanwhile, try again on the next round
+                return False
+            if age < self.ttl:
+                return False
+            generation = generations[-1] + 1
+            logger_a.info(f'Reclaiming expired lease {self.key} ({age:.0f} s since last heartbeat)')
+
+        # Only one worker can create the file
+        try:
+            fd = os.open(self._path(generation), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'worker': self.worker, 'claimed': time()}, f)
+        self.generation = generation
+
+        # Earlier generations are not needed anymore
+        for old in generations:
+            try:
+                os.remove(self._path(old))
+            except OSError:
+                pass
+
+        return True
+
+    def renew(self):
+        """
+        Heartbeat, updates the modification time of the lease file.
+
+        Returns
+        -------
+        bool
+            False if the lease was lost (expired and reclaimed by another worker).
+
+        """
+        generations = self._generations()
+        if self.generation is None or len(generations) == 0 or generations[-1] != self.generation:
+            return False
+        try:
+            os.utime(self._path(self.generation))
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self):
+        """
+        Removes the lease file.
+        """
+        if self.generation is None:
+            return
+        try:
+            os.remove(self._path(self.generation))
+        except FileNotFoundError:
+            pass
+        self.generation = None
+
+
+@contextmanager
+def hold(lease):
+    """
+    Renews the lease in a background thread until exit, and releases it.
+    A lost lease is logged.
+
+    Parameters
+    ----------
+    lease : Lease
+        Claimed lease.
+
+    Yields
+    ------
+    lease : Lease
+        The lease.
+
+    """
+    # Logger for the worker events
+    logger_a = logging.getLogger('qa.analysis')
+
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(lease.ttl / 3):
+            if not lease.renew():
+                logger_a.warning(f'Lease {lease.key} was lost. The group may be analysed by another worker.')
+                return
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+    try:
+        yield lease
+    finally:
+        stop.set()
+        thread.join()
+        lease.release()
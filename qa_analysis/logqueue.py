@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Queue-based logging.
+
+The loggers (qa.analysis, qa.test, qa.utilities, ...) only put records in a
+queue. A listener thread in the main process writes them to the log file and to
+the console, so a slow log file (e.g. on a network share) does not stall the analysis.
+
+The queue is a multiprocessing queue, which is given to the worker processes
+(see workers.py), so all processes write to the same file through one listener.
+The queue is bounded: when it is full, DEBUG and INFO records are dropped and
+counted, warnings and errors wait for a moment. The number of dropped records
+is logged when the queue has space again.
+"""
+import queue
+import atexit
+import logging
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler, TimedRotatingFileHandler
+
+# Log queue of this process, and the listener (main process only)
+_log_queue = None
+_listener = None
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Puts log records in a bounded queue without waiting.
+
+    Parameters
+    ----------
+    log_queue : multiprocessing.Queue
+        Queue read by the listener.
+    block_s : float, optional
+        Time (s) that warnings and errors wait for space in a full queue. The default is 0.5.
+
+    """
+
+    def __init__(self, log_queue, block_s=0.5):
+        super().__init__(log_queue)
+        self.block_s = block_s
+        self.dropped = 0
+
+    def enqueue(self, record):
+        # Report the records dropped since the queue was full
+        if self.dropped > 0:
+            notice = logging.LogRecord('qa.utilities', logging.WARNING, __file__, 0,
+                                       f'{self.dropped} log records dropped (log queue full)', None, None)
+            try:
+                self.queue.put_nowait(notice)
+                self.dropped = 0
+            except queue.Full:
+                pass
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno < logging.WARNING:
+                self.dropped += 1
+                return
+            try:
+                self.queue.put(record, timeout=self.block_s)
+            except queue.Full:
+                self.dropped += 1
+
+
+class Listener(QueueListener):
+    """
+    Queue listener that waits for space in the queue when stopping.
+    """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+def file_handler(path, rotation='month', max_mb=10, backup_count=12):
+    """
+    Handler for the log file.
+
+    Parameters
+    ----------
+    path : str
+        Log file.
+    rotation : str, optional
+        'month' (new file each month, no rotation), 'size' (rotated at max_mb)
+        or 'daily' (rotated at midnight). The default is 'month'.
+    max_mb : float, optional
+        Size (MB) for size rotation. The default is 10.
+    backup_count : int, optional
+        Rotated files kept. The default is 12.
+
+    Returns
+    -------
+    logging.Handler
+        File handler.
+
+    """
+    if rotation == 'size':
+        return RotatingFileHandler(path, maxBytes=int(max_mb * 2 ** 20), backupCount=backup_count)
+    if rotation == 'daily':
+        return TimedRotatingFileHandler(path, when='midnight', backupCount=backup_count)
+    return logging.FileHandler(path, mode='a')
+
+
+def start_listener(handlers, queue_size=10000):
+    """
+    Starts the listener thread writing the records of the queue to the handlers,
+    and sets the queue handler to the root logger of this process.
+
+    Parameters
+    ----------
+    handlers : list
+        Handlers for the records (file and console).
+    queue_size : int, optional
+        Maximum number of records in the queue. The default is 10000.
+
+    Returns
+    -------
+    log_queue : multiprocessing.Queue
+        Queue for the worker processes.
+
+    """
+    global _log_queue, _listener
+
+    stop_listener()
+    _log_queue = multiprocessing.Queue(queue_size)
+    _listener = Listener(_log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    attach_queue(_log_queue)
+
+    # Records in the queue are written when the program exits
+    atexit.register(stop_listener)
+    return _log_queue
+
+
+def stop_listener():
+    """
+    Writes the records left in the queue and stops the listener.
+    """
+    global _listener
+
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.close()
+    _listener = None
+
+
+def attach_queue(log_queue, level=logging.DEBUG):
+    """
+    Sends the records of this process to the queue (e.g. in a worker process).
+    """
+    global _log_queue
+
+    _log_queue = log_queue
+    root = logging.getLogger('')
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(BoundedQueueHandler(log_queue))
+    root.setLevel(level)
+
+
+def log_queue():
+    """
+    Log queue of this process, None if logging is not queued.
+    """
+    return _log_queue
@@ -0,0 +1,337 @@
+# -*- coding: utf-8 -*-
+"""
+Manifest of the processed files.
+
+With --processed_mode manifest, the analysed files are left where the modality wrote
+them, and each file is recorded in an SQLite manifest instead of being moved:
+    path                file in the data folder (primary key)
+    sop_instance_uid    SOPInstanceUID of the file (indexed)
+    test                test name, the processed subfolder (e.g. 'Catphan'), or 'Not_analyzed'
+    result_key          PatientID_SeriesDate_SeriesTime of the results (reports and Excel rows, indexed)
+    processed_at        time of the analysis
+    mtime               modification time of the file when it was recorded
+    relocated           destination after relocation, NULL while the file is in the data folder
+
+The discovery of the analysis skips the files of the manifest (unprocessed), unless
+the file was written again after it was recorded. The records are written in batches.
+With --relocate, the recorded files are moved to the processed folder in a background
+thread after each run (relocate), so the moves are not on the critical path.
+
+The manifest is for one machine. SQLite locking is not reliable on network shares
+(SMB, NFS), so the manifest is kept on a local disk and shared only by the processes
+of that machine. Workers on several machines (main_worker.py) claim the groups with
+lease files, which rely only on exclusive creation (leases.py), and move the files.
+"""
+import os
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+from datetime import datetime
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+# Manifest file in the results folder (unless --manifest is given)
+MANIFEST_FILE = 'processed_manifest.sqlite'
+
+# Records written in one transaction
+MANIFEST_BATCH = 500
+
+# Files looked up in one query (SQLite allows 999 parameters in older versions)
+MANIFEST_QUERY = 500
+
+# Test of the files that were not analysed
+NOT_ANALYZED = 'Not_analyzed'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed (
+    path TEXT PRIMARY KEY,
+    sop_instance_uid TEXT,
+    test TEXT,
+    result_key TEXT,
+    processed_at TEXT,
+    mtime REAL,
+    relocated TEXT
+);
+CREATE INDEX IF NOT EXISTS processed_uid ON processed (sop_instance_uid);
+CREATE INDEX IF NOT EXISTS processed_result ON processed (result_key);
+"""
+
+# Records not yet written, by manifest file (see flush_manifest)
+_pending = {}
+_pending_lock = threading.Lock()
+
+# Background relocation of this process, and the relocations not yet waited for (see relocate)
+_relocation_pool = None
+_relocation_futures = []
+
+
+def use_manifest(args):
+    """
+    True if the processed files are recorded in the manifest instead of moved.
+    """
+    return getattr(args, 'processed_mode', 'move') == 'manifest'
+
+
+def manifest_path(args):
+    """
+    Manifest file from the input arguments (manifest, or MANIFEST_FILE in save_path).
+    """
+    path = getattr(args, 'manifest', None)
+    return str(path) if path is not None else os.path.join(str(args.save_path), MANIFEST_FILE)
+
+
+def connect(path):
+    """
+    Opens the manifest, creates the table on first use.
+    """
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(path, timeout=30)
+    con.executescript(SCHEMA)
+    return con
+
+
+def record(src, args, test):
+    """
+    Records a processed file in the manifest (written in batches, see flush_manifest).
+
+    Parameters
+    ----------
+    src : str
+        File in the data folder.
+    args : TYPE
+        Input arguments (save_path or manifest).
+    test : str
+        Test name (processed subfolder), or NOT_ANALYZED.
+
+    Returns
+    -------
+    None.
+
+    """
+    # Identifiers are left empty for files that are not DICOM
+    uid, result_key = None, None
+    try:
+        ds = pydicom.dcmread(src, stop_before_pixels=True,
+                             specific_tags=[(0x0008, 0x0018), (0x0008, 0x0021), (0x0008, 0x0031), (0x0010, 0x0020)])
+        uid = ds.get('SOPInstanceUID')
+        result_key = f"{ds.get('PatientID', '')}_{ds.get('SeriesDate', '')}_{ds.get('SeriesTime', '')}"
+    except (InvalidDicomError, OSError):
+        pass
+    try:
+        mtime = os.path.getmtime(src)
+    except OSError:
+        return
+
+    path = manifest_path(args)
+    row = (os.path.normpath(src), uid, test, result_key, datetime.now().isoformat(timespec='seconds'), mtime)
+    with _pending_lock:
+        rows = _pending.setdefault(path, [])
+        rows.append(row)
+        full = len(rows) >= MANIFEST_BATCH
+    if full:
+        flush_manifest(args)
+
+
+def flush_manifest(args):
+    """
+    Writes the pending records of this process to the manifest. Returns the number of records.
+    """
+    path = manifest_path(args)
+    with _pending_lock:
+        rows = _pending.pop(path, [])
+        if len(rows) == 0:
+            return 0
+        con = connect(path)
+        try:
+            with con:
+                con.executemany('INSERT OR REPLACE INTO processed '
+                                '(path, sop_instance_uid, test, result_key, processed_at, mtime, relocated) '
+                                'VALUES (?, ?, ?, ?, ?, ?, NULL)', rows)
+        finally:
+            con.close()
+    return len(rows)
+
+
+def unprocessed(paths, args):
+    """
+    Files that are not in the manifest, or were written again after they were recorded.
+    All files without the manifest mode.
+
+    Parameters
+    ----------
+    paths : list
+        Files in the data folder.
+    args : TYPE
+        Input arguments.
+
+    Returns
+    -------
+    list
+        Files to be analysed, in the order of paths.
+
+    """
+    if not use_manifest(args) or len(paths) == 0:
+        return list(paths)
+
+    flush_manifest(args)
+    paths = list(paths)
+    keys = [os.path.normpath(path) for path in paths]
+    recorded = {}
+    con = connect(manifest_path(args))
+    try:
+        # Only the given files are looked up, not the whole manifest
+        for i in range(0, len(keys), MANIFEST_QUERY):
+            chunk = keys[i:i + MANIFEST_QUERY]
+            recorded.update(con.execute('SELECT path, mtime FROM processed WHERE relocated IS NULL '
+                                        f'AND path IN ({", ".join("?" * len(chunk))})', chunk))
+    finally:
+        con.close()
+
+    files = []
+    for path, key in zip(paths, keys):
+        mtime = recorded.get(key)
+        try:
+            if mtime is None or os.path.getmtime(path) != mtime:
+                files.append(path)
+        except OSError:
+            continue
+    return files
+
+
+def pending_files(folder, args):
+    """
+    Files of a series folder that are not processed (see unprocessed).
+    """
+    return unprocessed([os.path.join(folder, name) for name in sorted(os.listdir(folder))], args)
+
+
+def series_source(folder, args):
+    """
+    Series to be loaded by Pylinac: the folder, or its pending files in the manifest mode
+    (processed series are left in the folder).
+    """
+    return pending_files(folder, args) if use_manifest(args) else folder
+
+
+def folder_series(folder, args):
+    """
+    Pending files of a series folder grouped by SeriesInstanceUID. Each series is loaded
+    from its files, as the folder keeps the analysed series in manifest mode and read-only
+    runs (e.g. backfill), and Pylinac mixes the files of several series in one folder.
+    Files that are not DICOM are left out.
+
+    Parameters
+    ----------
+    folder : str
+        Series folder.
+    args : TYPE
+        Input arguments.
+
+    Returns
+    -------
+    list
+        Files of each series, in the order of the first file of the series.
+
+    """
+    series = {}
+    for path in pending_files(folder, args):
+        try:
+            ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=[(0x0020, 0x000e)])
+        except (InvalidDicomError, OSError):
+            continue
+        series.setdefault(ds.get('SeriesInstanceUID'), []).append(path)
+    return list(series.values())
+
+
+def relocate_files(args):
+    """
+    Moves the recorded files to the processed folder (subfolder by test, as move_processed).
+
+    Parameters
+    ----------
+    args : TYPE
+        Input arguments.
+
+    Returns
+    -------
+    relocated : int
+        Number of files moved.
+
+    """
+    from qa_analysis.utilities import relocate_file, move_file
+
+    # Utility logger
+    logger_u = logging.getLogger('qa.utilities')
+
+    start = perf_counter()
+    moved = []
+    try:
+        flush_manifest(args)
+        con = connect(manifest_path(args))
+    # Relocation is tried again after the next run
+    except (sqlite3.Error, OSError) as e:
+        logger_u.error(f'Processed files not relocated due to error {e}')
+        return 0
+    try:
+        rows = con.execute('SELECT path, test FROM processed WHERE relocated IS NULL').fetchall()
+        for path, test in rows:
+            if not os.path.isfile(path):
+                continue
+            try:
+                if test == NOT_ANALYZED:
+                    dst = path.replace(args.data_path.stem, f'{args.processed_path.stem}/{NOT_ANALYZED}')
+                    move_file(path, dst)
+                else:
+                    # Assume that there is one folder for patient name/ID (as in the tests)
+                    dst = relocate_file(path, args, test, Path(path).parent.parent.stem)
+            # The file is tried again after the next run, the other files are moved
+            except OSError as e:
+                logger_u.error(f'{path} not relocated due to error {e}')
+                continue
+            if not os.path.exists(path):
+                moved.append((dst, path))
+        with con:
+            con.executemany('UPDATE processed SET relocated = ? WHERE path = ?', moved)
+    except sqlite3.Error as e:
+        logger_u.error(f'Relocation of {len(moved)} files not recorded due to error {e}')
+    finally:
+        con.close()
+
+    if len(moved) > 0:
+        logger_u.info(f'Relocated {len(moved)} processed files in {perf_counter() - start:.1f} s')
+    return len(moved)
+
+
+def relocate(args):
+    """
+    Starts relocate_files in the background thread of this process.
+    Returns the future, or None without the manifest mode and --relocate.
+    """
+    global _relocation_pool
+
+    if not use_manifest(args) or not getattr(args, 'relocate', False):
+        return None
+    if _relocation_pool is None:
+        _relocation_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='qa-relocate')
+    future = _relocation_pool.submit(relocate_files, args)
+    _relocation_futures.append(future)
+    return future
+
+
+def wait_relocation():
+    """
+    Waits for the relocations started in this process (e.g. before a single run exits),
+    and for the compression of the relocated files (see archive.py).
+    Returns the number of files moved.
+    """
+    from qa_analysis.archive import wait_archive
+
+    relocated = 0
+    while len(_relocation_futures) > 0:
+        relocated += _relocation_futures.pop(0).result()
+    wait_archive()
+    return relocated
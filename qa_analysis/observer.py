@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+"""
+Polling observer for network drives.
+
+The native Watchdog observer is unreliable on mapped network drives (SMB),
+and the Watchdog polling observer stats every file of the tree on each poll.
+This observer keeps an index of the tree with the modification time of each
+directory. On each poll, only the directories are stated, and a directory is
+listed again only when its modification time has changed. New and modified
+files are stated until they stop changing (file transfers in progress).
+
+The polling interval is shortened after changes are found, and increased up
+to a maximum while the folder is idle.
+Moved files are reported as deleted and created.
+"""
+import os
+import time
+from functools import partial
+
+from watchdog.events import (
+    DirCreatedEvent, DirDeletedEvent, FileCreatedEvent, FileDeletedEvent, FileModifiedEvent
+    )
+from watchdog.observers.api import DEFAULT_EMITTER_TIMEOUT, DEFAULT_OBSERVER_TIMEOUT, BaseObserver, EventEmitter
+
+
+# Directories modified within this time (ns) from the listing are listed again on the next poll,
+# as later changes may not update the modification time (e.g. 2 s resolution on FAT and some SMB servers)
+MTIME_RESOLUTION_NS = 2 * 10 ** 9
+
+
+def empty_changes():
+    """
+    Changes found on one poll (lists of paths).
+    """
+    return {'files_created': [], 'files_modified': [], 'files_deleted': [],
+            'dirs_created': [], 'dirs_deleted': []}
+
+
+class SnapshotIndex:
+    """
+    In-memory index of a directory tree with the modification time of each directory.
+
+    Parameters
+    ----------
+    root : str or Path
+        Monitored folder.
+    recursive : bool, optional
+        Monitor the subfolders. The default is True.
+
+    """
+
+    def __init__(self, root, recursive=True):
+        self.root = os.fspath(root)
+        self.recursive = recursive
+        # Modification time of each directory (None: list again on next poll)
+        self.dirs = {}
+        # (modification time, size) of the files in each directory
+        self.files = {}
+        # Names of the subdirectories in each directory
+        self.subdirs = {}
+        # Files that are stated on each poll until they stop changing
+        self.pending = {}
+        # Number of file system calls, for benchmarking
+        self.stat_calls = 0
+        self.scandir_calls = 0
+
+    def scan(self):
+        """
+        Indexes the whole tree. No changes are reported.
+        """
+        self.dirs, self.files, self.subdirs, self.pending = {}, {}, {}, {}
+        self._add_tree(self.root, None)
+
+    def poll(self):
+        """
+        Finds the changes since the previous poll.
+
+        Raises
+        ------
+        OSError
+            The monitored folder cannot be accessed.
+
+        Returns
+        -------
+        changes : dict
+            Paths of the created, modified and deleted files and directories.
+
+        """
+        changes = empty_changes()
+
+        # Files that were changing on the previous poll
+        for path, previous in list(self.pending.items()):
+            try:
+                st = os.stat(path)
+                self.stat_calls += 1
+            except OSError:
+                # Deleted files are found from the directory
+                del self.pending[path]
+                continue
+            current = (st.st_mtime_ns, st.st_size)
+            if current == previous:
+                del self.pending[path]
+                continue
+            self.pending[path] = current
+            self.files[os.path.dirname(path)][os.path.basename(path)] = current
+            changes['files_modified'].append(path)
+
+        # Directories are listed only if they have changed
+        for path in list(self.dirs):
+            # Removed with a deleted parent directory
+            if path not in self.dirs:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                self.stat_calls += 1
+            except OSError:
+                if path == self.root:
+                    raise
+                self._remove_tree(path, changes)
+                continue
+            if mtime != self.dirs[path]:
+                self._update_dir(path, changes)
+
+        return changes
+
+    def _list_dir(self, path):
+        """
+        Lists the files (with modification time and size) and subdirectories of a directory.
+        """
+        mtime = os.stat(path).st_mtime_ns
+        self.stat_calls += 1
+        # Changes within the mtime resolution are checked again on the next poll
+        if abs(time.time_ns() - mtime) < MTIME_RESOLUTION_NS:
+            mtime = None
+
+        files, subdirs = {}, set()
+        with os.scandir(path) as entries:
+            self.scandir_calls += 1
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.add(entry.name)
+                        continue
+                    # Free on Windows (returned with the listing)
+                    st = entry.stat(follow_symlinks=False)
+                    self.stat_calls += os.name != 'nt'
+                except OSError:
+                    # Removed during listing
+                    continue
+                files[entry.name] = (st.st_mtime_ns, st.st_size)
+
+        return mtime, files, subdirs
+
+    def _update_dir(self, path, changes):
+        """
+        Lists a changed directory and compares it to the index.
+        """
+        try:
+            mtime, files, subdirs = self._list_dir(path)
+        except OSError:
+            if path == self.root:
+                raise
+            self._remove_tree(path, changes)
+            return
+        old_files = self.files[path]
+        old_subdirs = self.subdirs[path]
+        self.dirs[path], self.files[path], self.subdirs[path] = mtime, files, subdirs
+
+        # Files
+        for name, stat in files.items():
+            file = os.path.join(path, name)
+            if name not in old_files:
+                changes['files_created'].append(file)
+                self.pending[file] = stat
+            elif old_files[name] != stat:
+                changes['files_modified'].append(file)
+                self.pending[file] = stat
+        for name in old_files.keys() - files.keys():
+            file = os.path.join(path, name)
+            changes['files_deleted'].append(file)
+            self.pending.pop(file, None)
+
+        # Subdirectories
+        if not self.recursive:
+            return
+        for name in sorted(subdirs - old_subdirs):
+            self._add_tree(os.path.join(path, name), changes)
+        for name in old_subdirs - subdirs:
+            self._remove_tree(os.path.join(path, name), changes)
+
+    def _add_tree(self, path, changes):
+        """
+        Indexes a directory and its subdirectories.
+        The directory and its files are reported as created if changes is given.
+        """
+        try:
+            mtime, files, subdirs = self._list_dir(path)
+        except OSError:
+            if path == self.root:
+                raise
+            # Removed before listing
+            return
+        self.dirs[path], self.files[path] = mtime, files
+        self.subdirs[path] = subdirs if self.recursive else set()
+
+        if changes is not None:
+            if path != self.root:
+                changes['dirs_created'].append(path)
+            for name, stat in files.items():
+                file = os.path.join(path, name)
+                changes['files_created'].append(file)
+                self.pending[file] = stat
+
+        for name in sorted(self.subdirs[path]):
+            self._add_tree(os.path.join(path, name), changes)
+
+    def _remove_tree(self, path, changes):
+        """
+        Removes a deleted directory and its subdirectories from the index.
+        """
+        for name in self.subdirs.pop(path, ()):
+            self._remove_tree(os.path.join(path, name), changes)
+        for name in self.files.pop(path, {}):
+            file = os.path.join(path, name)
+            changes['files_deleted'].append(file)
+            self.pending.pop(file, None)
+        self.dirs.pop(path, None)
+        changes['dirs_deleted'].append(path)
+
+        # Remove from the parent, if the parent was not listed again
+        parent = os.path.dirname(path)
+        if parent in self.subdirs:
+            self.subdirs[parent].discard(os.path.basename(path))
+
+
+class SnapshotEmitter(EventEmitter):
+    """
+    Emitter that polls the monitored folder using a SnapshotIndex.
+    The events found on one poll are queued together.
+    """
+
+    def __init__(self, event_queue, watch, timeout=DEFAULT_EMITTER_TIMEOUT,
+                 min_interval=1, max_interval=30, **kwargs):
+        super().__init__(event_queue, watch, timeout=timeout, **kwargs)
+        self.index = SnapshotIndex(watch.path, recursive=watch.is_recursive)
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.interval = min_interval
+
+    def on_thread_start(self):
+        self.index.scan()
+
+    def queue_events(self, timeout):
+        # The interval adapts to the activity (timeout is not used)
+        if self.stopped_event.wait(self.interval):
+            return
+
+        try:
+            changes = self.index.poll()
+        except OSError:
+            # Monitored folder removed or the network drive disconnected
+            self.queue_event(DirDeletedEvent(self.index.root))
+            self.stop()
+            return
+
+        for path in changes['files_deleted']:
+            self.queue_event(FileDeletedEvent(path))
+        for path in changes['dirs_deleted']:
+            self.queue_event(DirDeletedEvent(path))
+        for path in changes['dirs_created']:
+            self.queue_event(DirCreatedEvent(path))
+        for path in sorted(changes['files_created']):
+            self.queue_event(FileCreatedEvent(path))
+        for path in sorted(changes['files_modified']):
+            self.queue_event(FileModifiedEvent(path))
+
+        # Poll often during file transfers, back off when idle
+        if any(changes.values()) or self.index.pending:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(2 * self.interval, self.max_interval)
+
+
+class SnapshotObserver(BaseObserver):
+    """
+    Observer polling the monitored folders for changes (see SnapshotIndex).
+
+    Parameters
+    ----------
+    min_interval : float, optional
+        Polling interval (s) after changes are found. The default is 1.
+    max_interval : float, optional
+        Maximum polling interval (s) while the folder is idle. The default is 30.
+
+    """
+
+    def __init__(self, min_interval=1, max_interval=30, timeout=DEFAULT_OBSERVER_TIMEOUT):
+        emitter = partial(SnapshotEmitter, min_interval=min_interval, max_interval=max_interval)
+        super().__init__(emitter, timeout=timeout)
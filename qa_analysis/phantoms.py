@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Custom phantom models for Pylinac. 
+Imported on first use, as importing Pylinac is slow.
+"""
+import os
+import functools
+
+import pylinac
+from pylinac.ct import CatPhan504, CTP404CP504, CTP486, CTP528CP504, CTP515
+from pylinac.winston_lutz import WinstonLutz, WinstonLutz2D
+
+from qa_analysis.constants import AIR, PMP, LDPE, POLY, ACRYLIC, DELRIN, TEFLON
+
+# Custom linearity module (smaller diameter for ROIs)
+class CustomCTP404(CTP404CP504):
+    roi_dist_mm = 58.7  # Default value
+    roi_radius_mm = 4  # Smaller diameter
+    roi_settings = {
+        "Air": {
+            "value": AIR,
+            "angle": -90,
+            "distance": roi_dist_mm,
+            "radius": roi_radius_mm,
+        },
+        "PMP": {
+            "value": PMP,
+            "angle": -120,
+            "distance": roi_dist_mm,
+            "radius": roi_radius_mm,
+        },
+        "LDPE": {
+            "value": LDPE,
+            "angle": 180,
+            "distance": roi_dist_mm,
+            "radius": roi_radius_mm,
+        },
+        "Poly": {
+            "value": POLY,
+            "angle": 120,
+            "distance": roi_dist_mm,
+            "radius": roi_radius_mm,
+        },
+        "Acrylic": {
+            "value": ACRYLIC,
+            "angle": 60,
+            "distance": roi_dist_mm,
+            "radius": roi_radius_mm,
+        },
+        "Delrin": {
+            "value": DELRIN,
+            "angle": 0,
+            "distance": roi_dist_mm,
+            "radius": roi_radius_mm,
+        },
+        "Teflon": {
+            "value": TEFLON,
+            "angle": -60,
+            "distance": roi_dist_mm,
+            "radius": roi_radius_mm,
+        },
+    }
+    background_roi_settings = {
+        "1": {"angle": -30, "distance": roi_dist_mm, "radius": roi_radius_mm},
+        "2": {"angle": -150, "distance": roi_dist_mm, "radius": roi_radius_mm},
+        "3": {"angle": -210, "distance": roi_dist_mm, "radius": roi_radius_mm},
+        "4": {"angle": 30, "distance": roi_dist_mm, "radius": roi_radius_mm},
+    }
+
+
+# then, pass to the CatPhan model
+class CustomCP504(CatPhan504):
+    modules = {
+        CustomCTP404: {"offset": 0},
+        CTP486: {"offset": -65},
+        CTP528CP504: {"offset": 30},
+        CTP515: {"offset": -30},
+    }
+
+
+def get_catphan_model(model):
+    """
+    Returns the Catphan model class for the given name.
+
+    Parameters
+    ----------
+    model : str or type
+        Name of a Pylinac Catphan model (e.g. 'CatPhan504') or 'CustomCP504'.
+        Model classes are returned as they are.
+
+    Returns
+    -------
+    type
+        Catphan model class.
+
+    """
+    if not isinstance(model, str):
+        return model
+    if model in globals():
+        return globals()[model]
+    return getattr(pylinac, model)
+
+
+class QuickCatphan:
+    """
+    Catphan analysis that uses the phantom axis found from the coarse slices when the
+    stack was loaded (stacks.load_sparse_catphan), instead of searching all slices again.
+    """
+
+    def find_phantom_axis(self):
+        axis = getattr(self, 'coarse_axis', None)
+        return axis if axis is not None else super().find_phantom_axis()
+
+
+@functools.lru_cache()
+def quick_model(model):
+    """
+    Catphan model with the HU linearity module (CTP404) only, for the quick daily analysis.
+    Pylinac locates the phantom and analyses only the modules of the model.
+    The phantom axis is taken from the coarse slices of the sparse loading (QuickCatphan).
+
+    Parameters
+    ----------
+    model : str or type
+        Catphan model (see get_catphan_model).
+
+    Returns
+    -------
+    type
+        Subclass of the model with the module at offset 0.
+
+    """
+    model = get_catphan_model(model)
+    modules = {module: config for module, config in model.modules.items() if config['offset'] == 0}
+    return type(f'{model.__name__}Quick', (QuickCatphan, model), {'modules': modules})
+
+
+class StreamedWinstonLutz2D(WinstonLutz2D):
+    """
+    Winston-Lutz image that restores the BB and field localisation cached when the
+    image arrived (see streaming.py), instead of localising them again.
+    """
+    # Analysis settings (bb_size_mm, low_density_bb, open_field) and attributes of the cached localisation
+    localized = None
+
+    def analyze(self, bb_size_mm=5, low_density_bb=False, open_field=False, shift_vector=None):
+        if self.localized is None or shift_vector is not None:
+            return super().analyze(bb_size_mm, low_density_bb, open_field, shift_vector)
+        settings, state = self.localized
+        if settings != (bb_size_mm, low_density_bb, open_field):
+            return super().analyze(bb_size_mm, low_density_bb, open_field, shift_vector)
+        # Same pixel processing as WLBaseImage.analyze (the reports show the processed image)
+        self.check_inversion_by_histogram(percentiles=(0.01, 50, 99.99))
+        self._clean_edges()
+        self.ground()
+        self.normalize()
+        vars(self).update(state)
+
+
+class StreamedWinstonLutz(WinstonLutz):
+    """
+    Winston-Lutz analysis of a session where some images were localised when they arrived.
+
+    Parameters
+    ----------
+    directory : str
+        Folder of the session images.
+    localized : dict, optional
+        Cached localisation of the images by file path (streaming.cached_localization).
+        The default is None (all images are localised).
+
+    """
+    image_type = StreamedWinstonLutz2D
+
+    def __init__(self, directory, localized=None, **kwargs):
+        self.localized = {os.path.normpath(path): value for path, value in (localized or {}).items()}
+        super().__init__(directory, **kwargs)
+
+    def _load_image(self, file, sid, dpi, **kwargs):
+        img = super()._load_image(file, sid, dpi, **kwargs)
+        img.localized = self.localized.get(os.path.normpath(str(file)))
+        return img
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+Read-ahead pipeline of the analysis.
+
+The groups (measurement date, patient) are processed in three stages that run
+at the same time, connected by bounded queues:
+    prefetch    reads the files and headers of the next groups (thread)
+    analysis    detects and runs the tests of a group (current thread)
+    commit      saves the pdf reports, Excel rows and arrays, and moves the files (thread)
+
+The prefetch stage reads the whole files, so the pixel data of the next groups is
+in the OS file cache (e.g. from a network share) when the analysis decodes it.
+At most depth groups are read ahead. The tests send their saving and moving to the
+commit stage with commit(). Outside the pipeline (e.g. in the worker processes)
+commit() runs the function at once.
+
+The busy time of each stage is logged when the pipeline ends.
+"""
+import queue
+import logging
+import threading
+from time import perf_counter
+
+# Pdf reports are drawn one at a time (Matplotlib is not thread-safe)
+REPORT_LOCK = threading.RLock()
+
+# Commit queue of the analysis thread, set while a pipeline runs
+_local = threading.local()
+
+
+def commit(function, *args, **kwargs):
+    """
+    Runs function(*args, **kwargs) in the commit stage of the running pipeline,
+    or at once without a pipeline. The return value is not available.
+    """
+    commits = getattr(_local, 'commits', None)
+    if commits is None:
+        function(*args, **kwargs)
+        return
+    commits.put((function, args, kwargs))
+
+
+def flush():
+    """
+    Waits until the commit stage has run the functions committed so far
+    (e.g. files moved before listing a folder again).
+    """
+    commits = getattr(_local, 'commits', None)
+    if commits is not None:
+        commits.join()
+
+
+def read_ahead(paths, chunk_mb=1):
+    """
+    Reads the files to the OS file cache. Unreadable files are left to the analysis.
+    Returns the number of bytes read.
+    """
+    size = 0
+    for path in paths:
+        try:
+            with open(path, 'rb', buffering=0) as f:
+                while True:
+                    data = f.read(int(chunk_mb * 2 ** 20))
+                    if not data:
+                        break
+                    size += len(data)
+        except OSError:
+            continue
+    return size
+
+
+class Pipeline:
+    """
+    Runs the groups in prefetch, analysis and commit stages.
+
+    Parameters
+    ----------
+    depth : int
+        Number of groups read ahead of the analysis.
+    commit_depth : int, optional
+        Number of analysed groups waiting for the commit stage before the
+        analysis waits. The default is 2.
+
+    """
+
+    def __init__(self, depth, commit_depth=2):
+        self.prefetched = queue.Queue(maxsize=max(1, depth))
+        self.commits = queue.Queue(maxsize=max(1, commit_depth))
+        self.stop = threading.Event()
+        # Busy time (s) of each stage
+        self.busy = {'prefetch': 0.0, 'analysis': 0.0, 'commit': 0.0}
+        # First unexpected error of the threads, raised in the analysis thread
+        self.error = None
+
+    def prefetch(self, jobs, order, read):
+        """
+        Prefetch stage: reads the groups in the order of the scheduler.
+        """
+        # Analysis logger
+        logger_a = logging.getLogger('qa.analysis')
+
+        try:
+            while len(jobs) > 0 and not self.stop.is_set():
+                # Priorities change while jobs wait (aging)
+                key, paths = order(jobs)[0]
+                jobs = [job for job in jobs if job[0] != key]
+                start = perf_counter()
+                item = (key, read(paths))
+                self.busy['prefetch'] += perf_counter() - start
+                # Waits while depth groups are ready
+                while not self.stop.is_set():
+                    try:
+                        self.prefetched.put(item, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            logger_a.error(f'Prefetch stopped due to error {e}')
+            self.error = self.error or e
+        finally:
+            # End of the jobs, not waited for when the analysis has stopped
+            while True:
+                try:
+                    self.prefetched.put(None, timeout=0.5)
+                    break
+                except queue.Full:
+                    if self.stop.is_set():
+                        break
+
+    def commit(self):
+        """
+        Commit stage: runs the committed functions in order.
+        """
+        # Analysis logger
+        logger_a = logging.getLogger('qa.analysis')
+
+        while True:
+            task = self.commits.get()
+            if task is None:
+                self.commits.task_done()
+                return
+            function, args, kwargs = task
+            start = perf_counter()
+            try:
+                function(*args, **kwargs)
+            # Errors of saving one group do not stop the other groups (as in analyze_group)
+            except (KeyError, ValueError, ZeroDivisionError, OSError) as e:
+                logger_a.debug(f'Cannot save results due to error {e}')
+            except Exception as e:
+                logger_a.error(f'Commit stopped due to error {e}')
+                self.error = self.error or e
+            finally:
+                self.busy['commit'] += perf_counter() - start
+                self.commits.task_done()
+
+    def run(self, jobs, order, read, analyze):
+        """
+        Runs the jobs through the stages.
+
+        Parameters
+        ----------
+        jobs : list
+            (key, paths) of each group.
+        order : callable
+            Sorts the jobs by priority (PriorityScheduler.order).
+        read : callable
+            Prefetch of a group, read(paths).
+        analyze : callable
+            Analysis of a group, analyze(key, prefetched).
+
+        Returns
+        -------
+        results : list
+            (key, result of analyze) of each group, in the order of the analysis.
+
+        """
+        # Analysis logger
+        logger_a = logging.getLogger('qa.analysis')
+
+        start = perf_counter()
+        prefetcher = threading.Thread(target=self.prefetch, args=(list(jobs), order, read),
+                                      name='qa-prefetch', daemon=True)
+        committer = threading.Thread(target=self.commit, name='qa-commit', daemon=True)
+        prefetcher.start()
+        committer.start()
+
+        results = []
+        _local.commits = self.commits
+        try:
+            while self.error is None:
+                item = self.prefetched.get()
+                if item is None:
+                    break
+                key, prefetched = item
+                started = perf_counter()
+                try:
+                    results.append((key, analyze(key, prefetched)))
+                finally:
+                    self.busy['analysis'] += perf_counter() - started
+        finally:
+            _local.commits = None
+            self.stop.set()
+            # Results of the analysed groups are saved before returning
+            self.commits.put(None)
+            committer.join()
+            prefetcher.join()
+
+            wall = max(perf_counter() - start, 1e-9)
+            utilisation = ', '.join(f'{name} {busy / wall:.0%}' for name, busy in self.busy.items())
+            logger_a.info(f'Pipeline: {len(results)} groups in {wall:.1f} s, busy {utilisation}, '
+                          f'overlap {sum(self.busy.values()) / wall:.2f}')
+
+        if self.error is not None:
+            raise self.error
+        return results
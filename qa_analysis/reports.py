@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Pdf reports of the tests.
+
+The reports are drawn by Pylinac (publish_pdf), which rasterises the Matplotlib
+figures of the analysed images into the pdf. publish_report draws a report
+    - one at a time (REPORT_LOCK, Matplotlib is not thread-safe)
+    - with the non-interactive Agg backend, unless the results are plotted
+    - at the figure DPI of the report mode (REPORT_DPI): the analysed images are
+      resampled to the figure pixels, so the DPI sets the size of the report
+    - with the logo read once per process
+and closes the figures of the report. The render time and file size are logged.
+    full    Matplotlib default resolution (100 dpi)
+    light   smaller reports for slow network shares (REPORT_DPI['light'])
+"""
+import os
+import logging
+import functools
+from time import perf_counter
+
+from qa_analysis.constants import REPORT_DPI
+from qa_analysis.pipeline import REPORT_LOCK
+
+
+def report_dpi(args):
+    """
+    Figure DPI of the reports from the input arguments (report_dpi, or the DPI of report_mode).
+    None for the Matplotlib default.
+    """
+    dpi = getattr(args, 'report_dpi', None)
+    return dpi if dpi is not None else REPORT_DPI[getattr(args, 'report_mode', 'full')]
+
+
+@functools.lru_cache()
+def report_logo():
+    """
+    Pylinac logo of the report header, read once and shared by the reports.
+    """
+    from pylinac.core.pdf import get_logo
+    from reportlab.lib.utils import ImageReader
+
+    return ImageReader(str(get_logo()))
+
+
+def publish_report(analysis, path, dpi=None, plot=False, **kwargs):
+    """
+    Draws the pdf report of an analysis.
+
+    Parameters
+    ----------
+    analysis : TYPE
+        Analysed Pylinac test (e.g. WinstonLutz).
+    path : str
+        Pdf file.
+    dpi : float, optional
+        Figure DPI of the report (see report_dpi). The default is None (Matplotlib default).
+    plot : bool, optional
+        Results are plotted, the backend is not changed. The default is False.
+    **kwargs
+        Passed to publish_pdf (e.g. notes).
+
+    Returns
+    -------
+    elapsed : float
+        Render time (s).
+    size : int
+        File size (bytes).
+
+    """
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    # Test logger
+    logger_t = logging.getLogger('qa.test')
+
+    settings = {} if dpi is None else {'savefig.dpi': dpi}
+    with REPORT_LOCK:
+        if not plot and matplotlib.get_backend().lower() != 'agg':
+            plt.switch_backend('Agg')
+        figures = set(plt.get_fignums())
+        start = perf_counter()
+        try:
+            with matplotlib.rc_context(settings):
+                analysis.publish_pdf(path, logo=report_logo(), **kwargs)
+        finally:
+            # Figures of the report are left open by Pylinac
+            for number in set(plt.get_fignums()) - figures:
+                plt.close(number)
+        elapsed = perf_counter() - start
+
+    size = os.path.getsize(path)
+    logger_t.info(f'Report {os.path.basename(path)} drawn in {elapsed:.1f} s, {size / 2 ** 10:.0f} kB')
+    return elapsed, size
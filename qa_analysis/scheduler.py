@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+Priority scheduling of the analysis jobs.
+
+Groups are started by priority instead of date order, so that short linac tests
+(T2/T3, Winston-Lutz) do not wait behind long CT and MR analyses. The priority
+of a group (lower runs first) is
+
+    TEST_PRIORITY[modality] + estimated memory / PRIORITY_COST_MB - waiting time / PRIORITY_AGING_S
+
+The estimated memory (admission.py) is used as the cost, as the analysis time
+grows with the number of pixels. The waiting time is counted from the arrival
+of the last file of the group, so a long analysis is not starved by new short ones.
+The waiting time of each job is logged and saved as a csv file.
+"""
+import os
+import csv
+import logging
+from datetime import datetime
+from time import time
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+from qa_analysis.constants import TEST_PRIORITY, TEST_DEFAULT_PRIORITY, PRIORITY_COST_MB, PRIORITY_AGING_S
+
+
+def parse_priorities(items):
+    """
+    Priorities from the command line, e.g. ['RTIMAGE=0', 'CT=3'].
+    Modalities that are not given keep the TEST_PRIORITY values.
+    """
+    priorities = dict(TEST_PRIORITY)
+    for item in items or []:
+        modality, _, value = item.partition('=')
+        if value == '':
+            raise ValueError(f'Priority should be given as MODALITY=VALUE, not {item}')
+        priorities[modality.upper()] = float(value)
+    return priorities
+
+
+def group_modality(paths):
+    """
+    Modality of a group from the first readable header ('' if none).
+    """
+    for path in paths:
+        try:
+            ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=[(0x0008, 0x0060)])
+            return str(ds.get('Modality', ''))
+        except (InvalidDicomError, OSError):
+            continue
+    return ''
+
+
+def arrival_time(paths):
+    """
+    Modification time of the last file of a group (time when the group was complete).
+    """
+    times = []
+    for path in paths:
+        try:
+            times.append(os.path.getmtime(path))
+        except OSError:
+            continue
+    return max(times) if len(times) > 0 else time()
+
+
+class PriorityScheduler:
+    """
+    Orders the analysis jobs by test type, estimated cost and waiting time.
+
+    Parameters
+    ----------
+    priorities : dict, optional
+        Priority of each modality (lower runs first). The default is TEST_PRIORITY.
+    aging_s : float, optional
+        Waiting time (s) that raises the priority by one. The default is PRIORITY_AGING_S.
+    cost_mb : float, optional
+        Estimated memory (MB) that lowers the priority by one. The default is PRIORITY_COST_MB.
+    wait_log : Path, optional
+        csv file for the waiting times of the jobs. The default is None (logged only).
+
+    """
+
+    def __init__(self, priorities=None, aging_s=PRIORITY_AGING_S, cost_mb=PRIORITY_COST_MB, wait_log=None):
+        self.priorities = TEST_PRIORITY if priorities is None else priorities
+        self.aging_s = aging_s
+        self.cost_mb = cost_mb
+        self.wait_log = wait_log
+        # Modality, estimated memory (MB) and arrival time of each job
+        self.jobs = {}
+        # Waiting time (s) of each started job
+        self.waits = {}
+
+    def add(self, key, paths, memory):
+        """
+        Adds a group to the scheduler. Reads the modality of the group.
+        """
+        self.jobs[key] = (group_modality(paths), memory, arrival_time(paths))
+
+    def priority(self, key, now=None):
+        """
+        Priority of a job (lower runs first).
+        """
+        modality, memory, ready = self.jobs[key]
+        waited = max(0, (time() if now is None else now) - ready)
+        return (self.priorities.get(modality, TEST_DEFAULT_PRIORITY) + memory / self.cost_mb
+                - waited / self.aging_s)
+
+    def order(self, jobs):
+        """
+        Sorts jobs (key first in each job) by the current priority. Equal priorities keep their order.
+        """
+        now = time()
+        return sorted(jobs, key=lambda job: self.priority(job[0], now))
+
+    def started(self, key):
+        """
+        Records the waiting time of a job when it starts.
+        """
+        # Analysis logger
+        logger_a = logging.getLogger('qa.analysis')
+
+        modality, memory, ready = self.jobs[key]
+        now = time()
+        self.waits[key] = now - ready
+        logger_a.info(f'Starting {key} ({modality or "unknown"}, priority {self.priority(key, now):.2f}) '
+                      f'after waiting {self.waits[key]:.1f} s')
+
+        if self.wait_log is None:
+            return
+        # The analysis is not stopped if saving fails
+        try:
+            new = not os.path.isfile(self.wait_log)
+            with open(self.wait_log, 'a', newline='') as f:
+                writer = csv.writer(f)
+                if new:
+                    writer.writerow(['started', 'date', 'patient', 'modality', 'memory_mb', 'wait_s'])
+                date, patient = key
+                writer.writerow([datetime.fromtimestamp(now).isoformat(timespec='seconds'), date, patient,
+                                 modality, round(memory), round(self.waits[key], 1)])
+        except OSError as e:
+            logger_a.debug(f'Waiting time of {key} not saved due to error {e}')
@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+Loading of CT and MR image stacks.
+
+Pylinac decodes every slice of a CT series before the analysis, although the
+Catphan modules cover only a few centimetres of the scan. The stack here reads
+the DICOM headers of all slices, and pixel data is decoded only for the slices
+that are needed for locating the phantom and analysing the modules.
+
+Uncompressed pixel data can be memory-mapped instead of decoded. Pages of the
+files are then read when touched, and the OS page cache is shared between
+processes analysing the same series. Compressed slices (e.g. RLE or JPEG) can
+be decoded in parallel in a pool of processes (workers.decode_pool).
+"""
+import logging
+import weakref
+import numpy as np
+import pydicom
+from pydicom.filereader import data_element_offset_to_value
+from pydicom.uid import ImplicitVRLittleEndian, ExplicitVRLittleEndian
+from pylinac.core.image import (BaseImage, DicomImage, LazyDicomImageStack, 
+                                z_position, _rescale_dicom_values)
+
+from qa_analysis.workers import decode_pixels
+
+# Length (mm) of the HU linearity module. The module is decoded whole, 
+# so that the origin slice is the same as with all slices decoded.
+HU_MODULE_MM = 25
+
+
+class HeaderImage(DicomImage):
+    """
+    Slice of a stack with the DICOM header only. The pixel data is not decoded,
+    and the image array is empty (zeros), so that the phantom is not found from it.
+    """
+
+    def __init__(self, path, metadata):
+        init_header(self, path, metadata)
+        self._original_dtype = np.int16
+        # Zeros are allocated lazily by the OS, empty slices take no memory until written
+        self.array = np.zeros((metadata.Rows, metadata.Columns), dtype=np.int16)
+
+
+class DecodedDicomImage(DicomImage):
+    """
+    Slice from decoded pixel values. The file is not read again
+    (DicomImage reads and decodes the file twice).
+    """
+
+    def __init__(self, path, metadata, pixels, dtype=None):
+        init_header(self, path, metadata)
+        self._original_dtype = pixels.dtype
+        if dtype is not None:
+            pixels = pixels.astype(dtype)
+        self.array = _rescale_dicom_values(pixels, metadata, raw_pixels=False)
+
+
+class MappedDicomImage(DicomImage):
+    """
+    Slice with the pixel data memory-mapped from an uncompressed file.
+    The rescaled values (e.g. HU) are computed from the mapped data when the array is used.
+    The array is reused while it is referenced elsewhere, and kept in memory only
+    if it is replaced (e.g. image roll).
+    """
+
+    def __init__(self, path, metadata, dtype=None):
+        init_header(self, path, metadata)
+        self._dtype = dtype
+        self._array = None
+        self._rescaled = lambda: None
+        self._pixels = map_pixel_data(path, metadata)
+        self._original_dtype = self._pixels.dtype
+
+    @property
+    def array(self):
+        if self._array is not None:
+            return self._array
+        array = self._rescaled()
+        if array is None:
+            pixels = self._pixels if self._dtype is None else self._pixels.astype(self._dtype)
+            array = _rescale_dicom_values(pixels, self.metadata, raw_pixels=False)
+            self._rescaled = weakref.ref(array)
+        return array
+
+    @array.setter
+    def array(self, value):
+        self._array = value
+
+
+def init_header(img, path, metadata):
+    """
+    Sets the attributes of a Pylinac DicomImage from the path and header, without reading the file.
+    """
+    BaseImage.__init__(img, path)
+    img._sid = None
+    img._dpi = None
+    img._sad = 1000
+    img._raw_pixels = False
+    img.metadata = metadata
+
+
+def can_map(metadata):
+    """
+    Checks if the pixel data of a DICOM file can be memory-mapped:
+    uncompressed little endian, one frame of grayscale values in whole bytes.
+    """
+    syntax = getattr(getattr(metadata, 'file_meta', None), 'TransferSyntaxUID', ImplicitVRLittleEndian)
+    signed = metadata.get('PixelRepresentation', 0) == 1
+    return (syntax in (ImplicitVRLittleEndian, ExplicitVRLittleEndian)
+            and metadata.get('SamplesPerPixel', 1) == 1
+            and int(metadata.get('NumberOfFrames', 1) or 1) == 1
+            and metadata.get('BitsAllocated') in (8, 16, 32)
+            # Signed values with unused high bits would need sign extension
+            and not (signed and metadata.get('BitsStored') != metadata.BitsAllocated))
+
+
+def map_pixel_data(path, metadata):
+    """
+    Memory-maps the pixel data of an uncompressed DICOM file (read only).
+
+    Parameters
+    ----------
+    path : str
+        DICOM file.
+    metadata : pydicom.Dataset
+        Header of the file.
+
+    Returns
+    -------
+    numpy.memmap
+        Pixel values (Rows x Columns).
+
+    """
+    # File position of the pixel data element
+    with open(path, 'rb') as f:
+        ds = pydicom.dcmread(f, stop_before_pixels=True, force=True)
+        offset = f.tell() + data_element_offset_to_value(ds.is_implicit_VR, 'OW')
+    
+    kind = 'i' if metadata.PixelRepresentation == 1 else 'u'
+    dtype = np.dtype(f'<{kind}{metadata.BitsAllocated // 8}')
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, 
+                     shape=(metadata.Rows, metadata.Columns))
+
+
+class SparseDicomImageStack(LazyDicomImageStack):
+    """
+    DICOM stack where the pixel data is decoded only for selected slices.
+    The other slices are kept as headers (HeaderImage), so that the slice numbers
+    and positions are the same as for a fully loaded stack.
+    With mapped=True, uncompressed slices are memory-mapped instead of decoded.
+    The headers are read once and shared by the slices.
+    """
+
+    def __init__(self, folder, dtype=None, min_number=39, check_uid=True, mapped=False):
+        super().__init__(folder, dtype, min_number, check_uid)
+        self.mapped = mapped
+        self.images = [HeaderImage(path, metadata) for path, metadata
+                       in zip(self._image_path_keys, self.metadatas)]
+
+    @classmethod
+    def from_stack(cls, stack, mapped=False):
+        """
+        Sparse stack from the headers of a LazyDicomImageStack, without reading the files again.
+        """
+        sparse = cls.__new__(cls)
+        sparse.dtype = stack.dtype
+        sparse.mapped = mapped
+        sparse.metadatas = list(stack.metadatas)
+        sparse._image_path_keys = list(stack._image_path_keys)
+        sparse.images = [HeaderImage(path, metadata) for path, metadata
+                         in zip(sparse._image_path_keys, sparse.metadatas)]
+        return sparse
+
+    def is_decoded(self, index):
+        return not isinstance(self.images[index], HeaderImage)
+
+    def decode(self, indices, pool=None):
+        """
+        Decodes (or maps) the pixel data of the slices in indices. Decoded slices are skipped.
+
+        Parameters
+        ----------
+        indices : iterable
+            Slice numbers.
+        pool : Executor, optional
+            Pool for decoding the slices in parallel (workers.decode_pool).
+            The default is None (decoded in this process).
+
+        """
+        decode = []
+        for i in indices:
+            if self.is_decoded(i):
+                continue
+            if self.mapped and can_map(self.metadatas[i]):
+                self.images[i] = MappedDicomImage(self._image_path_keys[i], self.metadatas[i], dtype=self.dtype)
+            else:
+                decode.append(i)
+
+        # Slices are assembled in slice order
+        paths = [self._image_path_keys[i] for i in decode]
+        decoded = map(decode_pixels, paths) if pool is None else pool.map(decode_pixels, paths, chunksize=4)
+        for i, pixels in zip(decode, decoded):
+            self.images[i] = DecodedDicomImage(self._image_path_keys[i], self.metadatas[i], pixels, dtype=self.dtype)
+
+    def release(self, indices):
+        """
+        Replaces the decoded slices in indices with headers, frees the pixel data.
+        """
+        for i in indices:
+            if self.is_decoded(i):
+                self.images[i] = HeaderImage(self._image_path_keys[i], self.metadatas[i])
+
+    def close(self):
+        """
+        Frees the pixel data and closes the memory-mapped files, e.g. before the files are moved.
+        """
+        self.release(range(len(self)))
+
+    def save_headers(self):
+        """
+        Saves the (modified) headers to the files. Pixel data is copied as it is, without decoding.
+        """
+        for path, metadata in zip(self._image_path_keys, self.metadatas):
+            ds = pydicom.dcmread(path, force=True)
+            ds.update(metadata)
+            ds.save_as(path)
+
+    @property
+    def paths(self):
+        return list(self._image_path_keys)
+
+    def view(self, step):
+        """
+        Stack of every step-th slice. The images are shared with this stack.
+        """
+        view = SparseDicomImageStack.__new__(SparseDicomImageStack)
+        view.dtype = self.dtype
+        view.mapped = self.mapped
+        view.metadatas = self.metadatas[::step]
+        view._image_path_keys = self._image_path_keys[::step]
+        view.images = self.images[::step]
+        return view
+
+    @property
+    def decoded(self):
+        """
+        Indices of the decoded slices.
+        """
+        return [i for i in range(len(self)) if self.is_decoded(i)]
+
+    def roll(self, direction, amount):
+        for img in self.images:
+            img.roll(direction, amount)
+
+    def __getitem__(self, item):
+        return self.images[item]
+
+    def __setitem__(self, key, value):
+        self.images[key] = value
+
+    def __delitem__(self, key):
+        """
+        Deletes the image from the stack. Files are not removed.
+        """
+        del self.images[key]
+        del self.metadatas[key]
+        del self._image_path_keys[key]
+
+    def __len__(self):
+        return len(self.images)
+
+
+def load_headers(model, folder, mapped=False):
+    """
+    Loads a Pylinac CT or MR phantom (e.g. CatPhan504, ACRMRILarge) with the DICOM headers only.
+    Pixel data is loaded with phantom.dicom_stack.decode().
+
+    Parameters
+    ----------
+    model : class
+        Pylinac phantom class.
+    folder : str or list
+        Folder of the image series, or the files of the series.
+    mapped : bool, optional
+        Memory-map uncompressed pixel data instead of decoding. The default is False.
+
+    Returns
+    -------
+    phantom : model
+        Phantom object with a SparseDicomImageStack.
+
+    """
+    phantom = model(folder, memory_efficient_mode=True)
+    phantom.dicom_stack = SparseDicomImageStack.from_stack(phantom.dicom_stack, mapped=mapped)
+    return phantom
+
+
+def load_phantom(model, folder, mapped=False, pool=None):
+    """
+    Loads a Pylinac CT or MR phantom with all slices decoded (or memory-mapped),
+    optionally in a decoding pool. See load_headers.
+    """
+    phantom = load_headers(model, folder, mapped=mapped)
+    phantom.dicom_stack.decode(range(len(phantom.dicom_stack)), pool=pool)
+    return phantom
+
+
+def load_sparse_catphan(model, folder, margin_mm=5, step_mm=6, mapped=False, pool=None):
+    """
+    Loads a Catphan CT series, decoding only the slices near the phantom modules.
+
+    Headers are read for all slices. The HU linearity module (origin) is located
+    from a coarse subset of slices, and the slices within margin_mm of
+    the module offsets (model.modules) are decoded. All slices are decoded
+    if the origin is not found.
+
+    Parameters
+    ----------
+    model : class
+        Pylinac Catphan class, e.g. CatPhan504 or CustomCP504.
+    folder : str or list
+        Folder of the CT series, or the files of the series.
+    margin_mm : float, optional
+        Decoded distance (mm) from the module centres. The default is 5.
+    step_mm : float, optional
+        Slice interval (mm) for locating the phantom. The default is 6.
+    mapped : bool, optional
+        Memory-map uncompressed pixel data instead of decoding. The default is False.
+    pool : Executor, optional
+        Pool for decoding the slices (workers.decode_pool). The default is None.
+
+    Returns
+    -------
+    cbct : model
+        Catphan object, ready for cbct.analyze(). In the side view of the report,
+        only the decoded slices are shown.
+
+    """
+    # Test logger
+    logger_t = logging.getLogger('qa.test')
+
+    # Headers only
+    cbct = load_headers(model, folder, mapped=mapped)
+    stack = cbct.dicom_stack
+    z = np.array([z_position(m) for m in stack.metadatas])
+
+    # Coarse view of every half step. Pylinac searches the origin from even slices
+    # of the view, which are decoded.
+    spacing = stack.slice_spacing
+    half = max(1, int(round(step_mm / spacing / 2)))
+    step = 2 * half
+    stack.decode(range(0, len(stack), step), pool=pool)
+    cbct.dicom_stack = stack.view(half)
+
+    # Locate the HU linearity module
+    try:
+        cbct._phantom_center_func = cbct.find_phantom_axis()
+        # Phantom axis by slice number of the stack (used by the quick analysis, phantoms.quick_model)
+        cbct.coarse_axis = tuple(np.poly1d(fit.coeffs / half ** np.arange(fit.order, -1, -1))
+                                 for fit in cbct._phantom_center_func)
+        origin = cbct.find_origin_slice() * half
+    except (ValueError, TypeError, IndexError, np.linalg.LinAlgError):
+        origin = None
+    finally:
+        # Located again from the decoded slices in cbct.analyze()
+        cbct.dicom_stack = stack
+        cbct._phantom_center_func = None
+
+    if origin is None:
+        logger_t.debug(f'Catphan origin not found from {len(stack.decoded)} slices, decoding all slices.')
+        stack.decode(range(len(stack)), pool=pool)
+        return cbct
+
+    # Slices near the modules, accounting for the coarse origin
+    keep = np.zeros(len(stack), dtype=bool)
+    for config in model.modules.values():
+        margin = max(margin_mm, HU_MODULE_MM / 2) if config['offset'] == 0 else margin_mm
+        keep |= np.abs(z - (z[origin] + config['offset'])) <= margin + step * spacing / 2
+
+    stack.release(np.flatnonzero(~keep))
+    stack.decode(np.flatnonzero(keep), pool=pool)
+    logger_t.debug(f'Decoded {keep.sum()} of {len(stack)} Catphan slices.')
+
+    return cbct
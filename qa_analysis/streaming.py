@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming Winston-Lutz analysis.
+
+The images of a Winston-Lutz session arrive one by one while the session is acquired.
+While the session is incomplete (deferred, see validation.py), the BB and the field of
+each new image are localised and the result is cached in the results folder, by
+SOPInstanceUID, BB size and Pylinac version (the cached attributes are Pylinac objects).
+A cache file written by another Pylinac version is an error. The session is complete when
+the last expected angle arrives (WL_EXPECTED_AXES) or, for other machines, at WL_MIN_IMAGES
+images when no new image has arrived in WL_SETTLE_S.
+winston_analysis then restores the cached images (phantoms.StreamedWinstonLutz), so
+only the last images and the isocenter and wobble computation are left.
+
+The cache of a session is removed when its results are saved. Cache files older than
+twice DEFER_MAX_S are from rejected sessions and are removed when new images arrive.
+"""
+import os
+import pickle
+import logging
+from glob import glob
+from time import time, perf_counter
+
+import pydicom
+from pydicom.errors import InvalidDicomError
+
+from qa_analysis.constants import DEFER_MAX_S
+
+# Cache folder in the results folder
+CACHE_FOLDER = 'Winston-Lutz cache'
+
+# SOP Instance UID tag (key of the cache)
+SOP_INSTANCE_UID = (0x0008, 0x0018)
+
+# Attributes set by WinstonLutz2D.analyze, restored from the cache
+LOCALIZED = ['bb_arrangement', 'arrangement_matches', 'field_cax', 'bb', '_is_analyzed']
+
+
+def pylinac_version():
+    """
+    Version of the installed Pylinac (key of the cache).
+    """
+    import pylinac
+
+    return pylinac.__version__
+
+
+def cache_path(save_path, uid, bb_size_mm):
+    """
+    Cache file of an image localised with a BB size and the installed Pylinac.
+    """
+    return os.path.join(str(save_path), CACHE_FOLDER, f'{uid}_{bb_size_mm:g}mm_pylinac{pylinac_version()}.pkl')
+
+
+def instance_uid(path):
+    """
+    SOPInstanceUID of an image file, None if not readable.
+    """
+    try:
+        ds = pydicom.dcmread(path, stop_before_pixels=True, specific_tags=[SOP_INSTANCE_UID])
+    except (InvalidDicomError, OSError):
+        return None
+    return ds.get('SOPInstanceUID')
+
+
+def localize(path, args, uid=None):
+    """
+    Localises the BB and the field of an RT image and caches the result.
+
+    Parameters
+    ----------
+    path : str
+        Image file.
+    args : TYPE
+        Input arguments (bb_size_mm and save_path).
+    uid : str, optional
+        SOPInstanceUID of the image. The default is None (read from the file).
+
+    Returns
+    -------
+    bool
+        True if the image was localised, False if it was cached already or could not be localised.
+
+    """
+    from qa_analysis.phantoms import StreamedWinstonLutz2D
+
+    # Test logger
+    logger_t = logging.getLogger('qa.test')
+
+    uid = uid or instance_uid(path)
+    if uid is None:
+        return False
+    cache = cache_path(args.save_path, uid, args.bb_size_mm)
+    if os.path.isfile(cache):
+        return False
+
+    # Analysis settings of winston_analysis
+    settings = (args.bb_size_mm, False, False)
+    try:
+        img = StreamedWinstonLutz2D(path)
+        img.analyze(*settings)
+    # The final analysis localises the image again and reports the error
+    except (ValueError, KeyError, AttributeError, OSError) as e:
+        logger_t.debug(f'{os.path.basename(path)} not localised due to error {e}')
+        return False
+
+    state = {name: getattr(img, name) for name in LOCALIZED}
+    temp = f'{cache}.tmp'
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        with open(temp, 'wb') as f:
+            pickle.dump((pylinac_version(), settings, state), f)
+        os.replace(temp, cache)
+    except OSError as e:
+        logger_t.debug(f'Localisation of {os.path.basename(path)} not cached due to error {e}')
+        return False
+    return True
+
+
+def localize_session(test_images, headers, args):
+    """
+    Localises the new images of a deferred Winston-Lutz session (stream function of
+    the detector, see detectors.py).
+
+    Parameters
+    ----------
+    test_images : dict
+        Images found by classify_headers.
+    headers : list
+        DicomHeaders of the patient in the measurement date.
+    args : TYPE
+        Input arguments.
+
+    Returns
+    -------
+    int
+        Number of images localised.
+
+    """
+    # Test logger
+    logger_t = logging.getLogger('qa.test')
+
+    # Cache of rejected sessions
+    expired = time() - 2 * DEFER_MAX_S
+    for path in glob(os.path.join(str(args.save_path), CACHE_FOLDER, '*.pkl')):
+        try:
+            if os.path.getmtime(path) < expired:
+                os.remove(path)
+        except OSError:
+            continue
+
+    start = perf_counter()
+    folder = os.path.dirname(test_images['winston'].path)
+    localized = 0
+    for header in headers:
+        if os.path.dirname(header.path) == folder and header.get_value((0x0008, 0x0060)) == 'RTIMAGE':
+            localized += localize(header.path, args, header.get_value(SOP_INSTANCE_UID))
+    if localized > 0:
+        logger_t.info(f'Winston-Lutz: {localized} new images localised in {perf_counter() - start:.1f} s '
+                      f'while the session arrives')
+    return localized
+
+
+def cached_localization(paths, args):
+    """
+    Cached localisation of the images.
+
+    Parameters
+    ----------
+    paths : list
+        Image files of the session.
+    args : TYPE
+        Input arguments (bb_size_mm and save_path).
+
+    Returns
+    -------
+    localized : dict
+        (settings, attributes) of each cached image by file path.
+    uids : list
+        SOPInstanceUIDs of the readable images (see clear_cache).
+
+    Raises
+    ------
+    RuntimeError
+        A cache file was written by another Pylinac version.
+
+    """
+    version = pylinac_version()
+    localized, uids = {}, []
+    for path in paths:
+        uid = instance_uid(path)
+        if uid is None:
+            continue
+        uids.append(uid)
+        cache = cache_path(args.save_path, uid, args.bb_size_mm)
+        # Images that are not cached are localised in the analysis
+        if not os.path.isfile(cache):
+            continue
+        with open(cache, 'rb') as f:
+            cached, settings, state = pickle.load(f)
+        if cached != version:
+            raise RuntimeError(f'{os.path.basename(cache)} was cached with Pylinac {cached}, '
+                               f'Pylinac {version} is installed')
+        localized[path] = (settings, state)
+    return localized, uids
+
+
+def clear_cache(uids, args):
+    """
+    Removes the cached localisation of the images (results of the session saved).
+    """
+    for uid in uids:
+        try:
+            os.remove(cache_path(args.save_path, uid, args.bb_size_mm))
+        except OSError:
+            continue
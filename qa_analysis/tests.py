@@ -4,20 +4,25 @@ Created on Mon Apr 22 10:32:35 2024
 
 @author: rytkysan
 """
-from pylinac import DRGS, DRMLC, WinstonLutz, ACRMRILarge
 import numpy as np
 import os
 import logging
 from pathlib import Path
 from time import time
 
-from pylinac import image
-
-from qa_analysis.utilities import wait_user_close, move_file, save_excel
+from qa_analysis.utilities import wait_user_close, move_processed, save_excel
+from qa_analysis.arrays import (
+    save_arrays, load_arrays, measurement_time, catphan_arrays, catphan_quick_arrays, winston_arrays
+    )
+from qa_analysis.constants import CATPHAN_QUICK_MACHINES, CATPHAN_QUICK_SERIES, CATPHAN_FULL_INTERVAL_DAYS
+from qa_analysis.pipeline import commit, flush
+from qa_analysis.reports import publish_report, report_dpi
+from qa_analysis.streaming import clear_cache
+from qa_analysis.manifest import pending_files, series_source, folder_series
 
 
 def drgs_test(mlc, open_im, tol=1.5, savepath=None, pdf=False, plot=False, precision=5,
-              segment_size=None, roi=None, rep_dir='T2-T3 reports'):
+              segment_size=None, roi=None, rep_dir='T2-T3 reports', dpi=None, rep_name='t2'):
     """
     Dose-rate and Gantry speed tests (T2 tests).
     Pylinac should automatically identify open beam and MLC images.
@@ -41,6 +46,10 @@ def drgs_test(mlc, open_im, tol=1.5, savepath=None, pdf=False, plot=False, preci
         Sets the size for analysis segments in mm.
     roi: dict, optional
         Sets the offset positions and names for analysis segments.
+    dpi : float, optional
+        Figure DPI of the pdf report (see reports.py). The default is None (Matplotlib default).
+    rep_name : str, optional
+        End of the report name, 't2dr' for the Halcyon dose rate test. The default is 't2'.
     Returns
     -------
     dict
@@ -48,6 +57,9 @@ def drgs_test(mlc, open_im, tol=1.5, savepath=None, pdf=False, plot=False, preci
 
     """
     
+    # Pylinac is imported when the test is run (slow import)
+    from pylinac import DRGS
+    
     # Test logger
     logger_t = logging.getLogger('qa.test')
     logger_t.info(f"Running DRGS test for {Path(mlc.path).name}")
@@ -68,13 +80,15 @@ def drgs_test(mlc, open_im, tol=1.5, savepath=None, pdf=False, plot=False, preci
     
     # Save results
     if pdf and savepath is not None:
-        report_name =f'{mlc.metadata.PatientID}_{mlc.metadata.SeriesDate}_{mlc.metadata.SeriesTime}_t3.pdf'
+        report_name = f'{mlc.metadata.PatientID}_{mlc.metadata.SeriesDate}_{mlc.metadata.SeriesTime}_{rep_name}.pdf'
         (savepath / rep_dir).mkdir(exist_ok=True)  # Make reports directory
         path = str(savepath / rep_dir / report_name)
         if wait_user_close(path):
-            drgs.publish_pdf(path, notes=[f'Device: {mlc.metadata.StationName}', f'Operator: {mlc.metadata.OperatorsName}'])
+            publish_report(drgs, path, dpi, plot, notes=[f'Device: {mlc.metadata.StationName}', f'Operator: {mlc.metadata.OperatorsName}'])
         
     res = drgs.results_data(as_dict=True)
+    # Segment data is an iterator, a list can be reused and sent between processes
+    res['segment_data'] = list(res['segment_data'])
     
     # Round to given precision
     res['max_deviation_percent'] = np.round(res['max_deviation_percent'], precision)
@@ -84,7 +98,7 @@ def drgs_test(mlc, open_im, tol=1.5, savepath=None, pdf=False, plot=False, preci
    
      
 def drmlc_test(mlc, open_im, tol=1.5, savepath=None, pdf=False, plot=False, precision=5,
-               segment_size=None, roi=None, rep_dir='T2-T3 reports'):
+               segment_size=None, roi=None, rep_dir='T2-T3 reports', dpi=None):
     """
     Dose-rate and MLC speed tests (T3 tests).
     Pylinac should automatically identify open beam and MLC images.
@@ -109,6 +123,8 @@ def drmlc_test(mlc, open_im, tol=1.5, savepath=None, pdf=False, plot=False, prec
         Sets the size for analysis segments in mm.
     roi: dict, optional
         Sets the offset positions and names for analysis segments.
+    dpi : float, optional
+        Figure DPI of the pdf report (see reports.py). The default is None (Matplotlib default).
 
     Returns
     -------
@@ -116,6 +132,9 @@ def drmlc_test(mlc, open_im, tol=1.5, savepath=None, pdf=False, plot=False, prec
         Results of the analysis, rounded to precision digits.
 
     """
+    # Pylinac is imported when the test is run (slow import)
+    from pylinac import DRMLC
+    
     # Test logger
     logger_t = logging.getLogger('qa.test')
     logger_t.info(f"Running DRMLC test for {Path(mlc.path).name}")
@@ -139,9 +158,11 @@ def drmlc_test(mlc, open_im, tol=1.5, savepath=None, pdf=False, plot=False, prec
         (savepath / rep_dir).mkdir(exist_ok=True)  # Make reports directory
         path = str(savepath / rep_dir / report_name)
         if wait_user_close(path):
-            drmlc.publish_pdf(path, notes=[f'Device: {mlc.metadata.StationName}', f'Operator: {mlc.metadata.OperatorsName}'])
+            publish_report(drmlc, path, dpi, plot, notes=[f'Device: {mlc.metadata.StationName}', f'Operator: {mlc.metadata.OperatorsName}'])
         
     res = drmlc.results_data(as_dict=True)
+    # Segment data is an iterator, a list can be reused and sent between processes
+    res['segment_data'] = list(res['segment_data'])
         
     # Round to given precision
     res['max_deviation_percent'] = np.round(res['max_deviation_percent'], precision)
@@ -178,23 +199,53 @@ def catphan_analysis(im, args, pdf=True, plot=False, tolerances=dict(),
         DESCRIPTION.
 
     """
+    # Pylinac is imported when the test is run (slow import)
+    from qa_analysis.phantoms import get_catphan_model, quick_model
+    from qa_analysis.stacks import load_phantom, load_sparse_catphan
+    from qa_analysis.workers import decode_pool
+    from qa_analysis.catphan_modules import analyze_catphan
+    from qa_analysis.verdicts import tolerance_set
+    
+    # Quick daily analysis of the HU linearity module, or the full analysis
+    quick = catphan_mode(im, args) == 'quick'
+    
     # Test logger
     logger_t = logging.getLogger('qa.test')
-    logger_t.info(f"Running Catphan analysis for {Path(im.path).name}")
+    logger_t.info(f"Running {'quick ' if quick else ''}Catphan analysis for {Path(im.path).name}")
     
     
     analysis_path = os.path.dirname(im.path)
     start = time()
+    # Series of the folder, each loaded from its files. Processed series are left in the folder
+    # in manifest mode (see manifest.py) and read-only runs (e.g. backfill).
+    series = folder_series(analysis_path, args)
     
-    while len(os.listdir(analysis_path)) > 0 and start - time() < timeout * 60:
+    while len(series) > 0 and start - time() < timeout * 60:
+        source = series.pop(0)
         # Run the analysis for Catphan model assigned in args
-        cbct = args.catphan_model(analysis_path)
+        model = get_catphan_model(args.catphan_model)
+        # Pylinac analyses only the modules of the model
+        if quick:
+            model = quick_model(model)
+        mapped = getattr(args, 'mmap', False)
+        with decode_pool(getattr(args, 'decode_workers', 1)) as pool:
+            if quick or getattr(args, 'catphan_loading', 'full') == 'sparse':
+                # Decode only the slices near the phantom modules
+                cbct = load_sparse_catphan(model, source, margin_mm=getattr(args, 'slice_margin_mm', 5),
+                                           mapped=mapped, pool=pool)
+            else:
+                cbct = load_phantom(model, source, mapped=mapped, pool=pool)
        
-        # Use the test tolerances from constants.py
-        cbct.analyze(**tolerances)
+        # Use the test tolerances from constants.py. Modules are analysed in parallel (catphan_modules.py)
+        if quick:
+            cbct.analyze(**tolerances)
+        else:
+            analyze_catphan(cbct, getattr(args, 'catphan_workers', 1), getattr(args, 'log_path', None),
+                            share=getattr(args, 'workers', 1), **tolerances)
         
         res = cbct.results_data(as_dict=True)
-        res['mtf'] = cbct.ctp528.mtf.mtfs
+        if not quick:
+            res['mtf'] = cbct.ctp528.mtf.mtfs
         
         # Update DICOM metadata
         im = cbct.dicom_stack[0]
@@ -210,132 +261,230 @@ def catphan_analysis(im, args, pdf=True, plot=False, tolerances=dict(),
             res['ctp404']['thickness_tolerance'] = 0.2
             res['ctp404']['low_contrast_tolerance'] = 1
         
+        # Values for re-evaluating the pass/fail results (verdicts.py)
+        res['ctp404']['nominal_slice_thickness_mm'] = float(im.metadata.SliceThickness)
+        res['tolerance_set'] = tolerance_set(tolerances)
+        
         # Plot figures
         if plot:
             cbct.plot_analyzed_image()
-            
-        # Save results
-        if pdf:
-            report_name = f'{im.metadata.PatientID}_{im.metadata.SeriesDate}_{im.metadata.SeriesTime}_Catphan.pdf'
-            (args.save_path / rep_dir).mkdir(exist_ok=True)  # Make reports directory
-            path = str(args.save_path / rep_dir / report_name)
-            if wait_user_close(path):
-                cbct.publish_pdf(path, notes=[f'Device: {im.metadata.StationName}', f'Operator: {im.metadata.OperatorsName}'])
         
-        # Save Catphan analysis to Excel file
-        save_excel(im, res, save_path=args.save_path, test='Catphan')
-                
-        # Move analyzed files to the processed folder, create subfolder by modality
-        modality = 'Catphan'
-        # Assume that there is one folder for patient name/ID
-        parent_folder = Path(im.path).parent.parent.stem
-        dicom_stack = image.DicomImageStack(analysis_path)
-        for img in dicom_stack:        
-            img.metadata[0x0018, 0x5100].value = 'HFS'
-            # Replace the data folder in image path with processed
-            if parent_folder == modality:
-                processed_path = img.path.replace(args.data_path.stem, f'{args.processed_path.stem}' )
-            else:
-                processed_path = img.path.replace(args.data_path.stem, f'{args.processed_path.stem}/{modality}' )
-            # Move the file
-            move_file(img.path, processed_path)
+        logger_t.info(f"{'Quick Catphan' if quick else 'Catphan'} analysis done in {time() - start:.1f} s")
+        
+        # Saved in the commit stage of the pipeline (see pipeline.py). No report in quick mode.
+        commit(commit_catphan, cbct, im, res, args, pdf and not quick, rep_dir, quick)
+        
+        # Other series of the folder are analysed after the results are saved
+        if len(series) > 0:
+            flush()
             
     return res
 
 
+def commit_catphan(cbct, im, res, args, pdf, rep_dir, quick=False):
+    """
+    Saves the Catphan report and results, and moves the analysed stack to the processed folder.
+    Quick analyses are saved to the 'Catphan daily' sheet and arrays.
+    """
+    # Save results
+    if pdf:
+        report_name = f'{im.metadata.PatientID}_{im.metadata.SeriesDate}_{im.metadata.SeriesTime}_Catphan.pdf'
+        (args.save_path / rep_dir).mkdir(exist_ok=True)  # Make reports directory
+        path = str(args.save_path / rep_dir / report_name)
+        if wait_user_close(path):
+            publish_report(cbct, path, report_dpi(args), getattr(args, 'plot', False),
+                           notes=[f'Device: {im.metadata.StationName}', f'Operator: {im.metadata.OperatorsName}'])
+    
+    # Save Catphan analysis to Excel file
+    test = 'Catphan daily' if quick else 'Catphan'
+    save_excel(im, res, save_path=args.save_path, test=test)
+    # Save the MTF curve and ROI statistics
+    save_arrays(im, catphan_quick_arrays(res) if quick else catphan_arrays(res), args.save_path, test)
+            
+    # Move analyzed files to the processed folder, create subfolder by modality
+    modality = 'Catphan'
+    # Assume that there is one folder for patient name/ID
+    parent_folder = Path(im.path).parent.parent.stem
+    # Analysed stack is used, files are not read again. Pixel data is freed (and files unmapped).
+    cbct.dicom_stack.close()
+    for img in cbct.dicom_stack:        
+        img.metadata[0x0018, 0x5100].value = 'HFS'
+        move_processed(img.path, args, modality, parent_folder)
+
+
+def catphan_mode(im, args):
+    """
+    Catphan analysis of a series: 'quick' (HU linearity module only) or 'full'.
+
+    With args.catphan_mode 'auto', the machines in CATPHAN_QUICK_MACHINES and the series
+    with a description containing one of CATPHAN_QUICK_SERIES are analysed quickly, unless
+    the last full analysis of the machine is older than CATPHAN_FULL_INTERVAL_DAYS.
+    'quick' and 'full' are used for all series.
+
+    Parameters
+    ----------
+    im : DicomHeader
+        Image of the series.
+    args : TYPE
+        Input arguments (catphan_mode, save_path).
+
+    Returns
+    -------
+    str
+        'quick' or 'full'.
+
+    """
+    mode = getattr(args, 'catphan_mode', 'full')
+    if mode != 'auto':
+        return mode
+    
+    machine = str(im.metadata.get('PatientID', ''))
+    description = str(im.metadata.get('SeriesDescription', '')).lower()
+    if machine not in CATPHAN_QUICK_MACHINES and not any(s.lower() in description for s in CATPHAN_QUICK_SERIES):
+        return 'full'
+    
+    # Full analyses are saved with the MTF curve (after the results waiting in the pipeline), weekly full analysis
+    flush()
+    times, _, _ = load_arrays(args.save_path, machine, 'Catphan', 'mtf')
+    measured = measurement_time(im)
+    earlier = times[times <= measured]
+    if len(earlier) == 0 or measured - earlier.max() > np.timedelta64(CATPHAN_FULL_INTERVAL_DAYS, 'D'):
+        return 'full'
+    return 'quick'
+
+
 def acr_analysis(im, args, pdf=True, plot=False, rep_dir='ACR reports', timeout=5):
+    # Pylinac is imported when the test is run (slow import)
+    from pylinac import ACRMRILarge
+    from qa_analysis.stacks import load_headers
+    from qa_analysis.workers import decode_pool
+    
     # Test logger
     logger_t = logging.getLogger('qa.test')
     logger_t.info(f"Running ACR analysis for {Path(im.path).name}")
     
     analysis_path = os.path.dirname(im.path)
     start = time()
+    # Series of the folder, each loaded from its files. Processed series are left in the folder
+    # in manifest mode (see manifest.py) and read-only runs (e.g. backfill).
+    series = folder_series(analysis_path, args)
     
-    while len(os.listdir(analysis_path)) > 0 and start - time() < timeout * 60:
+    while len(series) > 0 and start - time() < timeout * 60:
     
-        dicom_stack = image.DicomImageStack(analysis_path, min_number=3)
-        for img in dicom_stack:
+        # Read the headers of the MR images
+        acr = load_headers(ACRMRILarge, series.pop(0), mapped=getattr(args, 'mmap', False))
+        for metadata in acr.dicom_stack.metadatas:
             # Update field strength to Dicom metadata
-            img.metadata.MagneticFieldStrength = args.field_strength
-            # Save the image with new metadata
-            img.save(img.path)    
+            metadata.MagneticFieldStrength = args.field_strength
+        # Save the images with new metadata, pixel data is copied without decoding
+        if not getattr(args, 'read_only', False):
+            acr.dicom_stack.save_headers()
     
         # Run the analysis for MR images of the ACR phantom
-        acr = ACRMRILarge(os.path.dirname(im.path))    
+        with decode_pool(getattr(args, 'decode_workers', 1)) as pool:
+            acr.dicom_stack.decode(range(len(acr.dicom_stack)), pool=pool)
         acr.analyze()
         
         # Plot figures
         if plot:
             acr.plot_analyzed_image()
-            
-        # Save results
-        if pdf:
-            report_name = f'{im.metadata.PatientID}_{im.metadata.SeriesDate}_{im.metadata.SeriesTime}_ACR.pdf'
-            (args.save_path / rep_dir).mkdir(exist_ok=True)  # Make reports directory
-            path = str(args.save_path / rep_dir / report_name)
-            if wait_user_close(path):
-                acr.publish_pdf(path)
-                
-        # Move analyzed files to the processed folder, create subfolder by modality
-        modality = 'ACR'
-        # Assume that there is one folder for patient name/ID
-        parent_folder = Path(im.path).parent.parent.stem
-        dicom_stack = image.DicomImageStack(analysis_path, min_number=3)
-        for img in dicom_stack:        
-            
-            # Replace the data folder in image path with processed
-            if parent_folder == modality:
-                processed_path = img.path.replace(args.data_path.stem, f'{args.processed_path.stem}' )
-            else:
-                processed_path = img.path.replace(args.data_path.stem, f'{args.processed_path.stem}/{modality}' )
-            
-            # Move the file
-            move_file(img.path, processed_path)
         
-    return acr.results_data(as_dict=True)
+        # Results are read before the report is drawn in the commit stage
+        res = acr.results_data(as_dict=True)
+        # DICOM metadata of the analysed series (report name)
+        im = acr.dicom_stack[0]
+        commit(commit_acr, acr, im, args, pdf, rep_dir)
+        
+        # Other series of the folder are analysed after the results are saved
+        if len(series) > 0:
+            flush()
+        
+    return res
+
+
+def commit_acr(acr, im, args, pdf, rep_dir):
+    """
+    Saves the ACR report and moves the analysed stack to the processed folder.
+    """
+    # Save results
+    if pdf:
+        report_name = f'{im.metadata.PatientID}_{im.metadata.SeriesDate}_{im.metadata.SeriesTime}_ACR.pdf'
+        (args.save_path / rep_dir).mkdir(exist_ok=True)  # Make reports directory
+        path = str(args.save_path / rep_dir / report_name)
+        if wait_user_close(path):
+            publish_report(acr, path, report_dpi(args), getattr(args, 'plot', False))
+            
+    # Move analyzed files to the processed folder, create subfolder by modality
+    modality = 'ACR'
+    # Assume that there is one folder for patient name/ID
+    parent_folder = Path(im.path).parent.parent.stem
+    # Analysed stack is used, files are not read again. Pixel data is freed (and files unmapped).
+    acr.dicom_stack.close()
+    for img in acr.dicom_stack:        
+        move_processed(img.path, args, modality, parent_folder)
 
 
 def winston_analysis(im, args, pdf=True, plot=False, rep_dir='Winston-Lutz reports'):
-        
-    # Run the analysis for given image parent folder
-    wl = WinstonLutz(os.path.dirname(im.path))
+    # Pylinac is imported when the test is run (slow import)
+    from qa_analysis.phantoms import StreamedWinstonLutz
+    from qa_analysis.streaming import cached_localization
     
     # Test logger
     logger_t = logging.getLogger('qa.test')
     logger_t.info(f"Running Winston-Lutz analysis for {Path(im.path).name}")
+    start = time()
+        
+    # Images localised while the session arrived are restored (see streaming.py)
+    folder = os.path.dirname(im.path)
+    localized, uids = cached_localization(pending_files(folder, args), args)
+    # Run the analysis for given image parent folder. Processed sessions are left in the folder in manifest mode.
+    wl = StreamedWinstonLutz(series_source(folder, args), localized=localized)
     
     # Use the test tolerances from constants.py
     wl.analyze(bb_size_mm=args.bb_size_mm)
+    logger_t.info(f'Winston-Lutz analysis done in {time() - start:.1f} s '
+                  f'({len(localized)} of {len(wl.images)} images localised on arrival)')
     
     # Plot figures
     if plot:
         wl.plot_summary()
+    
+    # Results are read before the report is drawn in the commit stage
+    res = wl.results_data(as_dict=True)
+    # List files in the parent folder (analysed images)
+    images = [os.path.basename(path) for path in pending_files(folder, args)]
+    commit(commit_winston, wl, im, res, images, args, pdf, rep_dir, uids)
         
+    return res
+
+
+def commit_winston(wl, im, res, images, args, pdf, rep_dir, uids=()):
+    """
+    Saves the Winston-Lutz report and BB offsets, and moves the images to the processed folder.
+    """
     # Save results
     if pdf:
         report_name = f'{im.metadata.PatientID}_{im.metadata.StationName}_{im.metadata.SeriesDate}_{im.metadata.SeriesTime}_Winston_Lutz.pdf'
         (args.save_path / rep_dir).mkdir(exist_ok=True)  # Make reports directory
         path = str(args.save_path / rep_dir / report_name)
         if wait_user_close(path):
-            wl.publish_pdf(path, notes=[f'Device: {im.metadata.StationName}', f'Operator: {im.metadata.OperatorsName}'])
+            publish_report(wl, path, report_dpi(args), getattr(args, 'plot', False),
+                           notes=[f'Device: {im.metadata.StationName}', f'Operator: {im.metadata.OperatorsName}'])
+        
+    # Save the BB offsets of each image
+    arrays = winston_arrays(res)
+    if save_arrays(im, arrays, args.save_path, 'Winston-Lutz'):
+        # Update the running statistics of the BB offset, raises out-of-control alerts
+        from qa_analysis.trends import update_trends, winston_results, WINSTON_COLUMNS
+        update_trends(args.save_path, im.metadata.PatientID, 'Winston-Lutz', WINSTON_COLUMNS,
+                      winston_results(arrays['bb_offsets']))
+    # Localisation cache of the session is not needed after the results are saved
+    clear_cache(uids, args)
         
     # Move analyzed files to the processed folder, create subfolder by modality
     modality = 'Winston-Lutz'
     # Assume that there is one folder for patient name/ID
     parent_folder = Path(im.path).parent.parent.stem
-    # List files in the parent folder
-    images = os.listdir(os.path.dirname(im.path))
-    images.sort() 
     for img in images:     
         img = os.path.join(os.path.dirname(im.path), img)    
-        
-        # Replace the data folder in image path with processed
-        if parent_folder == modality:
-            processed_path = img.replace(args.data_path.stem, f'{args.processed_path.stem}' )
-        else:
-            processed_path = img.replace(args.data_path.stem, f'{args.processed_path.stem}/{modality}' )
-        
-        # Move the file
-        move_file(img, processed_path)
-        
-    return wl.results_data(as_dict=True)
\ No newline at end of file
+        move_processed(img, args, modality, parent_folder)
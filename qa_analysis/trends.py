@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+Trend analysis of QA results.
+
+Keeps running statistics for each machine (Patient ID), test and metric of
+TREND_METRICS. The statistics are updated with each new result row,
+so that drift can be detected without re-reading the result history:
+    - Mean and standard deviation (Welford's algorithm) with 3 sigma control limits
+    - Exponentially weighted moving average (EWMA) with control limits
+    - Two-sided tabular CUSUM of the standardized results
+"""
+import os
+import json
+import logging
+import numpy as np
+from glob import glob
+
+from qa_analysis.utilities import file_lock
+
+
+TREND_FILE = 'Trends.json'
+
+# Control chart parameters
+TREND_PARAMETERS = {
+    'min_samples': 10,  # Results needed before alerts are raised
+    'sigma_limit': 3,  # Control limits for individual results (x std)
+    'ewma_lambda': 0.2,  # Weight of the newest result in EWMA
+    'ewma_limit': 3,  # Control limits for EWMA (x std of EWMA)
+    'cusum_k': 0.5,  # CUSUM allowance (x std)
+    'cusum_h': 5,  # CUSUM decision interval (x std)
+    }
+
+# Followed metrics of each test: stable key and the column of the results row.
+# Catphan headers show the tolerances and MTF frequencies, so the Catphan columns are
+# given by position (catphan_columns and catphan_quick_columns). The scan settings
+# (KVP, mAs, CTDIvol) and the MTF at fixed frequencies are not followed.
+TREND_METRICS = {
+    'T2-T3': {
+        't2_max_deviation': 'T2_Max_deviation',
+        't3_max_deviation': 'T3_Max_deviation',
+        't2_mean_deviation': 'T2 DR GS (Avg)',
+        't3_mean_deviation': 'T3 MLC SPEED (Avg)',
+        # Halcyon
+        't2dr_max_deviation': 'T2DR_Max_deviation',
+        't2gs_max_deviation': 'T2GS_Max_deviation',
+        't2dr_mean_deviation': 'T2 DR (Avg)',
+        't2gs_mean_deviation': 'T2 GS (Avg)',
+        't3ls_mean_deviation': 'T3 LS (Avg)',
+        },
+    'Catphan': {
+        'hu_air': 8, 'hu_pmp': 9, 'hu_ldpe': 10, 'hu_polystyrene': 11,
+        'hu_acrylic': 12, 'hu_delrin': 13, 'hu_teflon': 14,
+        'line_distance_mm': 15,
+        'slice_thickness_mm': 16,
+        'uniformity_center': 17, 'uniformity_top': 18, 'uniformity_right': 19,
+        'uniformity_bottom': 20, 'uniformity_left': 21,
+        'low_contrast_visibility': 22,
+        'low_contrast_rois_seen': 23,
+        'mtf_80': 24, 'mtf_50': 25, 'mtf_30': 26,
+        },
+    'Catphan daily': {
+        'hu_air': 8, 'hu_pmp': 9, 'hu_ldpe': 10, 'hu_polystyrene': 11,
+        'hu_acrylic': 12, 'hu_delrin': 13, 'hu_teflon': 14,
+        'line_distance_mm': 15,
+        'slice_thickness_mm': 16,
+        'low_contrast_visibility': 17,
+        },
+    'Winston-Lutz': {
+        'bb_offset_max_mm': 'Max 2D CAX to BB (mm)',
+        'bb_offset_median_mm': 'Median 2D CAX to BB (mm)',
+        },
+    }
+
+# Results row of the Winston-Lutz trends (see winston_results)
+WINSTON_COLUMNS = list(TREND_METRICS['Winston-Lutz'].values())
+
+
+def update_trends(save_path, machine, test, columns, values, parameters=TREND_PARAMETERS):
+    """
+    Updates the running statistics with a new results row and checks the control limits.
+
+    Parameters
+    ----------
+    save_path : Path
+        Results folder, where the trend statistics are saved.
+    machine : str
+        Patient ID (device name).
+    test : str
+        QA test (sheet name in the results Excel).
+    columns : list
+        Column headers of the results row.
+    values : list
+        Results row. The numeric values of the TREND_METRICS columns are followed.
+    parameters : dict, optional
+        Control chart parameters. The default is TREND_PARAMETERS.
+
+    Returns
+    -------
+    alerts : list
+        Out-of-control messages for the results row.
+
+    """
+    path_trends = str(save_path / TREND_FILE)
+
+    alerts = []
+    with file_lock(path_trends) as locked:
+        if not locked:
+            return alerts
+
+        trends = load_trends(path_trends)
+        alerts = add_results(trends, machine, test, columns, values, parameters)
+        save_trends(path_trends, trends)
+
+    # Trend logger
+    logger_r = logging.getLogger('qa.trends')
+    for alert in alerts:
+        logger_r.warning(f'Out of control: {alert}')
+
+    return alerts
+
+
+def add_results(trends, machine, test, columns, values, parameters=TREND_PARAMETERS):
+    """
+    Adds a results row to the trend statistics of a machine and test.
+
+    Parameters
+    ----------
+    trends : dict
+        Trend statistics of all machines. Updated in place.
+    machine : str
+        Patient ID (device name).
+    test : str
+        QA test (sheet name in the results Excel).
+    columns : list
+        Column headers of the results row.
+    values : list
+        Results row.
+    parameters : dict, optional
+        Control chart parameters. The default is TREND_PARAMETERS.
+
+    Returns
+    -------
+    alerts : list
+        Out-of-control messages for the results row.
+
+    """
+    alerts = []
+    metrics = trends.setdefault(machine, {}).setdefault(test, {})
+    for key, value in metric_values(test, columns, values):
+        stats = metrics.setdefault(key, new_statistics())
+        for alert in update_statistics(stats, value, parameters):
+            alerts.append(f'{machine} {test} "{key}": {alert}')
+
+    return alerts
+
+
+def metric_values(test, columns, values):
+    """
+    Followed metrics of a results row (TREND_METRICS), as (key, value) pairs.
+    Missing columns, and values that are not numeric or NaN, are left out.
+    """
+    pairs = []
+    for key, column in TREND_METRICS.get(test, {}).items():
+        # Catphan columns by position, the others by header
+        if isinstance(column, int):
+            index = column if column < len(values) else None
+        else:
+            index = columns.index(column) if column in columns else None
+        if index is None:
+            continue
+        value = values[index]
+        if isinstance(value, (bool, np.bool_)) or not isinstance(value, (int, float, np.number)):
+            continue
+        if np.isnan(value):
+            continue
+        pairs.append((key, float(value)))
+    return pairs
+
+
+def winston_results(bb_offsets):
+    """
+    Largest and median BB offset from the field centre (mm) of a Winston-Lutz session
+    (WINSTON_COLUMNS), from the bb_offsets rows of the array store (BB_COLUMNS).
+    """
+    distances = np.hypot(bb_offsets[:, 0], bb_offsets[:, 1])
+    return [float(np.max(distances)), float(np.median(distances))]
+
+
+def new_statistics():
+    """
+    Returns empty running statistics for one metric.
+    """
+    return {'n': 0, 'mean': 0.0, 'm2': 0.0, 'ewma': None,
+            'cusum_pos': 0.0, 'cusum_neg': 0.0, 'last': None}
+
+
+def update_statistics(stats, x, parameters=TREND_PARAMETERS):
+    """
+    Checks a new result against the control limits and updates the running statistics.
+    The result is compared to the statistics of earlier results.
+
+    Parameters
+    ----------
+    stats : dict
+        Running statistics of the metric. Updated in place.
+    x : float
+        New result.
+    parameters : dict, optional
+        Control chart parameters. The default is TREND_PARAMETERS.
+
+    Returns
+    -------
+    alerts : list
+        Violated control rules.
+
+    """
+    alerts = []
+    lam = parameters['ewma_lambda']
+    std = statistics_std(stats)
+    in_control = True
+
+    # Control limits are used after the baseline has enough results
+    if stats['n'] >= parameters['min_samples'] and std > 0:
+        z = (x - stats['mean']) / std
+
+        # Individual result (Shewhart)
+        if abs(z) > parameters['sigma_limit']:
+            alerts.append(f'{x:.5g} outside {parameters["sigma_limit"]} sigma limits '
+                          f'({stats["mean"]:.5g} +/- {parameters["sigma_limit"] * std:.5g})')
+            in_control = False
+
+        # EWMA
+        ewma = lam * x + (1 - lam) * stats['ewma']
+        ewma_std = std * np.sqrt(lam / (2 - lam))
+        if abs(ewma - stats['mean']) > parameters['ewma_limit'] * ewma_std:
+            alerts.append(f'EWMA {ewma:.5g} outside limits '
+                          f'({stats["mean"]:.5g} +/- {parameters["ewma_limit"] * ewma_std:.5g})')
+
+        # CUSUM, restarted after a signal
+        stats['cusum_pos'] = max(0.0, stats['cusum_pos'] + z - parameters['cusum_k'])
+        stats['cusum_neg'] = max(0.0, stats['cusum_neg'] - z - parameters['cusum_k'])
+        if stats['cusum_pos'] > parameters['cusum_h']:
+            alerts.append(f'CUSUM shows an upward shift from {stats["mean"]:.5g}')
+            stats['cusum_pos'] = 0.0
+        if stats['cusum_neg'] > parameters['cusum_h']:
+            alerts.append(f'CUSUM shows a downward shift from {stats["mean"]:.5g}')
+            stats['cusum_neg'] = 0.0
+
+    # EWMA starts from the first result
+    stats['ewma'] = x if stats['ewma'] is None else lam * x + (1 - lam) * stats['ewma']
+    stats['last'] = x
+
+    # Out-of-control results are left out of the baseline mean and std
+    if in_control:
+        stats['n'] += 1
+        delta = x - stats['mean']
+        stats['mean'] += delta / stats['n']
+        stats['m2'] += delta * (x - stats['mean'])
+
+    return alerts
+
+
+def statistics_std(stats):
+    """
+    Sample standard deviation from the running statistics.
+    """
+    if stats['n'] < 2:
+        return 0.0
+    return float(np.sqrt(stats['m2'] / (stats['n'] - 1)))
+
+
+def control_limits(stats, parameters=TREND_PARAMETERS):
+    """
+    Control limits of the individual results and EWMA for one metric.
+
+    Parameters
+    ----------
+    stats : dict
+        Running statistics of the metric.
+    parameters : dict, optional
+        Control chart parameters. The default is TREND_PARAMETERS.
+
+    Returns
+    -------
+    dict
+        Lower and upper limits for results and EWMA.
+
+    """
+    std = statistics_std(stats)
+    ewma_std = std * np.sqrt(parameters['ewma_lambda'] / (2 - parameters['ewma_lambda']))
+    return {'lower': stats['mean'] - parameters['sigma_limit'] * std,
+            'upper': stats['mean'] + parameters['sigma_limit'] * std,
+            'ewma_lower': stats['mean'] - parameters['ewma_limit'] * ewma_std,
+            'ewma_upper': stats['mean'] + parameters['ewma_limit'] * ewma_std}
+
+
+def load_trends(path_trends):
+    """
+    Loads the saved trend statistics. Returns an empty dict if the file does not exist.
+    """
+    if not os.path.isfile(path_trends):
+        return {}
+    with open(path_trends, 'r') as f:
+        return json.load(f)
+
+
+def save_trends(path_trends, trends):
+    """
+    Saves the trend statistics. The file is replaced atomically.
+    """
+    with open(f'{path_trends}.tmp', 'w') as f:
+        json.dump(trends, f, indent=1)
+    os.replace(f'{path_trends}.tmp', path_trends)
+
+
+def rebuild_trends(save_path, parameters=TREND_PARAMETERS):
+    """
+    Rebuilds the trend statistics from all results Excel files in save_path, and the
+    Winston-Lutz statistics from the BB offsets of the array store.
+    Only needed once, e.g. for results saved before trend analysis was used.
+
+    Parameters
+    ----------
+    save_path : Path
+        Results folder.
+    parameters : dict, optional
+        Control chart parameters. The default is TREND_PARAMETERS.
+
+    Returns
+    -------
+    None.
+
+    """
+    import pandas as pd
+    from qa_analysis.arrays import ARRAY_FOLDER, store_path, load_arrays
+    
+    trends = {}
+    machines = []
+    for path_excel in sorted(glob(str(save_path / 'Results_*.xlsx'))):
+        machine = os.path.basename(path_excel)[len('Results_'):-len('.xlsx')]
+        machines.append(machine)
+        for test, results in pd.read_excel(path_excel, sheet_name=None).items():
+            # Results in measurement order
+            if 'Series date' in results:
+                order = pd.to_datetime(results['Series date'], format='%d.%m.%Y', errors='coerce')
+                results = results.iloc[np.argsort(order.values, kind='stable')]
+            for row in results.itertuples(index=False):
+                add_results(trends, machine, test, list(results.columns), list(row), parameters)
+
+    # Store folders of the machines with a results Excel
+    folders = {os.path.basename(os.path.dirname(store_path(save_path, machine, 'Winston-Lutz'))): machine for machine in machines}
+    for folder in sorted(glob(str(save_path / ARRAY_FOLDER / '*' / 'Winston-Lutz'))):
+        name = os.path.basename(os.path.dirname(folder))
+        machine = folders.get(name, name)
+        times, values, ends = load_arrays(save_path, machine, 'Winston-Lutz', 'bb_offsets', mmap_mode=None)
+        for index in np.argsort(times, kind='stable'):
+            start = ends[index - 1] if index > 0 else 0
+            add_results(trends, machine, 'Winston-Lutz', WINSTON_COLUMNS,
+                        winston_results(values[start:ends[index]]), parameters)
+
+    path_trends = str(save_path / TREND_FILE)
+    with file_lock(path_trends) as locked:
+        if locked:
+            save_trends(path_trends, trends)
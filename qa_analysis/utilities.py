@@ -2,34 +2,67 @@
 
 import os
 import logging
-import pandas as pd
 from pathlib import Path
 from time import sleep, time
+from datetime import datetime
+from contextlib import contextmanager
 from subprocess import run
 
+# Pass/fail columns of the Catphan results (verdicts.py)
+CATPHAN_VERDICT_COLUMNS = ['HU linearity passed', 'Geometry passed', 'Slice thickness passed',
+                           'Uniformity passed', 'Low contrast passed']
+# Pass/fail columns of the quick daily Catphan analysis (HU linearity module only)
+CATPHAN_QUICK_VERDICT_COLUMNS = CATPHAN_VERDICT_COLUMNS[:3]
 
-def start_log(path):
+
+def start_log(path, rotation='month', max_mb=10, backup_count=12, queue_size=10000):
+    """
+    Starts logging to a file (DEBUG) and to the console (INFO).
+    Records are queued and written by a listener thread (see logqueue.py).
+
+    Parameters
+    ----------
+    path : Path
+        Log file. With monthly files, the year and month are added to the name.
+    rotation : str, optional
+        'month', 'size' or 'daily' (see logqueue.file_handler). The default is 'month'.
+    max_mb : float, optional
+        Size (MB) for size rotation. The default is 10.
+    backup_count : int, optional
+        Rotated files kept. The default is 12.
+    queue_size : int, optional
+        Maximum number of queued records. The default is 10000.
+
+    Returns
+    -------
+    log_queue : multiprocessing.Queue
+        Queue for the worker processes.
+
+    """
+    from qa_analysis.logqueue import file_handler, start_listener
+    
     # Log folder
     path.parent.mkdir(exist_ok=True)
     
-    # Logging parameters
-    month = datetime.today().strftime('_%Y_%m')  # Name log files using current year and month
-    logging.basicConfig(filename=f'{path.parent}/{path.stem}{month}{path.suffix}', 
-                        level=logging.DEBUG, 
-                        format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
-                        datefmt='%m-%d %H:%M',
-                        filemode='a'  # a = append to existing file, w = overwrite
-                        )
+    # Name log files using current year and month
+    if rotation == 'month':
+        month = datetime.today().strftime('_%Y_%m')
+        path = path.parent / f'{path.stem}{month}{path.suffix}'
+    
+    # File handler writes all messages
+    log_file = file_handler(str(path), rotation, max_mb, backup_count)
+    log_file.setLevel(logging.DEBUG)
+    log_file.setFormatter(logging.Formatter('%(asctime)s %(name)-12s %(levelname)-8s %(message)s',
+                                            datefmt='%m-%d %H:%M'))
     
     # Define a console Handler which writes INFO messages or higher
     console = logging.StreamHandler()
     console.setLevel(logging.INFO)
     # Set a format which is simpler for console use
-    formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
-    # Tell the handler to use this format
-    console.setFormatter(formatter)
-    # Add the handler to the root logger
-    logging.getLogger('').addHandler(console)
+    console.setFormatter(logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s'))
+    
+    # Loggers only queue the records
+    return start_listener([log_file, console], queue_size)
 
 
 def map_network_drive(path):
@@ -46,6 +79,10 @@ def map_network_drive(path):
     None.
 
     """
+    # Network drive details are optional
+    if not os.path.isfile(str(path)):
+        return
+    
     # Map network drive with correct password
     with open(str(path), 'r') as f:
         share = f.readlines()
@@ -71,7 +108,8 @@ def save_excel(dicom_im, res, save_path, test='T2-T3', prec=5):
     save_path : TYPE
         DESCRIPTION.
     test : TYPE, optional
-        QA test to be saved. The default is 'T2-T3'. 'Catphan' is also available.
+        QA test to be saved. The default is 'T2-T3'. 'Catphan' and 'Catphan daily' 
+        (quick analysis) are also available.
     prec : int, optional
         Numeric precision for floating point results. The default is 5.
 
@@ -86,6 +124,9 @@ def save_excel(dicom_im, res, save_path, test='T2-T3', prec=5):
 
     """
 
+    # Pandas is imported when results are saved (slow import)
+    import pandas as pd
+    
     # Date, time and Patient ID
     date = dicom_im.metadata[0x0008, 0x0021].value
     time = dicom_im.metadata[0x0008, 0x0031].value
@@ -134,43 +175,14 @@ def save_excel(dicom_im, res, save_path, test='T2-T3', prec=5):
                 res['ctp404']['thickness_tolerance'],
                 res['ctp404']['low_contrast_tolerance']]
         
-        # TODO what if constants are changed (tolerances)?
+        # Tolerances can be changed afterwards with main_reevaluate.py (verdicts.py)
         lps, mtfs = zip(*res['mtf'].items()) 
-        cols = ['Series date', 
-                'Series time', 
-                'Series description',
-                'KVP',
-                'mAs',
-                'Filter type',
-                'Convolution kernel',
-                'CTDIvol',
-                f'Linearity (HU, +/-{tols[0]}), Air',
-                'PMP',
-                'LDPE',
-                'Polystyrene',
-                'Acrylic',
-                'Delrin',
-                'Teflon',
-                f'Average line distance (mm, < {tols[1]}mm error)',
-                f'Slice thickness (mm, < {tols[2]}mm error)',                
-                'Uniformity (HU, +/-{tols[0]}), Center',
-                'Top',
-                'Right',
-                'Bottom',
-                'Left',
-                'Low contrast visibility',
-                f'Low contrast ROIs seen (> {tols[3]})',
-                'MTF 80%',
-                'MTF 50%',
-                'MTF 30%',
-                f'MTF {lps[0]} lp/mm',
-                f'MTF {lps[1]} lp/mm',
-                f'MTF {lps[2]} lp/mm',
-                f'MTF {lps[3]} lp/mm',
-                f'MTF {lps[4]} lp/mm',
-                f'MTF {lps[5]} lp/mm',
-                f'MTF {lps[6]} lp/mm',
-            ]
+        cols = catphan_columns(tols, lps)
+        
+        # Pass/fail results from the measured values
+        from qa_analysis.arrays import catphan_arrays
+        from qa_analysis.verdicts import catphan_verdicts
+        verdicts = catphan_verdicts(catphan_arrays(res), res['ctp404'])
         
         series = ''
         ctdi = round(dicom_im.metadata[0x0018, 0x9345].value, prec) if (0x0018, 0x9345) in dicom_im.metadata else ''
@@ -215,7 +227,38 @@ def save_excel(dicom_im, res, save_path, test='T2-T3', prec=5):
                         round(mtfs[4], prec),
                         round(mtfs[5], prec),
                         round(mtfs[6], prec),
-                        ]
+                        ] + [verdicts[column] for column in CATPHAN_VERDICT_COLUMNS]
+    elif test == 'Catphan daily':
+        tols = [res['ctp404']['hu_tolerance'], 
+                res['ctp404']['scaling_tolerance'],
+                res['ctp404']['thickness_tolerance']]
+        cols = catphan_quick_columns(tols)
+        
+        # Pass/fail results from the measured values
+        from qa_analysis.arrays import catphan_quick_arrays
+        from qa_analysis.verdicts import catphan_verdicts
+        verdicts = catphan_verdicts(catphan_quick_arrays(res), res['ctp404'])
+        
+        ctdi = round(dicom_im.metadata[0x0018, 0x9345].value, prec) if (0x0018, 0x9345) in dicom_im.metadata else ''
+        hu_rois = res['ctp404']['hu_rois']
+        
+        # Row of test results, in Excel-friendly format
+        results_data = [f'{date[6:8]}.{date[4:6]}.{date[:4]}',
+                        f'{time[:2]}:{time[2:4]}:{time[4:6]}',
+                        str(dicom_im.metadata.get('SeriesDescription', '')),
+                        int(dicom_im.metadata[0x0018, 0x0060].value),
+                        int(dicom_im.metadata[0x0018, 0x1152].value),
+                        dicom_im.metadata[0x0018, 0x1160].value,
+                        dicom_im.metadata[0x0018, 0x1210].value,
+                        ctdi,
+                        # Linearity, difference from reference
+                        ] + [int(hu_rois[insert]['difference']) 
+                             for insert in ['Air', 'PMP', 'LDPE', 'Poly', 'Acrylic', 'Delrin', 'Teflon']] + [
+                        # Geometry
+                        round(res['ctp404']['avg_line_distance_mm'], prec), # Avg line distance
+                        round(res['ctp404']['measured_slice_thickness_mm'], prec), # Slice thickness
+                        round(res['ctp404']['low_contrast_visibility'], prec),  # Contrast of LDPE and Poly
+                        ] + [verdicts[column] for column in CATPHAN_QUICK_VERDICT_COLUMNS]
     else:
         raise NotImplementedError()
     
@@ -227,8 +270,106 @@ def save_excel(dicom_im, res, save_path, test='T2-T3', prec=5):
     # Add a new row to the excel file
     path_excel = str(save_path / f'Results_{patient}.xlsx')
     
+    # Parallel runs (e.g. backfill) may write to the same results file
+    with file_lock(path_excel) as locked:
+        if not locked or not append_excel_row(path_excel, results, test, date, patient):
+            return
+    
+    # Update the running statistics of the results, raises out-of-control alerts
+    from qa_analysis.trends import update_trends  # trends module uses file_lock from utilities
+    update_trends(save_path, patient, test, cols, results_data)
+
+
+def catphan_columns(tols, lps):
+    """
+    Column headers of the Catphan results.
+
+    Parameters
+    ----------
+    tols : list
+        HU, scaling, thickness and low-contrast tolerances (shown in the headers).
+    lps : list
+        Line pair frequencies (lp/mm) of the MTF values.
+
+    Returns
+    -------
+    list
+        Column headers.
+
+    """
+    return [
+        'Series date', 
+        'Series time', 
+        'Series description',
+        'KVP',
+        'mAs',
+        'Filter type',
+        'Convolution kernel',
+        'CTDIvol',
+        f'Linearity (HU, +/-{tols[0]}), Air',
+        'PMP',
+        'LDPE',
+        'Polystyrene',
+        'Acrylic',
+        'Delrin',
+        'Teflon',
+        f'Average line distance (mm, < {tols[1]}mm error)',
+        f'Slice thickness (mm, < {tols[2]}mm error)',                
+        f'Uniformity (HU, +/-{tols[0]}), Center',
+        'Top',
+        'Right',
+        'Bottom',
+        'Left',
+        'Low contrast visibility',
+        f'Low contrast ROIs seen (> {tols[3]})',
+        'MTF 80%',
+        'MTF 50%',
+        'MTF 30%',
+        f'MTF {lps[0]} lp/mm',
+        f'MTF {lps[1]} lp/mm',
+        f'MTF {lps[2]} lp/mm',
+        f'MTF {lps[3]} lp/mm',
+        f'MTF {lps[4]} lp/mm',
+        f'MTF {lps[5]} lp/mm',
+        f'MTF {lps[6]} lp/mm',
+        ] + CATPHAN_VERDICT_COLUMNS
+
+
+def catphan_quick_columns(tols):
+    """
+    Column headers of the quick daily Catphan results: the series, HU linearity,
+    geometry and slice thickness columns of catphan_columns, and their pass/fail results.
+    """
+    columns = catphan_columns(tols + [None], [None] * 7)
+    return columns[:17] + [columns[22]] + CATPHAN_QUICK_VERDICT_COLUMNS
+
+
+def append_excel_row(path_excel, results, test, date, patient):
+    """
+    Adds a row of results to the given sheet of an Excel file. 
+    Creates the file or sheet if they do not exist.
+
+    Parameters
+    ----------
+    path_excel : str
+        Path to the results Excel file.
+    results : pd.DataFrame
+        Single row of results with column headers.
+    test : str
+        Sheet name (QA test).
+    date : str
+        Series date (for logging).
+    patient : str
+        Patient ID (for logging).
+
+    Returns
+    -------
+    bool
+        True if the row was added, False otherwise.
+
+    """
+    import pandas as pd
     
-        
     # Check if a results file exists
     if os.path.isfile(path_excel):
         
@@ -241,13 +382,14 @@ def save_excel(dicom_im, res, save_path, test='T2-T3', prec=5):
                 # Create a new sheet to Excel
                 if not test in writer.book:
                     results.to_excel(writer, sheet_name=test, index=None)
+                    return True
                 
                 # Find if the results row exists
                 if find_matching_row(writer.book[test], results):
                     # Utility logger
                     logger_u = logging.getLogger('qa.utilities')
                     logger_u.info(f'Measurement date {date}, patient {patient}, test {test} already analyzed.')
-                    return
+                    return False
                 
                 # Find the last row in the results table
                 start = writer.book[test].max_row
@@ -263,12 +405,14 @@ def save_excel(dicom_im, res, save_path, test='T2-T3', prec=5):
                 
         # After timeout, skip saving the results excel
         else:        
-            return
+            return False
     
     # Create new results file
     else:            
         with pd.ExcelWriter(path_excel, engine='openpyxl') as writer:    
             results.to_excel(writer, sheet_name=test, index=None)
+    
+    return True
 
 
 def move_file(src: str, dst: str, overwrite=True):
@@ -311,6 +455,65 @@ def move_file(src: str, dst: str, overwrite=True):
     else:
         # Move file
         os.rename(src, dst)
+
+
+def move_processed(src: str, args, modality: str, parent_folder: str):
+    """
+    Moves an analyzed file from the data folder to the processed folder. 
+    Files are placed in a subfolder by modality, unless the data was already 
+    sorted in a folder with the same name. In manifest mode (processed_mode),
+    the file is left in place and recorded in the manifest.
+
+    Parameters
+    ----------
+    src : str
+        File to be moved.
+    args : TYPE
+        Input arguments (data_path, processed_path, archive and processed_mode).
+    modality : str
+        Test name used as the subfolder (e.g. 'T2-T3').
+    parent_folder : str
+        Name of the folder above the patient folder.
+
+    Returns
+    -------
+    None.
+
+    """
+    # Files are left in place in read-only runs (e.g. backfill)
+    if not getattr(args, 'move_files', True):
+        return
+    
+    # Files are left in place and recorded in the manifest (see manifest.py)
+    if getattr(args, 'processed_mode', 'move') == 'manifest':
+        from qa_analysis.manifest import record
+        record(src, args, modality)
+        return
+    
+    relocate_file(src, args, modality, parent_folder)
+
+
+def relocate_file(src: str, args, modality: str, parent_folder: str):
+    """
+    Moves a file to the processed folder (see move_processed), and compresses it
+    in the background if args.archive is set. Returns the destination.
+    """
+    # Replace the data folder in image path with processed
+    if parent_folder == modality:
+        processed_path = src.replace(args.data_path.stem, f'{args.processed_path.stem}' )
+    else:
+        processed_path = src.replace(args.data_path.stem, f'{args.processed_path.stem}/{modality}' )
+    
+    # Move the file
+    move_file(src, processed_path)
+    
+    # Moved files are compressed in the background (see archive.py)
+    method = getattr(args, 'archive', 'none')
+    if method != 'none' and not os.path.exists(src) and os.path.isfile(processed_path):
+        from qa_analysis.archive import archive
+        archive(processed_path, method, getattr(args, 'archive_workers', 1))
+    return processed_path
+
         
 def remove_empty_directory(directory: Path):
     """
@@ -413,6 +616,69 @@ def wait_user_close(path_file, retry_time=5, timeout=120):
                 return False
     return True
 
+@contextmanager
+def file_lock(path_file, retry_time=0.2, timeout=10, stale=30):
+    """
+    Exclusive lock for a file shared between processes. 
+    Uses a lock file created next to the locked file.
+
+    Parameters
+    ----------
+    path_file : str
+        Path to the file that is locked.
+    retry_time : float, optional
+        Time (s) to wait until retrying to acquire the lock. The default is 0.2 seconds.
+    timeout : int, optional
+        Timeout (min) for waiting the lock. The default is 10 minutes.
+    stale : int, optional
+        Age (min) after which a lock is assumed to be left from a crashed 
+        process and is removed. The default is 30 minutes.
+
+    Yields
+    ------
+    bool
+        True if the lock was acquired, False after timeout.
+
+    """
+    # Utility logger
+    logger_u = logging.getLogger('qa.utilities')
+    
+    path_lock = f'{path_file}.lock'
+    s_time = time()
+    
+    # Wait until the lock is released
+    while True:
+        try:
+            # Creating the lock file is atomic
+            fd = os.open(path_lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            os.write(fd, str(os.getpid()).encode())
+            os.close(fd)
+            break
+        except FileExistsError:
+            # Remove lock left by a crashed process
+            try:
+                if time() - os.path.getmtime(path_lock) > stale * 60:
+                    os.remove(path_lock)
+                    continue
+            except OSError:
+                continue
+            
+            if time() - s_time > timeout * 60:
+                logger_u.debug(f'Timeout of {timeout} minutes has passed while waiting for {path_lock}.')
+                yield False
+                return
+            sleep(retry_time)
+    
+    try:
+        yield True
+    finally:
+        # Release the lock
+        try:
+            os.remove(path_lock)
+        except OSError:
+            pass
+
+
 def find_matching_row(worksheet, compare_row):
     """
     Finds 
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-validation of the test images before the analysis.
+
+Checks that are fast compared to the analysis, from the headers read by the
+detectors and a downsampled pixel check of the RT images:
+    - RT images (T2/T3, Winston-Lutz): the field edges are inside the image
+      (cropped fields fail in the analysis), and all images of the session are found.
+      The Halcyon T2/T3 fields fill the imager, only the images are checked.
+    - CT and MR stacks (Catphan, ACR): the number of slices, the z coverage of
+      the phantom modules and missing slices
+
+Invalid groups are rejected (moved to Not_analyzed) or deferred, i.e. left in the
+data folder for the next run, when the images can still be arriving. Groups are
+deferred while their last file is newer than DEFER_MAX_S, then rejected.
+"""
+import os
+from time import time
+from collections import namedtuple
+
+import numpy as np
+
+from qa_analysis.workers import decode_pixels
+from qa_analysis.constants import (
+    VALIDATION_PIXEL_STEP, FIELD_EDGE_FRACTION, FIELD_MIN_CONTRAST, WL_MIN_IMAGES, DEFER_MAX_S,
+    WL_EXPECTED_AXES, WL_AXIS_TOLERANCE_DEG, WL_SETTLE_S
+    )
+
+# Result of a failed validation
+#   action: 'reject' or 'defer'
+#   reason: explanation for the log
+Invalid = namedtuple('Invalid', ['action', 'reason'])
+
+# Image position tag (z coordinate of CT and MR slices)
+IMAGE_POSITION = (0x0020, 0x0032)
+
+# Gantry, collimator and couch angle tags of RT images
+RT_AXES = [(0x300a, 0x011e), (0x300a, 0x0120), (0x300a, 0x0122)]
+
+
+def incomplete(headers, arg, reason):
+    """
+    Defers a group that can still be receiving files, otherwise rejects it.
+
+    Parameters
+    ----------
+    headers : list
+        DicomHeaders of the group.
+    arg : TYPE
+        Input arguments.
+    reason : str
+        What is missing.
+
+    Returns
+    -------
+    Invalid
+        Deferred or rejected group.
+
+    """
+    newest = max(os.path.getmtime(header.path) for header in headers)
+    waited = time() - newest
+    # Archived groups (e.g. backfill) are not completed later
+    if waited < DEFER_MAX_S and not getattr(arg, 'read_only', False):
+        return Invalid('defer', f'{reason}, waiting for more files')
+    return Invalid('reject', f'{reason} (no new files in {waited:.0f} s)')
+
+
+def field_problem(path, step=VALIDATION_PIXEL_STEP):
+    """
+    Checks the radiation field of an RT image from downsampled pixels.
+
+    Parameters
+    ----------
+    path : str
+        Image file.
+    step : int, optional
+        Pixel step of the downsampling. The default is VALIDATION_PIXEL_STEP.
+
+    Returns
+    -------
+    str or None
+        Problem found, None if the field edges are inside the image.
+
+    """
+    # Images that cannot be decoded here are left to the analysis
+    try:
+        arr = decode_pixels(path)[::step, ::step].astype(float)
+    except Exception:
+        return None
+    # Full range, the Winston-Lutz field is a small part of the image
+    low, high = arr.min(), arr.max()
+    if high - low < FIELD_MIN_CONTRAST * max(abs(high), abs(low), 1):
+        return 'no radiation field in the image'
+
+    # The field is the class that is not the majority of the image border
+    # (works for both photometric interpretations)
+    field = arr > (low + high) / 2
+    border = np.concatenate([field[0], field[-1], field[:, 0], field[:, -1]])
+    if border.mean() > 0.5:
+        field = ~field
+
+    # A field reaching over a border is cropped (fraction of the field width along the border)
+    width, height = field.any(axis=0).sum(), field.any(axis=1).sum()
+    sides = {'top': (field[0], width), 'bottom': (field[-1], width),
+             'left': (field[:, 0], height), 'right': (field[:, -1], height)}
+    cropped = [side for side, (values, size) in sides.items() if values.sum() > FIELD_EDGE_FRACTION * size]
+    if len(cropped) > 0:
+        return f'field cropped at the {" and ".join(cropped)} edge'
+    return None
+
+
+def check_fields(images):
+    """
+    Field check of RT images. Returns an Invalid for the first problem found, or None.
+    """
+    for image in images:
+        problem = field_problem(image.path)
+        if problem is not None:
+            return Invalid('reject', f'{os.path.basename(image.path)}: {problem}')
+    return None
+
+
+def stack_problem(header, headers, min_slices, span_mm):
+    """
+    Checks the slices of a CT or MR series (the folder of header).
+
+    Parameters
+    ----------
+    header : DicomHeader
+        An image of the series.
+    headers : list
+        DicomHeaders of the group.
+    min_slices : int
+        Minimum number of slices.
+    span_mm : float
+        Distance (mm) between the first and last module of the phantom.
+
+    Returns
+    -------
+    str or None
+        Problem found, None if the stack is complete.
+
+    """
+    folder = os.path.dirname(header.path)
+    z = np.unique([float(h[IMAGE_POSITION].value[2]) for h in headers
+                   if os.path.dirname(h.path) == folder and IMAGE_POSITION in h])
+    if len(z) < min_slices:
+        return f'{len(z)} slices, at least {min_slices} needed'
+
+    # Missing slices in the middle of the stack
+    spacing = np.diff(z)
+    step = np.median(spacing)
+    gaps = np.flatnonzero(spacing > 1.5 * step)
+    if len(gaps) > 0:
+        return f'slices missing between z = {z[gaps[0]]:.1f} and {z[gaps[0] + 1]:.1f} mm'
+
+    # Scan length covers the phantom modules
+    if z[-1] - z[0] < span_mm - step / 2:
+        return f'scan length {z[-1] - z[0]:.0f} mm, phantom modules span {span_mm:.0f} mm'
+    return None
+
+
+def validate_t2_t3(test_images, headers, arg):
+    """
+    T2/T3 session: all images found, and the fields are inside the images (not Halcyon).
+    """
+    needed = ['t2_open', 't2_mlc', 't3_open', 't3_mlc']
+    # Halcyon dose-rate images come in pairs
+    if 't2_dr_open' in test_images or 't2_dr_mlc' in test_images:
+        needed += ['t2_dr_open', 't2_dr_mlc']
+    missing = [key for key in needed if key not in test_images]
+    if len(missing) > 0:
+        return incomplete(headers, arg, f'T2-T3 images missing: {", ".join(missing)}')
+    # Halcyon T2GS and T3 fields (28 cm at the isocenter) fill the imager
+    if any(test_images.get(key) is not None for key in ['t2_gs_roi', 't3_roi', 't2_dr_open']):
+        return None
+    return check_fields([test_images[key] for key in needed])
+
+
+def validate_catphan(key):
+    """
+    Catphan stack check for the image key ('catphan' or 'catphan_linac').
+    """
+    def validate(test_images, headers, arg):
+        # Pylinac is imported when the test is run (slow import)
+        from qa_analysis.phantoms import get_catphan_model, quick_model
+        from qa_analysis.tests import catphan_mode
+
+        model = get_catphan_model(arg.catphan_model)
+        # The quick daily analysis needs the HU linearity module only
+        if catphan_mode(test_images[key], arg) == 'quick':
+            model = quick_model(model)
+        offsets = [config['offset'] for config in model.modules.values()]
+        problem = stack_problem(test_images[key], headers, model.min_num_images, max(offsets) - min(offsets))
+        return None if problem is None else incomplete(headers, arg, f'Catphan {problem}')
+    return validate
+
+
+def validate_acr(test_images, headers, arg):
+    """
+    ACR stack check: slices 1 to 11.
+    """
+    # Pylinac is imported when the test is run (slow import)
+    from pylinac import ACRMRILarge
+    from pylinac.acr import MR_SLICE11_MODULE_OFFSET_MM
+
+    problem = stack_problem(test_images['acr'], headers, ACRMRILarge.min_num_images, MR_SLICE11_MODULE_OFFSET_MM)
+    return None if problem is None else incomplete(headers, arg, f'ACR {problem}')
+
+
+def missing_axes(images, expected, tol=WL_AXIS_TOLERANCE_DEG):
+    """
+    Expected (gantry, collimator, couch) angles without an image.
+
+    Parameters
+    ----------
+    images : list
+        DicomHeaders of the RT images.
+    expected : list
+        (gantry, collimator, couch) angles (deg) of the session.
+    tol : float, optional
+        Tolerance (deg) of the angles. The default is WL_AXIS_TOLERANCE_DEG.
+
+    Returns
+    -------
+    list
+        Expected angles that were not found.
+
+    """
+    found = [[float(image.get_value(tag, 0)) for tag in RT_AXES] for image in images]
+    # Difference of the angles over 360 deg (e.g. 359.9 and 0)
+    close = lambda a, b: abs((a - b + 180) % 360 - 180) <= tol
+    return [axes for axes in expected
+            if not any(all(close(a, b) for a, b in zip(angles, axes)) for angles in found)]
+
+
+def validate_winston(test_images, headers, arg):
+    """
+    Winston-Lutz: number of images (or the expected angles) in the folder, and the fields are inside the images.
+    Without the expected angles, the session is complete when no new image has arrived in WL_SETTLE_S.
+    """
+    folder = os.path.dirname(test_images['winston'].path)
+    images = [h for h in headers if os.path.dirname(h.path) == folder and h.get_value((0x0008, 0x0060)) == 'RTIMAGE']
+    # Session is complete when the last expected angle arrives
+    expected = WL_EXPECTED_AXES.get(str(test_images['winston'].get_value((0x0010, 0x0020), '')))
+    if expected:
+        missing = missing_axes(images, expected)
+        if len(missing) > 0:
+            angles = ', '.join(f'G{g:g} C{c:g} T{t:g}' for g, c, t in missing)
+            return incomplete(headers, arg, f'Winston-Lutz angles missing: {angles}')
+        return check_fields(images)
+    if len(images) < WL_MIN_IMAGES:
+        return incomplete(headers, arg, f'{len(images)} Winston-Lutz images, at least {WL_MIN_IMAGES} needed')
+    # More images of the session can still be arriving (archived sessions are complete)
+    waited = time() - max(os.path.getmtime(image.path) for image in images)
+    if waited < WL_SETTLE_S and not getattr(arg, 'read_only', False):
+        return Invalid('defer', f'{len(images)} Winston-Lutz images, last image {waited:.0f} s ago, '
+                                f'waiting for more images')
+    return check_fields(images)
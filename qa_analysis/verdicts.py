@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Pass/fail results (verdicts) of the QA tests from the measured values and the tolerances.
+
+The measured values are saved separately from the verdicts: the maximum deviations
+of the T2-T3 tests in the results Excel, and the Catphan ROI values, line distances,
+slice thickness and low-contrast ROIs seen in the array store (arrays.py, also for the
+quick daily analyses in the 'Catphan daily' sheet).
+When the tolerances in constants.py are changed, reevaluate() recomputes the pass/fail
+columns, the HU differences and the tolerances in the column headers of the results
+Excel files from the saved values, without analysing the images again (main_reevaluate.py).
+
+The verdicts are computed as in Pylinac:
+    T2, T3              maximum deviation < DRGS_TOL or DRMLC_TOL (%)
+    HU linearity        |value - expected HU| <= hu_tolerance for all inserts
+    Geometry            |line distance - 50 mm| < scaling_tolerance for all lines
+    Slice thickness     |measured - nominal| < thickness_tolerance
+    Uniformity          |value - nominal| <= hu_tolerance for all ROIs
+    Low contrast        ROIs seen >= low_contrast_tolerance
+"""
+import os
+import re
+import logging
+from glob import glob
+
+import numpy as np
+
+from qa_analysis import constants
+from qa_analysis.arrays import ROI_COLUMNS, load_arrays
+from qa_analysis.utilities import (
+    file_lock, wait_user_close, catphan_columns, catphan_quick_columns, CATPHAN_VERDICT_COLUMNS
+    )
+
+# Nominal length (mm) of the CTP404 geometry lines (as in Pylinac)
+NOMINAL_LINE_MM = 50
+
+# Tolerance constant of each T2-T3 column prefix (e.g. 'T2_Pass/Fail' and 'T2_Max_deviation')
+VMAT_TOLERANCES = {'T2': 'DRGS_TOL', 'T2DR': 'DRGS_TOL', 'T2GS': 'DRGS_TOL', 'T3': 'DRMLC_TOL'}
+
+# Linearity inserts in the order of the Catphan results columns
+LINEARITY_INSERTS = ['Air', 'PMP', 'LDPE', 'Poly', 'Acrylic', 'Delrin', 'Teflon']
+
+# Fields of the array store read for the Catphan verdicts
+CATPHAN_FIELDS = ['hu_rois', 'hu_roi_names', 'uniformity_rois', 'line_distances',
+                  'slice_thickness', 'low_contrast_rois_seen', 'tolerance_set']
+
+
+def tolerance_set(tolerances):
+    """
+    Name of the constant (constants.py) of the tolerances, '' for other tolerances.
+    """
+    return next((name for name, value in vars(constants).items() if value is tolerances), '')
+
+
+def vmat_passed(max_deviation, tol):
+    """
+    T2/T3 verdict: all segments within tol (%) from the open field.
+    """
+    return bool(max_deviation < tol)
+
+
+def hu_differences(arrays, tolerances):
+    """
+    Differences of the linearity inserts from the expected HU values of the tolerances.
+    Inserts without an expected value keep the nominal value of the analysis.
+    """
+    expected = tolerances.get('expected_hu_values') or {}
+    rois = np.asarray(arrays['hu_rois'], dtype=float)
+    nominal = [expected.get(str(name), roi[ROI_COLUMNS.index('nominal_value')])
+               for name, roi in zip(arrays['hu_roi_names'], rois)]
+    return rois[:, ROI_COLUMNS.index('value')] - np.array(nominal, dtype=float)
+
+
+def catphan_verdicts(arrays, tolerances):
+    """
+    Pass/fail results of a Catphan measurement.
+
+    Parameters
+    ----------
+    arrays : dict
+        Measured values (arrays.catphan_arrays, or one measurement of the array store).
+    tolerances : dict
+        hu_tolerance, scaling_tolerance, thickness_tolerance, low_contrast_tolerance
+        and optionally expected_hu_values (e.g. CATPHAN_TOLERANCES).
+
+    Returns
+    -------
+    verdicts : dict
+        Verdict of each CATPHAN_VERDICT_COLUMNS. None if the values were not saved.
+
+    """
+    verdicts = dict.fromkeys(CATPHAN_VERDICT_COLUMNS)
+    hu_tolerance = tolerances['hu_tolerance']
+
+    verdicts['HU linearity passed'] = bool(np.all(np.abs(hu_differences(arrays, tolerances)) <= hu_tolerance))
+    # Uniformity and low contrast are not analysed in the quick daily analysis
+    if 'uniformity_rois' in arrays:
+        uniformity = np.asarray(arrays['uniformity_rois'], dtype=float)[:, ROI_COLUMNS.index('difference')]
+        verdicts['Uniformity passed'] = bool(np.all(np.abs(uniformity) <= hu_tolerance))
+
+    # Values saved since the verdicts were added
+    if 'line_distances' in arrays:
+        lines = np.asarray(arrays['line_distances'], dtype=float)
+        verdicts['Geometry passed'] = bool(np.all(np.abs(lines - NOMINAL_LINE_MM) < tolerances['scaling_tolerance']))
+    if 'slice_thickness' in arrays:
+        measured, nominal = np.asarray(arrays['slice_thickness'], dtype=float).ravel()
+        if not np.isnan(nominal):
+            verdicts['Slice thickness passed'] = bool(abs(measured - nominal) < tolerances['thickness_tolerance'])
+    if 'low_contrast_rois_seen' in arrays:
+        seen = float(np.asarray(arrays['low_contrast_rois_seen']).ravel()[0])
+        verdicts['Low contrast passed'] = bool(seen >= tolerances['low_contrast_tolerance'])
+
+    return verdicts
+
+
+def catphan_measurements(save_path, machine, test='Catphan'):
+    """
+    Catphan values of a machine from the array store, by series date and time.
+
+    Parameters
+    ----------
+    save_path : Path
+        Results folder.
+    machine : str
+        Patient ID (device name).
+    test : str, optional
+        'Catphan', or 'Catphan daily' for the quick analyses. The default is 'Catphan'.
+
+    Returns
+    -------
+    measurements : dict
+        Arrays of each measurement (CATPHAN_FIELDS that were saved) by numpy.datetime64.
+
+    """
+    measurements = {}
+    for field in CATPHAN_FIELDS:
+        times, values, ends = load_arrays(save_path, machine, test, field)
+        for measured, rows in zip(times, np.split(np.asarray(values), ends[:-1])):
+            measurements.setdefault(measured, {})[field] = rows
+    return measurements
+
+
+def row_time(date, time):
+    """
+    Series date and time of a results row ('dd.mm.yyyy', 'hh:mm:ss'), None if not readable.
+    """
+    try:
+        return np.datetime64(f'{date[6:10]}-{date[3:5]}-{date[0:2]}T{time}', 's')
+    except (TypeError, ValueError):
+        return None
+
+
+def set_cell(cell, value):
+    """
+    Sets a cell value, returns True if the value changed.
+    """
+    if cell.value == value:
+        return False
+    cell.value = value
+    return True
+
+
+def reevaluate_vmat(sheet):
+    """
+    Recomputes the T2-T3 pass/fail columns of a sheet from the maximum deviations.
+    Returns the number of rows, changed cells and rows without saved values (none, saved in the sheet).
+    """
+    header = [cell.value for cell in sheet[1]]
+    pairs = [(header.index(f'{prefix}_Pass/Fail'), header.index(f'{prefix}_Max_deviation'), getattr(constants, name))
+             for prefix, name in VMAT_TOLERANCES.items()
+             if f'{prefix}_Pass/Fail' in header and f'{prefix}_Max_deviation' in header]
+
+    rows, changed = 0, 0
+    for row in sheet.iter_rows(min_row=2):
+        rows += 1
+        for passed, deviation, tol in pairs:
+            if isinstance(row[deviation].value, (int, float)):
+                changed += set_cell(row[passed], vmat_passed(row[deviation].value, tol))
+    return rows, changed, 0
+
+
+def reevaluate_catphan(sheet, measurements, quick=False):
+    """
+    Recomputes the HU differences, pass/fail columns and tolerance headers of a Catphan sheet
+    (or of the 'Catphan daily' sheet with quick) from the array store.
+    Returns the number of rows, changed cells and rows without saved values.
+    """
+    header = [cell.value for cell in sheet[1]]
+    # MTF frequencies of the sheet, the other headers are written with the current tolerances
+    lps = [match.group(1) for match in (re.fullmatch(r'MTF (\S+) lp/mm', str(text)) for text in header) if match]
+    linearity = next((i for i, text in enumerate(header) if str(text).startswith('Linearity (HU')), None)
+    if linearity is None or (not quick and len(lps) != 7):
+        return 0, 0, 0
+
+    rows, changed, missing = 0, 0, 0
+    tolerances = None
+    for row in sheet.iter_rows(min_row=2):
+        rows += 1
+        measurement = measurements.get(row_time(row[0].value, row[1].value))
+        name = None if measurement is None or 'tolerance_set' not in measurement else str(measurement['tolerance_set'][0])
+        if not name or not hasattr(constants, name):
+            missing += 1
+            continue
+        tolerances = getattr(constants, name)
+        # HU tolerance is a float in the Pylinac results
+        tols = [float(tolerances['hu_tolerance']), tolerances['scaling_tolerance'], tolerances['thickness_tolerance']]
+        if quick:
+            columns = catphan_quick_columns(tols)
+        else:
+            columns = catphan_columns(tols + [tolerances['low_contrast_tolerance']], lps)
+
+        # HU differences from the current expected values
+        differences = dict(zip(map(str, measurement['hu_roi_names']), hu_differences(measurement, tolerances)))
+        for i, insert in enumerate(LINEARITY_INSERTS):
+            if insert in differences:
+                changed += set_cell(row[linearity + i], int(differences[insert]))
+
+        # Pass/fail columns are added to sheets saved before the verdicts
+        for column, verdict in catphan_verdicts(measurement, tolerances).items():
+            if verdict is not None:
+                changed += set_cell(sheet.cell(row[0].row, columns.index(column) + 1), verdict)
+
+    # Headers with the tolerances of the last re-evaluated row
+    if tolerances is not None:
+        for i, text in enumerate(columns):
+            changed += set_cell(sheet.cell(1, i + 1), text)
+    return rows, changed, missing
+
+
+def reevaluate(save_path, tests=('T2-T3', 'Catphan', 'Catphan daily'), dry_run=False):
+    """
+    Recomputes the pass/fail results of the results Excel files in save_path with
+    the current tolerances (constants.py), from the saved measured values.
+
+    Parameters
+    ----------
+    save_path : Path
+        Results folder.
+    tests : tuple, optional
+        Sheets re-evaluated. The default is ('T2-T3', 'Catphan', 'Catphan daily').
+    dry_run : bool, optional
+        Count the changes without saving. The default is False.
+
+    Returns
+    -------
+    summary : list
+        (file, test, rows, changed cells, rows without saved values) of each sheet.
+
+    """
+    # Openpyxl is imported when the results are read (slow import)
+    import openpyxl
+    from qa_analysis.trends import rebuild_trends
+
+    # Analysis logger
+    logger_a = logging.getLogger('qa.analysis')
+
+    summary = []
+    saved = False
+    for path_excel in sorted(glob(os.path.join(str(save_path), 'Results_*.xlsx'))):
+        machine = os.path.basename(path_excel)[len('Results_'):-len('.xlsx')]
+        with file_lock(path_excel) as locked:
+            if not locked or not wait_user_close(path_excel):
+                logger_a.info(f'{os.path.basename(path_excel)} not re-evaluated (file in use).')
+                continue
+            book = openpyxl.load_workbook(path_excel)
+            total = 0
+            for test in tests:
+                if test not in book.sheetnames:
+                    continue
+                if test in ('Catphan', 'Catphan daily'):
+                    counts = reevaluate_catphan(book[test], catphan_measurements(save_path, machine, test),
+                                                quick=test == 'Catphan daily')
+                else:
+                    counts = reevaluate_vmat(book[test])
+                summary.append((os.path.basename(path_excel), test, *counts))
+                total += counts[1]
+                logger_a.info(f'{os.path.basename(path_excel)} {test}: {counts[0]} rows, {counts[1]} cells changed, '
+                              f'{counts[2]} rows without saved values')
+            if total > 0 and not dry_run:
+                book.save(path_excel)
+                saved = True
+
+    # Trend statistics follow the changed HU differences
+    if saved:
+        rebuild_trends(save_path)
+    return summary
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Worker processes for running the analyses.
+
+Importing Pylinac and its dependencies takes several seconds. The worker pool
+is started once and the imports are done when the workers start, so that 
+the analysis can start as soon as new files are found.
+
+Compressed CT and MR slices are decoded in a separate pool of processes, 
+which import only pydicom.
+
+The independent analyses of one session (T2, T3 and Halcyon T2DR), and the
+Catphan modules, are run in session pools, which are started on first use and 
+kept for the next sessions.
+"""
+import os
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from qa_analysis.utilities import start_log
+from qa_analysis.logqueue import attach_queue, log_queue
+
+# Session pools of this process by name, and their number of workers (see session_pool)
+_session_pools = {}
+
+
+def start_pool(workers=1, log_path=None, preload=True):
+    """
+    Starts a pool of worker processes and waits until the workers are ready.
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of worker processes. The default is 1.
+    log_path : Path, optional
+        File for saving event logs in the workers. The default is None.
+    preload : bool, optional
+        Import Pylinac and other analysis dependencies when the workers start. 
+        The default is True.
+
+    Returns
+    -------
+    pool : ProcessPoolExecutor
+        Worker pool.
+
+    """
+    # Share the cores between the workers (BLAS and OpenMP threads)
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    limit_threads(threads)
+    
+    pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, 
+                               initargs=(log_path, preload, threads, log_queue()))
+    
+    # Start all workers now (the pool starts workers on demand)
+    wait([pool.submit(os.getpid) for _ in range(workers)])
+    
+    return pool
+
+
+def init_worker(log_path=None, preload=True, threads=None, queue=None):
+    """
+    Sets up logging and imports the analysis dependencies in a worker process.
+
+    Parameters
+    ----------
+    log_path : Path, optional
+        File for saving event logs. The default is None.
+    preload : bool, optional
+        Import Pylinac and other analysis dependencies. The default is True.
+    threads : int, optional
+        Number of BLAS and OpenMP threads in the worker. The default is None (not limited).
+    queue : multiprocessing.Queue, optional
+        Log queue of the main process. The default is None (the worker logs to log_path).
+
+    Returns
+    -------
+    None.
+
+    """
+    # Records are sent to the listener of the main process (forked workers inherit the queue handler)
+    if queue is not None:
+        attach_queue(queue)
+    elif log_path is not None and len(logging.getLogger('').handlers) == 0:
+        start_log(log_path)
+    
+    # Libraries loaded before the worker started (forked workers) are limited at runtime
+    if threads is not None:
+        try:
+            from threadpoolctl import threadpool_limits
+            threadpool_limits(threads)
+        except ImportError:
+            pass
+    
+    if preload:
+        preload_modules()
+
+
+def limit_threads(threads):
+    """
+    Sets the number of BLAS and OpenMP threads for processes started after the call.
+    Values set by the user are kept.
+
+    Parameters
+    ----------
+    threads : int
+        Number of threads per process.
+
+    Returns
+    -------
+    None.
+
+    """
+    for variable in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 
+                     'NUMEXPR_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS'):
+        os.environ.setdefault(variable, str(threads))
+
+
+def preload_modules():
+    """
+    Imports the modules used by the analyses.
+    """
+    import pandas
+    import openpyxl
+    import matplotlib.pyplot
+    from pylinac import image, DRGS, DRMLC, WinstonLutz, ACRMRILarge
+    from qa_analysis import phantoms
+
+
+@contextmanager
+def decode_pool(workers=1):
+    """
+    Pool of processes for decoding DICOM pixel data, shut down on exit.
+    Yields None for workers <= 1 (decoding in the current process).
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of decoding processes. The default is 1.
+
+    Yields
+    ------
+    pool : ProcessPoolExecutor or None
+        Decoding pool.
+
+    """
+    if workers <= 1:
+        yield None
+        return
+    
+    # Processes, as the pydicom RLE decoder is pure Python (holds the GIL)
+    pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        yield pool
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+
+def session_pool(workers=1, log_path=None, name='session', share=1):
+    """
+    Pool for running the analyses of one session concurrently (e.g. T2, T3 and T2DR).
+    The pool is started on first use with Pylinac imported, and kept for the next sessions.
+    Returns None for workers <= 1 or when no cores are left (analyses in the current process).
+
+    Parameters
+    ----------
+    workers : int, optional
+        Number of processes. Limited to the cores left for this process. The default is 1.
+    log_path : Path, optional
+        File for saving event logs in the workers. The default is None.
+    name : str, optional
+        Name of the pool, e.g. 'catphan' for the Catphan modules. Pools of different
+        names are kept separately. The default is 'session'.
+    share : int, optional
+        Number of processes running sessions at the same time (e.g. the analysis workers
+        of main.py), which share the cores. The default is 1.
+
+    Returns
+    -------
+    pool : ProcessPoolExecutor or None
+        Session pool.
+
+    """
+    # Cores left for the sessions of this process, the pools are not oversubscribed
+    cores = max(1, (os.cpu_count() or 1) // max(1, share))
+    workers = min(workers, cores)
+    if workers <= 1:
+        return None
+    
+    # Restart the pool if the number of workers changed
+    if name in _session_pools and _session_pools[name][1] != workers:
+        close_session_pool(name)
+    if name not in _session_pools:
+        threads = max(1, cores // workers)
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                   initargs=(log_path, True, threads, log_queue()))
+        _session_pools[name] = (pool, workers)
+    return _session_pools[name][0]
+
+
+def close_session_pool(name='session'):
+    """
+    Shuts down a session pool, e.g. after a worker stopped unexpectedly.
+    """
+    if name in _session_pools:
+        pool, _ = _session_pools.pop(name)
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def decode_pixels(path):
+    """
+    Decodes the pixel data of a DICOM file. Run in the decoding pool.
+
+    Parameters
+    ----------
+    path : str
+        DICOM file.
+
+    Returns
+    -------
+    numpy.ndarray
+        Stored pixel values.
+
+    """
+    import pydicom
+    from pydicom.uid import ImplicitVRLittleEndian
+    
+    ds = pydicom.dcmread(path, force=True)
+    # Files without meta information (as in Pylinac)
+    if 'TransferSyntaxUID' not in ds.file_meta:
+        ds.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    return ds.pixel_array
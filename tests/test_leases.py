@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Claiming and reclaiming the lease of a measurement group (leases.py).
+"""
+import os
+from time import time
+
+from qa_analysis.leases import Lease, group_key
+
+
+def expire(lease):
+    """
+    Sets the last heartbeat of a lease past its ttl.
+    """
+    path = os.path.join(lease.lease_path, f'{lease.key}.{lease.generation}.lease')
+    past = time() - 2 * lease.ttl
+    os.utime(path, (past, past))
+
+
+def test_group_key():
+    assert group_key('20240501', 'CT 1/A') == group_key('20240501', 'CT 1/A')
+    assert group_key('20240501', 'CT 1/A') != group_key('20240501', 'CT_1_A')
+    assert '/' not in group_key('20240501', 'CT 1/A')
+
+
+def test_one_worker_gets_the_lease(tmp_path):
+    key = group_key('20240501', 'LINAC1')
+    first, second = Lease(tmp_path, key, 'a'), Lease(tmp_path, key, 'b')
+    assert first.claim()
+    assert not second.claim()
+    assert first.renew()
+
+    # Released lease can be claimed again
+    first.release()
+    assert second.claim()
+    assert second.generation == 0
+
+
+def test_expired_lease_is_reclaimed(tmp_path):
+    key = group_key('20240501', 'LINAC1')
+    first, second, third = Lease(tmp_path, key, 'a'), Lease(tmp_path, key, 'b'), Lease(tmp_path, key, 'c')
+    assert first.claim()
+    expire(first)
+
+    assert second.claim()
+    assert second.generation == 1
+    assert not third.claim()
+    # Earlier generation is removed, the first worker has lost the lease
+    assert os.listdir(tmp_path) == [f'{key}.1.lease']
+    assert not first.renew()
+    assert second.renew()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Running statistics and control charts of the QA results (trends.py).
+"""
+import numpy as np
+
+from qa_analysis.trends import (
+    TREND_PARAMETERS, WINSTON_COLUMNS, new_statistics, update_statistics, statistics_std,
+    add_results, winston_results
+    )
+from qa_analysis.utilities import catphan_columns
+
+
+def follow(values, parameters=TREND_PARAMETERS):
+    """
+    Statistics and alerts of a series of results.
+    """
+    stats = new_statistics()
+    alerts = [update_statistics(stats, x, parameters) for x in values]
+    return stats, alerts
+
+
+def test_welford_mean_and_std():
+    values = np.random.default_rng(1).normal(2.0, 0.3, 200)
+    # No alerts, all results are in the baseline
+    stats, _ = follow(values, dict(TREND_PARAMETERS, min_samples=len(values)))
+    assert stats['n'] == len(values)
+    assert np.isclose(stats['mean'], values.mean())
+    assert np.isclose(statistics_std(stats), values.std(ddof=1))
+
+
+def test_std_needs_two_results():
+    stats, _ = follow([1.0])
+    assert statistics_std(stats) == 0.0
+
+
+def test_ewma():
+    values = [1.0, 2.0, 4.0, 3.0]
+    stats, _ = follow(values)
+    lam = TREND_PARAMETERS['ewma_lambda']
+    ewma = values[0]
+    for x in values[1:]:
+        ewma = lam * x + (1 - lam) * ewma
+    assert np.isclose(stats['ewma'], ewma)
+    assert stats['last'] == values[-1]
+
+
+def test_outlier_is_left_out_of_the_baseline():
+    baseline = [10.0 + 0.1 * (-1) ** i for i in range(20)]
+    stats, _ = follow(baseline)
+    mean, n = stats['mean'], stats['n']
+
+    alerts = update_statistics(stats, 20.0)
+    assert any('sigma limits' in alert for alert in alerts)
+    assert stats['n'] == n and stats['mean'] == mean
+    assert stats['last'] == 20.0
+
+
+def test_cusum_detects_a_small_shift():
+    baseline = [10.0 + 0.1 * (-1) ** i for i in range(20)]
+    stats, _ = follow(baseline)
+    std = statistics_std(stats)
+
+    # Shift of 1.5 std, inside the 3 sigma limits
+    alerts = []
+    for _ in range(10):
+        alerts += update_statistics(stats, stats['mean'] + 1.5 * std)
+        if any('CUSUM' in alert for alert in alerts):
+            break
+    assert any('upward shift' in alert for alert in alerts)
+    assert not any('sigma limits' in alert for alert in alerts)
+    # Restarted after the signal
+    assert stats['cusum_pos'] == 0.0
+
+
+def test_no_alerts_before_the_baseline():
+    _, alerts = follow([1.0, 1.1, 0.9, 50.0])
+    assert all(len(a) == 0 for a in alerts)
+
+
+def catphan_row(tols):
+    """
+    Catphan columns (catphan_columns) and a row of values.
+    """
+    columns = catphan_columns(tols, [0.2, 0.4, 0.6, 0.8, 1.0, 1.2, 1.4])
+    values = (['01.05.2024', '08:00:00', '', 120, 200, 'F', 'K', 12.5]
+              + list(range(-7, 0)) + [50.1, 2.05] + [1, 2, 3, 4, 5] + [11.0, 6] + [0.5, 0.7, 0.9]
+              + [0.9] * 7 + [True] * 5)
+    return columns, values
+
+
+def test_catphan_metrics_have_stable_keys():
+    trends = {}
+    add_results(trends, 'CT1', 'Catphan', *catphan_row([10, 0.5, 0.1, 5]))
+    add_results(trends, 'CT1', 'Catphan', *catphan_row([20, 1.0, 0.2, 3]))
+    metrics = trends['CT1']['Catphan']
+    assert metrics['hu_air']['n'] == 2 and metrics['hu_air']['last'] == -7
+    assert metrics['uniformity_center']['last'] == 1
+    assert metrics['low_contrast_rois_seen']['last'] == 6
+    assert metrics['mtf_50']['last'] == 0.7
+    # Scan settings and the MTF at fixed frequencies are not followed
+    assert len(metrics) == 19
+    assert not any('KVP' in key or 'lp/mm' in key for key in metrics)
+
+
+def test_winston_offsets():
+    offsets = np.array([[0.3, 0.4, 0.0, 0.0], [0.0, 0.1, 0.0, 0.0], [-0.6, 0.8, 0.0, 0.0]])
+    assert np.allclose(winston_results(offsets), [1.0, 0.5])
+
+    trends = {}
+    add_results(trends, 'LINAC1', 'Winston-Lutz', WINSTON_COLUMNS, winston_results(offsets))
+    assert set(trends['LINAC1']['Winston-Lutz']) == {'bb_offset_max_mm', 'bb_offset_median_mm'}
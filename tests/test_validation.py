@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+Expected Winston-Lutz angles of a session (validation.py).
+"""
+from qa_analysis.validation import RT_AXES, missing_axes
+
+
+class Header:
+    """
+    RT image header with the gantry, collimator and couch angles (DicomHeader.get_value).
+    """
+
+    def __init__(self, gantry, collimator, couch):
+        self.values = dict(zip(RT_AXES, [gantry, collimator, couch]))
+
+    def get_value(self, tag, default=None):
+        return self.values.get(tag, default)
+
+
+EXPECTED = [(0, 0, 0), (90, 0, 0), (180, 0, 0), (270, 0, 0)]
+
+
+def test_all_angles_found():
+    images = [Header(g, c, t) for g, c, t in EXPECTED]
+    assert missing_axes(images, EXPECTED) == []
+
+
+def test_missing_angles():
+    images = [Header(0, 0, 0), Header(180, 0, 0)]
+    assert missing_axes(images, EXPECTED) == [(90, 0, 0), (270, 0, 0)]
+
+
+def test_angles_within_tolerance_over_360():
+    images = [Header(359.6, 0.4, 0), Header(90.5, 0, 359.8), Header(180, 0, 0), Header(270, 0, 0)]
+    assert missing_axes(images, EXPECTED, tol=1) == []
+    assert missing_axes(images, EXPECTED, tol=0.3) == [(0, 0, 0), (90, 0, 0)]
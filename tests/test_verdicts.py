@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Pass/fail results from the measured values and the tolerances (verdicts.py).
+"""
+import numpy as np
+
+from qa_analysis.arrays import ROI_COLUMNS
+from qa_analysis.verdicts import vmat_passed, hu_differences, catphan_verdicts, row_time
+
+TOLERANCES = {'hu_tolerance': 10, 'scaling_tolerance': 0.5, 'thickness_tolerance': 0.1,
+              'low_contrast_tolerance': 5, 'expected_hu_values': {'Air': -983}}
+
+
+def roi(nominal, value):
+    """
+    ROI statistics row (ROI_COLUMNS).
+    """
+    row = dict(nominal_value=nominal, value=value, stdev=1.0, difference=value - nominal)
+    return [row[column] for column in ROI_COLUMNS]
+
+
+def catphan_values(**changes):
+    """
+    Measured values of a Catphan analysis within the tolerances (arrays.catphan_arrays).
+    """
+    arrays = {
+        'hu_rois': np.array([roi(-1000, -985), roi(-196, -190), roi(120, 128)]),
+        'hu_roi_names': np.array(['Air', 'PMP', 'Delrin']),
+        'uniformity_rois': np.array([roi(0, 2), roi(0, -3), roi(0, 9)]),
+        'line_distances': np.array([50.1, 49.8, 50.3, 49.9]),
+        'slice_thickness': np.array([[2.05, 2.0]]),
+        'low_contrast_rois_seen': np.array([6.0]),
+        }
+    arrays.update(changes)
+    return arrays
+
+
+def test_vmat_passed_is_strict():
+    assert vmat_passed(1.49, 1.5)
+    assert not vmat_passed(1.5, 1.5)
+    assert isinstance(vmat_passed(np.float64(0.2), 1.5), bool)
+
+
+def test_hu_differences_use_expected_values():
+    # Air from the expected values, the others from the nominal values of the analysis
+    differences = hu_differences(catphan_values(), TOLERANCES)
+    np.testing.assert_allclose(differences, [-2, 6, 8])
+
+
+def test_hu_differences_without_expected_values():
+    differences = hu_differences(catphan_values(), {'hu_tolerance': 10})
+    np.testing.assert_allclose(differences, [15, 6, 8])
+
+
+def test_catphan_verdicts_pass():
+    verdicts = catphan_verdicts(catphan_values(), TOLERANCES)
+    assert verdicts == {'HU linearity passed': True, 'Geometry passed': True, 'Slice thickness passed': True,
+                        'Uniformity passed': True, 'Low contrast passed': True}
+
+
+def test_catphan_verdicts_fail():
+    arrays = catphan_values(hu_rois=np.array([roi(-1000, -970)]), hu_roi_names=np.array(['Air']),
+                            uniformity_rois=np.array([roi(0, 11)]),
+                            line_distances=np.array([50.0, 50.5]),
+                            slice_thickness=np.array([[2.1, 2.0]]),
+                            low_contrast_rois_seen=np.array([4.0]))
+    verdicts = catphan_verdicts(arrays, TOLERANCES)
+    assert not any(verdicts.values())
+
+
+def test_catphan_verdicts_boundaries():
+    # HU and uniformity pass at the tolerance, geometry and slice thickness fail at it
+    arrays = catphan_values(hu_rois=np.array([roi(-1000, -973)]), hu_roi_names=np.array(['Air']),
+                            uniformity_rois=np.array([roi(0, -10)]),
+                            line_distances=np.array([50.5]),
+                            slice_thickness=np.array([[2.1, 2.0]]),
+                            low_contrast_rois_seen=np.array([5.0]))
+    verdicts = catphan_verdicts(arrays, TOLERANCES)
+    assert verdicts['HU linearity passed'] and verdicts['Uniformity passed'] and verdicts['Low contrast passed']
+    assert not verdicts['Geometry passed'] and not verdicts['Slice thickness passed']
+
+
+def test_catphan_verdicts_missing_values():
+    # Quick analysis (no uniformity or low contrast), and unknown nominal slice thickness
+    arrays = catphan_values(slice_thickness=np.array([[2.05, np.nan]]))
+    del arrays['uniformity_rois'], arrays['low_contrast_rois_seen']
+    verdicts = catphan_verdicts(arrays, TOLERANCES)
+    assert verdicts['HU linearity passed'] and verdicts['Geometry passed']
+    assert verdicts['Slice thickness passed'] is None
+    assert verdicts['Uniformity passed'] is None
+    assert verdicts['Low contrast passed'] is None
+
+
+def test_row_time():
+    assert row_time('01.05.2024', '08:30:15') == np.datetime64('2024-05-01T08:30:15')
+    assert row_time(None, '08:30:15') is None
+    assert row_time('01.05.2024', 'noon') is None